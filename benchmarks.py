@@ -0,0 +1,235 @@
+# coding: utf-8
+
+"""Benchmarks of sandboxie's hot paths.
+
+Run from the project root directory::
+
+    $ python benchmarks.py
+
+Results are printed as JSON. Sandboxie itself is not needed: the
+:class:`sandboxie.Sandboxie` benchmarks run against a stand-in Start.exe and
+generated Sandboxie.ini configs in a temporary directory, so they can be run
+on any platform. See ``python benchmarks.py --help`` for options.
+"""
+
+from __future__ import unicode_literals
+
+import argparse
+import configparser
+import contextlib
+import io
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import timeit
+
+import sandboxie
+
+
+FAKE_START_EXE = '''#!{python}
+import sys
+args = sys.argv[1:]
+if '/listpids' in args:
+    sys.stdout.write('13\\r\\n2705\\r\\n5716\\r\\n')
+elif not ('/reload' in args or '/terminate' in args or
+          '/terminate_all' in args):
+    sys.stdout.write(' '.join(args))
+'''
+
+
+def generate_config_text(sections, settings_per_section=8):
+    """Returns the text of a Sandboxie.ini config with a ``GlobalSettings``
+    section followed by *sections* sandbox sections, each with
+    *settings_per_section* settings, some of them repeated."""
+    lines = ['[GlobalSettings]',
+             r'FileRootPath=C:\Sandbox\%USER%\%SANDBOX%',
+             '']
+    for i in range(sections):
+        lines.append('[Box{0}]'.format(i))
+        lines.append('Enabled=y')
+        for j in range(settings_per_section - 1):
+            if j % 2:
+                lines.append(r'OpenFilePath=app{0}.exe,C:\Data\{1}'.format(
+                    j, i))
+            else:
+                lines.append('Setting{0}=value {1}'.format(j, i))
+        lines.append('')
+    return '\r\n'.join(lines)
+
+
+def time_call(func, repeat=5):
+    """Returns a ``dict`` of the best and median wall time, in seconds, of
+    *repeat* calls of *func*."""
+    times = sorted(timeit.repeat(func, number=1, repeat=repeat))
+    return {'best': times[0], 'median': times[len(times) // 2]}
+
+
+def percentiles(times):
+    """Returns a ``dict`` of the throughput, in calls per second, and the
+    latency percentiles, in seconds, of calls that took *times* seconds."""
+    times = sorted(times)
+
+    def percentile(p):
+        return times[min(len(times) - 1, int(len(times) * p / 100.0))]
+
+    return {'calls': len(times),
+            'throughput': len(times) / sum(times),
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99),
+            'max': times[-1]}
+
+
+def time_calls(func, samples):
+    """Returns a list of the wall times, in seconds, of *samples* calls of
+    *func*. The ``int`` index of each call is passed to *func*."""
+    times = []
+    for i in range(samples):
+        started = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+@contextlib.contextmanager
+def fake_installation(sections):
+    """Context manager that yields the directory of a stand-in Sandboxie
+    installation, with a Start.exe that emulates ``/box:``, ``/reload``,
+    ``/listpids`` and ``/terminate``, and a Sandboxie.ini config of
+    *sections* sandbox sections, as generated by
+    :func:`generate_config_text`."""
+    install_dir = tempfile.mkdtemp(prefix='sandboxie-benchmarks-')
+    environ = os.environ.copy()
+    try:
+        start_exe = os.path.join(install_dir, 'Start.exe')
+        with io.open(start_exe, 'w') as f:
+            f.write(FAKE_START_EXE.format(python=sys.executable))
+        os.chmod(start_exe, os.stat(start_exe).st_mode | stat.S_IEXEC)
+        config_path = os.path.join(install_dir, 'Sandboxie.ini')
+        with io.open(config_path, 'w', encoding='utf-16', newline='') as f:
+            f.write(generate_config_text(sections))
+        os.environ['WinDir'] = install_dir
+        yield install_dir
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(install_dir)
+
+
+def benchmark_sandboxie(sections, samples=20):
+    """Measures the throughput and latency percentiles of the hot paths of
+    :class:`sandboxie.Sandboxie`, against a stand-in installation with a
+    config of *sections* sandbox sections (see :func:`fake_installation`).
+
+    Commands are run *samples* times each; parsing the config is repeated
+    fewer times for the largest configs.
+    """
+    parse_samples = max(3, min(samples, 100000 // max(sections, 1)))
+    with fake_installation(sections) as install_dir:
+        sbie = sandboxie.Sandboxie(install_dir=install_dir)
+        uncached = sandboxie.Sandboxie(install_dir=install_dir,
+                                       cache_config=False)
+        options = {'Enabled': 'yes', 'ConfigLevel': '7'}
+        results = {
+            'sections': sections,
+            'bytes': os.path.getsize(sbie.config_path),
+            'get_config': percentiles(time_calls(
+                lambda i: uncached.get_config(), parse_samples)),
+            'get_config_cached': percentiles(time_calls(
+                lambda i: sbie.get_config(), parse_samples)),
+            'create_sandbox': percentiles(time_calls(
+                lambda i: sbie.create_sandbox('Bench{0}'.format(i), options),
+                samples)),
+            'destroy_sandbox': percentiles(time_calls(
+                lambda i: sbie.destroy_sandbox('Bench{0}'.format(i)),
+                samples)),
+            'start': percentiles(time_calls(
+                lambda i: sbie.start('notepad.exe', box='Box0'), samples)),
+            'running_processes': percentiles(time_calls(
+                lambda i: sbie.running_processes(box='Box0'), samples)),
+        }
+        with sandboxie.WorkerPoolRunner() as runner:
+            pooled = sandboxie.Sandboxie(install_dir=install_dir,
+                                         runner=runner)
+            results['start_worker_pool'] = percentiles(time_calls(
+                lambda i: pooled.start('notepad.exe', box='Box0'), samples))
+        with sandboxie.JobScheduler(sbie, max_workers=4,
+                                    max_per_box=2) as scheduler:
+            started = time.perf_counter()
+            futures = [scheduler.submit('notepad.exe',
+                                        box='Box{0}'.format(i % 4))
+                       for i in range(samples)]
+            for future in futures:
+                future.result()
+            elapsed = time.perf_counter() - started
+        results['start_scheduled'] = {
+            'calls': samples, 'throughput': samples / elapsed,
+            'max_wait_time': scheduler.stats().max_wait_time}
+    return results
+
+
+def benchmark_config_parsing(sections=10000):
+    """Compares parsing and serializing a Sandboxie.ini config of
+    *sections* sections with :class:`sandboxie.SandboxieConfig` and
+    :class:`configparser.ConfigParser`."""
+    text = generate_config_text(sections)
+
+    def parse_configparser():
+        parser = configparser.ConfigParser(strict=False, interpolation=None)
+        parser.read_string(text)
+        return parser
+
+    def parse_sandboxie():
+        return sandboxie.SandboxieConfig.from_string(text)
+
+    parser = parse_configparser()
+    config = parse_sandboxie()
+
+    def write_configparser():
+        parser.write(io.StringIO())
+
+    results = {
+        'sections': sections,
+        'bytes': len(text.encode('utf-16-le')),
+        'parse': {'configparser': time_call(parse_configparser),
+                  'sandboxie': time_call(parse_sandboxie)},
+        'write': {'configparser': time_call(write_configparser),
+                  'sandboxie': time_call(config.to_string)},
+    }
+    for operation in ('parse', 'write'):
+        times = results[operation]
+        times['speedup'] = (times['configparser']['median']
+                            / times['sandboxie']['median'])
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sections', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000, 100000],
+                        help='the sizes of the generated configs, in sandbox '
+                             'sections (default: %(default)s)')
+    parser.add_argument('--samples', type=int, default=20,
+                        help='the number of times each operation is run '
+                             '(default: %(default)s)')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout,
+                        help='the file to write the JSON results to '
+                             '(default: stdout)')
+    args = parser.parse_args(argv)
+    results = {
+        'python': sys.version.split()[0],
+        'config_parsing': benchmark_config_parsing(),
+        'sandboxie': [benchmark_sandboxie(sections, args.samples)
+                      for sections in args.sections],
+    }
+    json.dump(results, args.output, indent=2, sort_keys=True)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -23,26 +23,2375 @@
 
 from __future__ import unicode_literals
 
+import asyncio
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
 import configparser
 import contextlib
+import functools
+import getpass
+import glob
+import gzip
+import heapq
 import io
+import itertools
+import json
+import logging
+import mmap
 import os
+import queue
+import random
+import re
+import shutil
+import stat
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 import _meta
 
 
-__version__ = _meta.__version__
+__version__ = _meta.__version__
+
+_log = logging.getLogger(__name__)
+
+
+class SandboxieError(Exception):
+    pass
+
+
+class ConfigLockTimeout(SandboxieError):
+    """Raised when the Sandboxie.ini lock could not be acquired in time."""
+
+
+class SandboxPoolTimeout(SandboxieError):
+    """Raised when no sandbox of a :class:`SandboxPool` could be leased
+    within the timeout."""
+
+
+class JobQueueFull(SandboxieError):
+    """Raised when a job is submitted to a :class:`JobScheduler` whose
+    queue is full, and there was no room for it within the timeout."""
+
+
+class CommandTimeout(SandboxieError):
+    """Raised when a Start.exe command line did not complete within its
+    timeout, or before the current :func:`Sandboxie.deadline`. The command
+    is killed (or, if the deadline had already passed, not run at all).
+
+    :ivar cmd: The command line, as a list of arguments.
+    :ivar timeout: The number of seconds the command was allowed to run.
+    """
+
+    def __init__(self, cmd, timeout):
+        SandboxieError.__init__(
+            self, 'Command {0!r} timed out after {1:.3g} seconds'.format(
+                cmd, timeout))
+        self.cmd = cmd
+        self.timeout = timeout
+
+
+class CheckpointExpired(SandboxieError):
+    """Raised by :func:`Sandboxie.changed_files` when the changes since the
+    checkpoint are no longer retained by the content index of the
+    sandbox."""
+
+
+class ConfigConflictError(SandboxieError):
+    """Raised when an optimistic config update kept conflicting with
+    concurrent writers, and ran out of retries."""
+
+
+ConfigCacheInfo = collections.namedtuple('ConfigCacheInfo',
+                                         ['hits', 'misses', 'currsize'])
+
+
+def _stat_signature(path):
+    """Returns a tuple identifying the version of the file at *path*, or
+    ``None`` if the file does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+_UNSET = object()
+
+
+def _section_name(line):
+    """Returns the name of the section whose header is *line*, or ``None``
+    if *line* is not a section header."""
+    line = line.strip()
+    close = line.rfind(']')
+    # Lines such as "[]" are not headers.
+    if line[:1] != '[' or close < 2:
+        return None
+    return line[1:close]
+
+
+def _check_setting(key, value):
+    if not key or '=' in key or key != key.strip() or '\n' in key:
+        raise ValueError('Invalid setting name: {0!r}'.format(key))
+    if '\n' in value or '\r' in value:
+        raise ValueError('Invalid value for setting {0!r}: {1!r}'.format(
+            key, value))
+
+
+class SandboxieSection(collections.abc.MutableMapping):
+    """A section of a Sandboxie.ini config: an ordered mapping of setting
+    names to values.
+
+    Setting names are case-insensitive, and a setting may be repeated, as
+    Sandboxie does for settings such as ``OpenFilePath`` or
+    ``ForceProcess``. Indexing returns the first value of a setting (the one
+    Sandboxie uses for single-valued settings); :func:`get_all` returns all
+    of them. Assigning a ``list`` or ``tuple`` sets all values of a setting
+    at once.
+
+    The settings are stored as a tuple of ``(name, value)`` pairs, which is
+    shared, rather than copied, by copies of the section.
+    """
+
+    __slots__ = ('name', '_entries')
+
+    def __init__(self, name, entries=()):
+        self.name = name
+        self._entries = tuple(entries)
+
+    @property
+    def entries(self):
+        """A tuple of the ``(name, value)`` pairs of all settings, in
+        order."""
+        return self._entries
+
+    def __getitem__(self, key):
+        key_lower = key.lower()
+        for name, value in self._entries:
+            if name.lower() == key_lower:
+                return value
+        raise KeyError(key)
+
+    def get_all(self, key):
+        """Returns a list of all values of the setting *key*."""
+        key_lower = key.lower()
+        return [value for name, value in self._entries
+                if name.lower() == key_lower]
+
+    def __setitem__(self, key, value):
+        if isinstance(value, (list, tuple)):
+            values = [str(v) for v in value]
+        else:
+            values = [str(value)]
+        for v in values:
+            _check_setting(key, v)
+        key_lower = key.lower()
+        entries = []
+        replaced = False
+        for name, old_value in self._entries:
+            if name.lower() != key_lower:
+                entries.append((name, old_value))
+            elif not replaced:
+                entries.extend((name, v) for v in values)
+                replaced = True
+        if not replaced:
+            entries.extend((key, v) for v in values)
+        self._entries = tuple(entries)
+
+    def add(self, key, value):
+        """Adds a value of the setting *key*, after any existing ones."""
+        value = str(value)
+        _check_setting(key, value)
+        self._entries += ((key, value),)
+
+    def __delitem__(self, key):
+        key_lower = key.lower()
+        entries = tuple(entry for entry in self._entries
+                        if entry[0].lower() != key_lower)
+        if len(entries) == len(self._entries):
+            raise KeyError(key)
+        self._entries = entries
+
+    def __iter__(self):
+        seen = set()
+        for name, _ in self._entries:
+            name_lower = name.lower()
+            if name_lower not in seen:
+                seen.add(name_lower)
+                yield name
+
+    def __len__(self):
+        return len(set(name.lower() for name, _ in self._entries))
+
+    def __eq__(self, other):
+        if isinstance(other, SandboxieSection):
+            return self._entries == other._entries
+        return collections.abc.MutableMapping.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<SandboxieSection {0!r}: {1!r}>'.format(
+            self.name, list(self._entries))
+
+
+# The values accepted by ConfigParser, and the y and n used by Sandboxie.
+_BOOLEAN_STATES = dict(configparser.ConfigParser.BOOLEAN_STATES,
+                       y=True, n=False)
+
+
+def _convert_boolean(value):
+    try:
+        return _BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError('Not a boolean: {0}'.format(value))
+
+
+class SandboxieConfig(object):
+    """A parsed Sandboxie.ini config: an ordered collection of
+    :class:`SandboxieSection` objects, keyed by section name.
+
+    Supports the commonly used subset of the
+    :class:`configparser.ConfigParser` interface, and raises the same
+    exceptions, while preserving repeated settings and the case of setting
+    names. Values are never interpolated, so Sandboxie variables such as
+    ``%SANDBOX%`` are kept verbatim.
+    """
+
+    def __init__(self):
+        self._sections = collections.OrderedDict()
+
+    @classmethod
+    def from_string(cls, text):
+        """Returns the config parsed from the string *text*."""
+        config = cls()
+        config.read_string(text)
+        return config
+
+    def read_string(self, text):
+        """Parses the Sandboxie.ini config in the string *text*, adding its
+        sections and settings to this config. A leading byte order mark is
+        ignored. Settings of repeated sections are merged.
+        """
+        if text[:1] == '\ufeff':
+            text = text[1:]
+        sections = self._sections
+        parsed = collections.OrderedDict()
+        entries = None
+        for line in text.split('\n'):
+            if line[:1] == '[':
+                name = _section_name(line)
+                if name is not None:
+                    entries = parsed.get(name)
+                    if entries is None:
+                        entries = parsed[name] = (
+                            list(sections[name]._entries)
+                            if name in sections else [])
+                    continue
+            if entries is None:
+                continue
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            key, sep, value = line.partition('=')
+            if sep:
+                entries.append((key.rstrip(), value.lstrip()))
+        for name, entries in parsed.items():
+            sections[name] = SandboxieSection(name, entries)
+
+    def read_file(self, f):
+        """Parses the Sandboxie.ini config read from the text file *f*. See
+        :func:`read_string`."""
+        self.read_string(f.read())
+
+    def sections(self):
+        """Returns a list of the section names."""
+        return list(self._sections)
+
+    def has_section(self, section):
+        return section in self._sections
+
+    def add_section(self, section):
+        """Adds an empty section named *section*. Raises
+        :class:`configparser.DuplicateSectionError` if it already
+        exists."""
+        if section in self._sections:
+            raise configparser.DuplicateSectionError(section)
+        if ('\n' in section or '\r' in section
+                or _section_name('[{0}]'.format(section)) != section):
+            raise ValueError('Invalid section name: {0!r}'.format(section))
+        self._sections[section] = SandboxieSection(section)
+
+    def remove_section(self, section):
+        """Removes *section*. Returns ``True`` if it existed."""
+        return self._sections.pop(section, None) is not None
+
+    def _section(self, section):
+        try:
+            return self._sections[section]
+        except KeyError:
+            raise configparser.NoSectionError(section)
+
+    def __getitem__(self, section):
+        return self._sections[section]
+
+    def __setitem__(self, section, options):
+        """Replaces *section* with the settings in the mapping
+        *options*."""
+        if section not in self._sections:
+            self.add_section(section)
+        if isinstance(options, SandboxieSection):
+            self._sections[section] = SandboxieSection(section,
+                                                       options.entries)
+            return
+        new_section = SandboxieSection(section)
+        for key, value in options.items():
+            new_section[key] = value
+        self._sections[section] = new_section
+
+    def __delitem__(self, section):
+        del self._sections[section]
+
+    def __contains__(self, section):
+        return section in self._sections
+
+    def __iter__(self):
+        return iter(self._sections)
+
+    def __len__(self):
+        return len(self._sections)
+
+    def __eq__(self, other):
+        if not isinstance(other, SandboxieConfig):
+            return NotImplemented
+        return self._sections == other._sections
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def options(self, section):
+        """Returns a list of the setting names of *section*."""
+        return list(self._section(section))
+
+    def has_option(self, section, option):
+        return section in self._sections and option in self._sections[section]
+
+    def get(self, section, option, raw=False, vars=None, fallback=_UNSET):
+        """Returns the first value of setting *option* of *section*, or
+        *fallback* if it is given and the setting does not exist. The *raw*
+        and *vars* arguments are accepted for compatibility with
+        :class:`configparser.ConfigParser`, and ignored."""
+        try:
+            return self._section(section)[option]
+        except (configparser.NoSectionError, KeyError):
+            if fallback is not _UNSET:
+                return fallback
+            if section not in self._sections:
+                raise
+            raise configparser.NoOptionError(option, section)
+
+    def _get_converted(self, section, option, conv, fallback):
+        try:
+            value = self.get(section, option)
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            if fallback is _UNSET:
+                raise
+            return fallback
+        return conv(value)
+
+    def getint(self, section, option, raw=False, vars=None,
+               fallback=_UNSET):
+        """Like :func:`get`, but converts the value to an ``int``."""
+        return self._get_converted(section, option, int, fallback)
+
+    def getfloat(self, section, option, raw=False, vars=None,
+                 fallback=_UNSET):
+        """Like :func:`get`, but converts the value to a ``float``."""
+        return self._get_converted(section, option, float, fallback)
+
+    def getboolean(self, section, option, raw=False, vars=None,
+                   fallback=_UNSET):
+        """Like :func:`get`, but converts the value to a ``bool``, as
+        :func:`configparser.ConfigParser.getboolean` does: ``yes``,
+        ``true``, ``on`` and ``1`` are true, and ``no``, ``false``, ``off``
+        and ``0`` are false, ignoring case. Sandboxie's own ``y`` and ``n``
+        are also accepted. Raises :class:`ValueError` for other values."""
+        return self._get_converted(section, option, _convert_boolean,
+                                   fallback)
+
+    def get_all(self, section, option):
+        """Returns a list of all values of setting *option* of
+        *section*."""
+        return self._section(section).get_all(option)
+
+    def set(self, section, option, value):
+        """Sets setting *option* of *section* to *value*, replacing all of
+        its values. *value* may be a list of values."""
+        self._section(section)[option] = value
+
+    def add(self, section, option, value):
+        """Adds a value of setting *option* of *section*, after any existing
+        ones."""
+        self._section(section).add(option, value)
+
+    def remove_option(self, section, option):
+        """Removes all values of setting *option* of *section*. Returns
+        ``True`` if it existed."""
+        section = self._section(section)
+        if option not in section:
+            return False
+        del section[option]
+        return True
+
+    def items(self, section=_UNSET, raw=False, vars=None):
+        """Returns a list of ``(name, value)`` pairs of all settings of
+        *section*, including repeated ones, or a list of ``(name, section)``
+        pairs of all sections if *section* is not given."""
+        if section is _UNSET:
+            return list(self._sections.items())
+        return list(self._section(section).entries)
+
+    def copy(self):
+        """Returns a copy of the config, which can be modified
+        independently."""
+        copy = SandboxieConfig()
+        for name, section in self._sections.items():
+            copy._sections[name] = SandboxieSection(name, section._entries)
+        return copy
+
+    def write(self, f):
+        """Writes the config to the text file *f*, in the format Sandboxie
+        uses."""
+        f.write(self.to_string())
+
+    def to_string(self):
+        """Returns the config as a string, in the format Sandboxie
+        uses."""
+        lines = []
+        for name, section in self._sections.items():
+            lines.append('[{0}]'.format(name))
+            lines.extend(['='.join(entry) for entry in section._entries])
+            lines.append('')
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class _ConfigVersion(object):
+    """A parsed version of the Sandboxie.ini config, along with the layout
+    of its sections in the file, which allows changes to it to be written
+    incrementally.
+
+    :ivar config: The parsed config.
+    :ivar layout: A list of ``(section, start, end)`` byte ranges of the
+        file's sections, or ``None`` if unknown.
+    :ivar newline: The line separator used by the file.
+    :ivar bom: Whether the file starts with a byte order mark.
+    :ivar signature: The stat signature of the file that was parsed.
+    """
+
+    __slots__ = ('config', 'layout', 'newline', 'bom', 'signature')
+
+    def __init__(self, config, layout, newline, bom, signature):
+        self.config = config
+        self.layout = layout
+        self.newline = newline
+        self.bom = bom
+        self.signature = signature
+
+
+_LF = '\n'.encode('utf-16-le')
+_SECTION_START = '\n['.encode('utf-16-le')
+_UTF16_BOM = b'\xff\xfe'
+
+
+def _find_aligned(data, sub, start=0):
+    """Returns the lowest even index of *sub* in *data* at or after *start*,
+    or -1. UTF-16 code units are 2 bytes wide, so matches at odd indexes
+    straddle two characters and are not real matches."""
+    index = data.find(sub, start)
+    while index != -1 and index % 2:
+        index = data.find(sub, index + 1)
+    return index
+
+
+def _scan_sections(data):
+    """Returns a list of ``(section, start, end)`` byte ranges of each
+    section in *data*, the UTF-16-LE encoded contents of a Sandboxie.ini
+    config. A section spans from its header line to the next header line, or
+    the end of *data*.
+
+    *data* may be any buffer supporting ``find`` and slicing, such as a
+    :class:`mmap.mmap`. Only the section header lines are decoded.
+    """
+    starts = []
+    first = len(_UTF16_BOM) if data[:2] == _UTF16_BOM else 0
+    if data[first:first + 2] == _SECTION_START[2:]:
+        starts.append(first)
+    index = _find_aligned(data, _SECTION_START, first)
+    while index != -1:
+        starts.append(index + 2)
+        index = _find_aligned(data, _SECTION_START, index + 2)
+
+    sections = []
+    for start in starts:
+        line_end = _find_aligned(data, _LF, start)
+        if line_end == -1:
+            line_end = len(data)
+        # Lines that are not headers, such as "[]", belong to the previous
+        # section.
+        name = _section_name(data[start:line_end].decode('utf-16-le'))
+        if name is not None:
+            sections.append((name, start))
+    return [(name, start, sections[i + 1][1] if i + 1 < len(sections)
+             else len(data))
+            for i, (name, start) in enumerate(sections)]
+
+
+def _detect_newline(data):
+    """Returns the line separator used in the UTF-16-LE encoded *data*."""
+    if '\r\n'.encode('utf-16-le') in data:
+        return '\r\n'
+    if _find_aligned(data, _LF) != -1:
+        return '\n'
+    return os.linesep
+
+
+def _ends_with_newline(data):
+    return not len(data) or bytes(data[-2:]) == _LF
+
+
+def _encode_config_text(text, newline):
+    """Encodes the Sandboxie.ini config *text*, whose lines are separated by
+    ``\\n``, as UTF-16-LE with *newline* line separators."""
+    if newline != '\n':
+        text = text.replace('\n', newline)
+    return text.encode('utf-16-le')
+
+
+def _format_settings(entries):
+    """Returns the ``(name, value)`` setting *entries* of a section
+    formatted as Sandboxie does, with lines separated by ``\\n`` and
+    followed by a blank line."""
+    return ''.join([name + '=' + value + '\n' for name, value in entries]
+                   + ['\n'])
+
+
+def _format_section(config, section):
+    """Returns *section* of the :class:`SandboxieConfig` *config* formatted
+    as Sandboxie does, with lines separated by ``\\n``."""
+    return '[{0}]\n'.format(section) + _format_settings(
+        config[section].entries)
+
+
+def _encode_sections(config, sections, newline):
+    """Returns a list of each of *sections* of the :class:`SandboxieConfig`
+    *config*, formatted as by :func:`_format_section` and encoded as by
+    :func:`_encode_config_text`. Sections sharing their settings tuple, such
+    as those created from the same template, are only formatted and encoded
+    once."""
+    # Settings tuples are kept alive by config, so their ids are unique.
+    encoded_settings = {}
+    chunks = []
+    for section in sections:
+        entries = config[section].entries
+        settings = encoded_settings.get(id(entries))
+        if settings is None:
+            settings = _encode_config_text(_format_settings(entries), newline)
+            encoded_settings[id(entries)] = settings
+        chunks.append(_encode_config_text('[{0}]\n'.format(section),
+                                          newline) + settings)
+    return chunks
+
+
+def _apply_options(section, options):
+    """Sets the settings of the mapping *options* in the
+    :class:`SandboxieSection` *section*, removing those whose value is
+    ``None``."""
+    for key, value in options.items():
+        if value is None:
+            section.pop(key, None)
+        else:
+            section[key] = value
+
+
+def _diff_sections(old, new):
+    """Compares the sections of the configs *old* and *new*. Returns a tuple
+    of the lists of sections added to, removed from and changed in *new*."""
+    old_sections = set(old.sections())
+    new_sections = new.sections()
+    added = [s for s in new_sections if s not in old_sections]
+    removed = [s for s in old.sections() if not new.has_section(s)]
+    changed = [s for s in new_sections if s in old_sections
+               and old[s].entries != new[s].entries]
+    return added, removed, changed
+
+
+class ConfigDiff(collections.namedtuple('ConfigDiff',
+                                        ['added', 'removed', 'changed'])):
+    """The changes between two versions of a Sandboxie.ini config, as
+    returned by :func:`Sandboxie.commit`: the lists of the names of the
+    sections *added* and *removed*, and an ordered ``dict`` mapping the name
+    of each *changed* section to its :class:`SectionDiff`.
+
+    A ``ConfigDiff`` is false if the configs are the same.
+    """
+
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __str__(self):
+        if not self:
+            return 'no changes'
+        parts = []
+        if self.added:
+            parts.append('added {0}'.format(', '.join(self.added)))
+        if self.removed:
+            parts.append('removed {0}'.format(', '.join(self.removed)))
+        if self.changed:
+            parts.append('changed {0}'.format('; '.join(
+                '{0} ({1})'.format(name, diff)
+                for name, diff in self.changed.items())))
+        return '; '.join(parts)
+
+
+class SectionDiff(collections.namedtuple('SectionDiff',
+                                         ['added', 'removed', 'changed'])):
+    """The changes to a section of a Sandboxie.ini config: the lists of the
+    names of the settings *added*, *removed* and *changed* (including
+    repeated settings whose values were added, removed or reordered).
+
+    A ``SectionDiff`` is false if only the order of different settings
+    changed.
+    """
+
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __str__(self):
+        parts = ['{0}{1}'.format(sign, name)
+                 for sign, names in (('+', self.added), ('-', self.removed),
+                                     ('~', self.changed))
+                 for name in names]
+        return ', '.join(parts) or 'reordered'
+
+
+def _settings_by_name(section):
+    """Returns an ordered ``dict`` mapping the lowercase name of each setting
+    of *section* to a pair of its name and the list of its values."""
+    settings = collections.OrderedDict()
+    for name, value in section.entries:
+        setting = settings.get(name.lower())
+        if setting is None:
+            setting = settings[name.lower()] = (name, [])
+        setting[1].append(value)
+    return settings
+
+
+def _diff_section(old, new):
+    """Returns the :class:`SectionDiff` of the settings of the
+    :class:`SandboxieSection` *new* compared to those of *old*."""
+    old_settings = _settings_by_name(old)
+    new_settings = _settings_by_name(new)
+    added = [name for key, (name, _) in new_settings.items()
+             if key not in old_settings]
+    removed = [name for key, (name, _) in old_settings.items()
+               if key not in new_settings]
+    changed = [name for key, (name, values) in new_settings.items()
+               if key in old_settings and old_settings[key][1] != values]
+    return SectionDiff(added, removed, changed)
+
+
+def _diff_config(old, new):
+    """Returns the :class:`ConfigDiff` of the config *new* compared to the
+    config *old*."""
+    added, removed, changed = _diff_sections(old, new)
+    return ConfigDiff(added, removed, collections.OrderedDict(
+        (name, _diff_section(old[name], new[name])) for name in changed))
+
+
+def _is_box_section(name):
+    """Returns whether the Sandboxie.ini section *name* defines a sandbox,
+    rather than global (``GlobalSettings``), user (``UserSettings_*``) or
+    template (``Template_*``) settings."""
+    return not (name == 'GlobalSettings' or name.startswith('UserSettings_')
+                or name.startswith('Template_'))
+
+
+class _SectionIndex(object):
+    """An index of the byte ranges of each section of a version of the
+    Sandboxie.ini config file, identified by its stat *signature*.
+
+    :ivar spans: An ordered ``dict`` mapping each section name to a list of
+        the ``(start, end)`` byte ranges of its (possibly repeated) sections.
+    """
+
+    __slots__ = ('signature', 'spans')
+
+    def __init__(self, signature, spans):
+        self.signature = signature
+        self.spans = spans
+
+    @classmethod
+    def build(cls, config_file):
+        """Indexes the open binary *config_file*, by memory-mapping it, so
+        that only section headers are read and decoded."""
+        st = os.fstat(config_file.fileno())
+        spans = collections.OrderedDict()
+        if st.st_size:
+            data = mmap.mmap(config_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for name, start, end in _scan_sections(data):
+                    spans.setdefault(name, []).append((start, end))
+            finally:
+                data.close()
+        return cls((st.st_mtime_ns, st.st_size, st.st_ino), spans)
+
+    def read_section(self, config_file, name):
+        """Reads and parses section *name* from the open binary
+        *config_file*, which must be the indexed version of the file.
+        Returns a :class:`SandboxieSection`, or ``None`` if the section does
+        not exist."""
+        chunks = []
+        for start, end in self.spans.get(name, ()):
+            config_file.seek(start)
+            chunks.append(config_file.read(end - start))
+        if not chunks:
+            return None
+        text = b''.join(chunks).decode('utf-16-le')
+        return SandboxieConfig.from_string(text)[name]
+
+
+class _ConfigCache(object):
+    """A cache of parsed Sandboxie.ini configs keyed by file path, each
+    entry being revalidated against the file's stat signature (mtime, size
+    and inode) before it is handed out."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, load):
+        """Returns the parsed config at *path*, calling ``load()`` to parse
+        it only if the file changed since it was last cached. The cached
+        instance is returned; callers must not modify it.
+        """
+        # The file is stat'ed *before* it is loaded, so a concurrent change
+        # can at worst cause a spurious miss on the next call, never a stale
+        # hit.
+        signature = _stat_signature(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if (entry is not None and signature is not None
+                    and entry[0] == signature):
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        config = load()
+        if signature is not None:
+            with self._lock:
+                self._entries[path] = (signature, config)
+        return config
+
+    def put(self, path, signature, config):
+        """Caches *config* as the parsed config at *path*, whose stat
+        signature is *signature*."""
+        with self._lock:
+            self._entries[path] = (signature, config)
+
+    def invalidate(self, path=None):
+        """Drops the cached config at *path*, or all configs if *path* is
+        ``None``."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def info(self):
+        with self._lock:
+            return ConfigCacheInfo(self.hits, self.misses, len(self._entries))
+
+
+class _FileLock(object):
+    """An advisory, cross-process exclusive lock on the file at *path*,
+    which is created if it does not exist."""
+
+    poll_interval = 0.005
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self._fd = None
+
+    def _try_lock(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(self._fd, msvcrt.LK_NBLCK, 1)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def acquire(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        deadline = (None if self.timeout is None
+                    else time.monotonic() + self.timeout)
+        while not self._try_lock():
+            if deadline is not None and time.monotonic() >= deadline:
+                os.close(self._fd)
+                self._fd = None
+                raise ConfigLockTimeout(
+                    'Timed out waiting for lock on {0}'.format(self.path))
+            time.sleep(self.poll_interval)
+
+    def release(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _replace_file(src, dst, retries=5):
+    """Atomically replaces *dst* with *src*. On Windows, the replacement is
+    retried briefly while *dst* is held open by another process."""
+    for attempt in range(retries):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.01 * (attempt + 1))
+
+
+# The content folder of a sandbox, unless set by FileRootPath.
+_DEFAULT_FILE_ROOT = r'C:\Sandbox\%USER%\%SANDBOX%'
+
+# Suffix of the name a sandbox content folder is renamed to by
+# Sandboxie.reset_box, before it is deleted.
+_TOMBSTONE_SUFFIX = '.sandboxie-deleted-'
+
+_FILE_ATTRIBUTE_REPARSE_POINT = 0x400
+
+
+def _expand_file_root(path, box):
+    """Returns the Sandboxie setting *path* of sandbox *box*, such as
+    ``FileRootPath``, with its ``%SANDBOX%``, ``%USER%`` and environment
+    variables expanded, and its NT object namespace prefix, if any,
+    removed."""
+    def expand(match):
+        name = match.group(1)
+        if name.upper() == 'SANDBOX':
+            return box
+        if name.upper() == 'USER':
+            return getpass.getuser()
+        return os.environ.get(name, match.group(0))
+
+    path = re.sub(r'%([^%]+)%', expand, path)
+    if path.startswith('\\??\\'):
+        path = path[4:]
+    return path
+
+
+def _is_tree_dir(entry):
+    """Returns whether the :func:`os.scandir` entry *entry* is a directory
+    to descend into, rather than a file, symbolic link or junction."""
+    if not entry.is_dir(follow_symlinks=False):
+        return False
+    attributes = getattr(entry.stat(follow_symlinks=False),
+                         'st_file_attributes', 0)
+    return not attributes & _FILE_ATTRIBUTE_REPARSE_POINT
+
+
+def _remove_path(remove, path):
+    """Removes *path* with ``remove(path)``, clearing its read-only
+    attribute if needed, as Windows requires. A *path* that does not exist,
+    e.g. because another thread removed it, is ignored."""
+    try:
+        remove(path)
+    except FileNotFoundError:
+        pass
+    except PermissionError:
+        os.chmod(path, stat.S_IWRITE)
+        remove(path)
+
+
+def _scan_and_remove_files(path):
+    """Removes the files, symbolic links and junctions of the directory
+    *path*, and returns a list of the paths of its subdirectories."""
+    subdirs = []
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return subdirs
+    for entry in entries:
+        try:
+            is_tree_dir = _is_tree_dir(entry)
+        except FileNotFoundError:
+            continue
+        if is_tree_dir:
+            subdirs.append(entry.path)
+        elif entry.is_dir(follow_symlinks=False):
+            _remove_path(os.rmdir, entry.path)
+        else:
+            _remove_path(os.unlink, entry.path)
+    return subdirs
+
+
+def _remove_tree(path, max_workers=8):
+    """Deletes the directory tree *path*, like :func:`shutil.rmtree`, but
+    scanning directories and deleting their files on up to *max_workers*
+    threads at once. Parts of the tree removed concurrently by another
+    thread or process are skipped."""
+    dirs = [path]
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        pending = set([executor.submit(_scan_and_remove_files, path)])
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                for subdir in future.result():
+                    dirs.append(subdir)
+                    pending.add(executor.submit(_scan_and_remove_files,
+                                                subdir))
+    # Subdirectories are always found after their parent, so removing them
+    # in reverse order removes each directory after its children.
+    for directory in reversed(dirs):
+        _remove_path(os.rmdir, directory)
+
+
+def _log_background_error(future, message, *args):
+    """Logs *message*, formatted with *args*, with the exception raised by
+    the background task of the :class:`concurrent.futures.Future` *future*
+    once it completes, if any, for tasks whose callers do not wait for
+    them."""
+    def log(future):
+        if not future.cancelled() and future.exception() is not None:
+            _log.error(message, *args, exc_info=future.exception())
+    future.add_done_callback(log)
+
+
+# The Linux FICLONE ioctl, which makes a file share the blocks of another
+# (a "reflink") on copy-on-write filesystems such as Btrfs and XFS.
+_FICLONE = 0x40049409
+
+# Suffix of the name of the folder a snapshot or restored sandbox content
+# folder is built in, before it is renamed into place.
+_STAGING_SUFFIX = '.sandboxie-staging-'
+
+
+class _TreeCloner(object):
+    """Copies directory trees, scanning directories and copying files on up
+    to *max_workers* threads at once.
+
+    Each file is copied with the cheapest method available: a hard link if
+    *hardlink* is ``True``, else a reflink, else :func:`os.copy_file_range`,
+    else a plain copy. A method that fails is not tried again by the same
+    cloner. The number of files copied with each method is counted in
+    ``self.counts``. Symbolic links and junctions are copied as symbolic
+    links, and are not followed.
+    """
+
+    def __init__(self, hardlink=False, max_workers=8):
+        self.hardlink = hardlink
+        self.max_workers = max_workers
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._reflink = fcntl is not None and sys.platform.startswith('linux')
+        self._copy_file_range = hasattr(os, 'copy_file_range')
+
+    def clone_tree(self, src, dst):
+        """Copies the directory tree *src* to *dst*, which must not exist,
+        and returns ``self.counts``."""
+        dirs = [(src, dst)]
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            pending = set([pool.submit(self._clone_dir, src, dst)])
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if result is None:
+                        continue
+                    subdirs, files = result
+                    for paths in subdirs:
+                        dirs.append(paths)
+                        pending.add(pool.submit(self._clone_dir, *paths))
+                    for paths in files:
+                        pending.add(pool.submit(self._clone_file, *paths))
+        # Copying the files of a directory changes its modification time, so
+        # directory metadata is copied last.
+        for src_dir, dst_dir in reversed(dirs):
+            shutil.copystat(src_dir, dst_dir)
+        return self.counts
+
+    def _clone_dir(self, src, dst):
+        """Creates the directory *dst*, copies the symbolic links of *src*
+        into it, and returns lists of the ``(src, dst)`` paths of the
+        subdirectories and files of *src* still to be copied."""
+        os.mkdir(dst)
+        subdirs = []
+        files = []
+        for entry in os.scandir(src):
+            target = os.path.join(dst, entry.name)
+            if _is_tree_dir(entry):
+                subdirs.append((entry.path, target))
+            elif entry.is_symlink() or entry.is_dir(follow_symlinks=False):
+                os.symlink(os.readlink(entry.path), target,
+                           target_is_directory=entry.is_dir())
+            else:
+                files.append((entry.path, target))
+        return subdirs, files
+
+    def _clone_file(self, src, dst):
+        method = None
+        if self.hardlink:
+            try:
+                os.link(src, dst)
+                method = 'hardlink'
+            except OSError:
+                pass
+        if method is None:
+            with io.open(src, 'rb') as fsrc, io.open(dst, 'wb') as fdst:
+                method = self._copy(fsrc, fdst)
+            shutil.copystat(src, dst)
+        with self._lock:
+            self.counts[method] += 1
+
+    def _copy(self, fsrc, fdst):
+        """Copies the contents of the file *fsrc* to the empty file *fdst*,
+        and returns the name of the method used."""
+        if self._reflink:
+            try:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+                return 'reflink'
+            except OSError:
+                self._reflink = False
+        if self._copy_file_range:
+            copied = 0
+            try:
+                while True:
+                    count = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                               1 << 30)
+                    if not count:
+                        return 'copy_file_range'
+                    copied += count
+            except OSError:
+                if copied:
+                    raise
+                self._copy_file_range = False
+        shutil.copyfileobj(fsrc, fdst, 1 << 20)
+        return 'copy'
+
+
+BoxUsage = collections.namedtuple('BoxUsage', ['files', 'size'])
+BoxUsage.__doc__ = """The disk usage of a sandbox, as returned by
+:func:`Sandboxie.box_usage`: its number of *files* and their total *size*,
+in bytes."""
+
+ContentChanges = collections.namedtuple('ContentChanges', [
+    'checkpoint', 'added', 'modified', 'deleted'])
+ContentChanges.__doc__ = """The files of a sandbox changed since a
+checkpoint, as returned by :func:`Sandboxie.changed_files`: sorted lists of
+the paths, relative to the sandbox's content folder, of the files *added*,
+*modified* and *deleted*, and the *checkpoint* to pass next time to get the
+changes made since."""
+
+# Directories modified less than this many nanoseconds before they are
+# scanned may be modified again without their modification time changing,
+# given the granularity of file times, so they are scanned again next time.
+_RACY_MTIME_NS = 2000000000
+
+
+class _ContentIndex(object):
+    """An index of the files under the directory *root*, with their size,
+    modification time and inode, refreshed incrementally by only scanning
+    the directories whose modification time or inode changed since the last
+    refresh, and persisted to the gzipped JSON file *path*.
+
+    Each refresh that finds changes starts a new generation. Every file
+    records the generations in which it was created and last changed, and
+    the past lifetimes of deleted files (which may since have been created
+    again) are remembered with the generations of their creation and
+    deletion, so that the changes since a generation can be listed. A log
+    of changes, ordered by generation, makes that proportional to the
+    number of changes rather than the number of files.
+
+    Only the changes of the last *retained_generations* generations are
+    kept, so that the index of a sandbox that is emptied over and over does
+    not grow with every file it ever held; ``self.oldest`` is the oldest
+    generation the changes since which can still be listed.
+
+    Files modified in place do not change the modification time of their
+    directory, so they are only seen by a full refresh. Files written in a
+    sandbox are first copied into its content folder, which does.
+    """
+
+    _FORMAT_VERSION = 3
+
+    retained_generations = 16
+
+    def __init__(self, root, path):
+        self.root = root
+        self.path = path
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.oldest = 0
+        # Directory relative path -> [signature, subdir names, files], where
+        # signature is [mtime_ns, inode], or None if the directory must be
+        # scanned again, and files maps file names to
+        # [size, mtime_ns, inode, created, changed].
+        self.dirs = {}
+        # File relative path -> list of [created, deleted] lifetimes.
+        self.deleted = {}
+        self.files = 0
+        self.size = 0
+        self._log = []
+
+    @classmethod
+    def load(cls, root, path):
+        """Returns the index of *root* persisted to *path*, or a new, empty
+        index if there is none, or it is unreadable or of another root."""
+        index = cls(root, path)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError, EOFError):
+            return index
+        # Version 1 indexes are the same as version 2, but without a history
+        # limit, and both only kept the last lifetime of deleted files.
+        version = state.get('version')
+        if (version not in (1, 2, cls._FORMAT_VERSION)
+                or state.get('root') != root):
+            return index
+        index.generation = state['generation']
+        index.oldest = state.get('oldest', 0)
+        index.deleted = state['deleted']
+        if version < 3:
+            index.deleted = dict((rel, [lifetime])
+                                 for rel, lifetime in index.deleted.items())
+        for rel, (signature, subdirs, files) in state['dirs'].items():
+            index.dirs[rel] = [signature, set(subdirs), files]
+            for name, (size, _, _, _, changed) in files.items():
+                index.files += 1
+                index.size += size
+                if changed > index.oldest:
+                    index._log.append((changed, os.path.join(rel, name)))
+        index._log.extend((deleted, rel)
+                          for rel, lifetimes in index.deleted.items()
+                          for _, deleted in lifetimes)
+        index._log.sort()
+        index._prune()
+        return index
+
+    def save(self):
+        """Atomically writes the index to ``self.path``."""
+        state = {
+            'version': self._FORMAT_VERSION,
+            'root': self.root,
+            'generation': self.generation,
+            'oldest': self.oldest,
+            'dirs': dict((rel, [signature, sorted(subdirs), files])
+                         for rel, (signature, subdirs, files)
+                         in self.dirs.items()),
+            'deleted': self.deleted,
+        }
+        index_dir, index_name = os.path.split(self.path)
+        os.makedirs(index_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=index_name, dir=index_dir)
+        try:
+            with io.open(fd, 'wb') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                    gz.write(json.dumps(state, separators=(',', ':'))
+                             .encode('utf-8'))
+            _replace_file(temp_path, self.path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _record(self, rel):
+        self._log.append((self.generation, rel))
+
+    def _prune(self):
+        """Forgets the changes older than the last
+        ``self.retained_generations`` generations."""
+        horizon = self.generation - self.retained_generations
+        if horizon <= self.oldest:
+            return
+        self.oldest = horizon
+        deleted = {}
+        for rel, lifetimes in self.deleted.items():
+            lifetimes = [lifetime for lifetime in lifetimes
+                         if lifetime[1] > horizon]
+            if lifetimes:
+                deleted[rel] = lifetimes
+        self.deleted = deleted
+        del self._log[:bisect.bisect_right(self._log,
+                                           (horizon, '\U0010ffff'))]
+
+    def _add_file(self, rel, stat_result, created=None):
+        """Records the file *rel* as changed in the current generation, and
+        returns its entry. A file that is not replacing an indexed one is
+        recorded as created in the current generation."""
+        if created is None:
+            created = self.generation
+        self.files += 1
+        self.size += stat_result.st_size
+        self._record(rel)
+        return [stat_result.st_size, stat_result.st_mtime_ns,
+                stat_result.st_ino, created, self.generation]
+
+    def _delete_file(self, rel, entry):
+        self.files -= 1
+        self.size -= entry[0]
+        self.deleted.setdefault(rel, []).append([entry[3], self.generation])
+        self._record(rel)
+
+    def _delete_dir(self, rel):
+        _, subdirs, files = self.dirs.pop(rel)
+        for name, entry in files.items():
+            self._delete_file(os.path.join(rel, name), entry)
+        for name in subdirs:
+            self._delete_dir(os.path.join(rel, name))
+
+    def _scan_dir(self, rel, signature):
+        """Re-scans the directory *rel*, whose signature is now *signature*,
+        recording the changes to its files and subdirectories."""
+        _, old_subdirs, old_files = self.dirs.get(rel, (None, set(), {}))
+        subdirs = set()
+        files = {}
+        for entry in os.scandir(os.path.join(self.root, rel)):
+            try:
+                if _is_tree_dir(entry):
+                    subdirs.add(entry.name)
+                    continue
+                stat_result = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            name_rel = os.path.join(rel, entry.name)
+            old = old_files.get(entry.name)
+            if (old is not None and old[0] == stat_result.st_size
+                    and old[1] == stat_result.st_mtime_ns
+                    and old[2] == stat_result.st_ino):
+                files[entry.name] = old
+                continue
+            if old is not None:
+                self.files -= 1
+                self.size -= old[0]
+                files[entry.name] = self._add_file(name_rel, stat_result,
+                                                   created=old[3])
+            else:
+                files[entry.name] = self._add_file(name_rel, stat_result)
+        for name in set(old_files) - set(files):
+            self._delete_file(os.path.join(rel, name), old_files[name])
+        for name in old_subdirs - subdirs:
+            self._delete_dir(os.path.join(rel, name))
+        self.dirs[rel] = [signature, subdirs, files]
+
+    def refresh(self, full=False):
+        """Brings the index up to date with the files under ``self.root``,
+        re-scanning every directory if *full* is ``True``, and saves it if
+        anything changed. Returns the current generation."""
+        self.generation += 1
+        log_length = len(self._log)
+        racy_mtime = int(time.time() * 1e9) - _RACY_MTIME_NS
+        pending = ['']
+        while pending:
+            rel = pending.pop()
+            try:
+                stat_result = os.stat(os.path.join(self.root, rel))
+                signature = [stat_result.st_mtime_ns, stat_result.st_ino]
+                known = self.dirs.get(rel)
+                if full or known is None or known[0] != signature:
+                    if stat_result.st_mtime_ns >= racy_mtime:
+                        signature = None
+                    self._scan_dir(rel, signature)
+            except (FileNotFoundError, NotADirectoryError):
+                if rel in self.dirs:
+                    self._delete_dir(rel)
+                continue
+            pending.extend(os.path.join(rel, name)
+                           for name in self.dirs[rel][1])
+        if len(self._log) == log_length:
+            self.generation -= 1
+        else:
+            self._prune()
+            self.save()
+        return self.generation
+
+    def changes(self, since):
+        """Returns a :class:`ContentChanges` of the changes made after
+        generation *since*, or of all files, as added, if *since* is 0.
+        Raises :class:`CheckpointExpired` if *since* is older than
+        ``self.oldest``."""
+        if since <= 0:
+            added = [os.path.join(rel, name)
+                     for rel, (_, _, files) in self.dirs.items()
+                     for name in files]
+            return ContentChanges(self.generation, sorted(added), [], [])
+        if since < self.oldest:
+            raise CheckpointExpired(
+                'The changes of {0} since checkpoint {1} are no longer '
+                'retained; the oldest is {2}'.format(self.root, since,
+                                                     self.oldest))
+        start = bisect.bisect_right(self._log, (since, '\U0010ffff'))
+        added = []
+        modified = []
+        deleted = []
+        for rel in set(rel for _, rel in self._log[start:]):
+            directory, name = os.path.split(rel)
+            entry = self.dirs.get(directory, (None, None, {}))[2].get(name)
+            if entry is not None and entry[4] <= since:
+                continue
+            existed = any(created <= since < deleted_in
+                          for created, deleted_in
+                          in self.deleted.get(rel, ()))
+            if entry is None:
+                if existed:
+                    deleted.append(rel)
+            elif existed or entry[3] <= since:
+                modified.append(rel)
+            else:
+                added.append(rel)
+        return ContentChanges(self.generation, sorted(added),
+                              sorted(modified), sorted(deleted))
+
+
+class _ReloadCoalescer(object):
+    """Coalesces bursts of config reload requests into a single call of
+    *reload*, made by a background thread once no request has been made for
+    *delay* seconds, or at most *max_delay* seconds after the first pending
+    request."""
+
+    def __init__(self, reload, delay, max_delay=None):
+        self._reload = reload
+        self.delay = delay
+        self.max_delay = max_delay
+        self.reloads = 0
+        self._cond = threading.Condition()
+        self._reload_lock = threading.Lock()
+        self._requested = 0
+        self._completed = 0
+        self._error = None
+        self._first_request = None
+        self._last_request = None
+        self._thread = None
+
+    def request(self):
+        with self._cond:
+            now = time.monotonic()
+            self._requested += 1
+            if self._first_request is None:
+                self._first_request = now
+            self._last_request = now
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='sandboxie-reload-coalescer')
+                self._thread.daemon = True
+                self._thread.start()
+            else:
+                self._cond.notify_all()
+
+    def _due(self):
+        due = self._last_request + self.delay
+        if self.max_delay is not None:
+            due = min(due, self._first_request + self.max_delay)
+        return due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._first_request is None:
+                    self._thread = None
+                    return
+                remaining = self._due() - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+            self._reload_pending()
+
+    def _reload_pending(self):
+        """Reloads the config if a reload is pending. Returns the exception
+        raised by the reload, if any."""
+        with self._reload_lock:
+            with self._cond:
+                if self._first_request is None:
+                    return None
+                generation = self._requested
+                self._first_request = self._last_request = None
+            try:
+                self._reload()
+                error = None
+            except Exception as e:
+                error = e
+            with self._cond:
+                self.reloads += 1
+                self._completed = generation
+                self._error = error
+                self._cond.notify_all()
+            return error
+
+    def flush(self):
+        error = self._reload_pending()
+        if error is not None:
+            raise error
+
+    def wait(self, timeout=None):
+        with self._cond:
+            target = self._requested
+            if not self._cond.wait_for(lambda: self._completed >= target,
+                                       timeout):
+                return False
+            if self._error is not None:
+                raise self._error
+            return True
+
+
+class _Flight(object):
+    """A call in progress, whose result is shared by all callers waiting on
+    it."""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _ProcessCache(object):
+    """Caches the process ids running in each sandbox for *ttl* seconds,
+    and coalesces concurrent lookups of the same key into a single call."""
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._flights = {}
+        self._generation = 0
+
+    def get(self, key, fetch, timeout=None):
+        """Returns the cached result for *key*, a tuple whose first item is
+        the sandbox name, or calls ``fetch()`` to get it. Callers arriving
+        while ``fetch()`` is running wait for, and share, its result; they
+        raise :class:`subprocess.TimeoutExpired` if it is not available
+        within *timeout* seconds (unless ``None``)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                generation = self._generation
+        if not leader:
+            if timeout is not None:
+                timeout = max(timeout, 0)
+            if not flight.done.wait(timeout):
+                raise subprocess.TimeoutExpired(key, timeout)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fetch()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                # Results fetched before an invalidation may be stale.
+                if (flight.error is None and self.ttl
+                        and generation == self._generation):
+                    self._entries[key] = (time.monotonic(), flight.result)
+            flight.done.set()
+        return flight.result
+
+    def invalidate(self, box=None):
+        """Discards the cached results of sandbox *box*, or of all
+        sandboxes if *box* is ``None``. Lookups in progress are not joined by
+        later callers, and their results are not cached."""
+        with self._lock:
+            self._generation += 1
+            for mapping in (self._entries, self._flights):
+                for key in list(mapping):
+                    if box is None or key[0] == box:
+                        del mapping[key]
+
+
+class _CleanupQueue(object):
+    """Runs ``cleanup(box)`` for queued sandboxes on up to *workers*
+    threads, highest priority first, and in submission order for equal
+    priorities. A sandbox queued again before its cleanup has started is
+    only cleaned up once, and the cleanups of a sandbox never overlap."""
+
+    def __init__(self, cleanup, workers):
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self.workers = workers
+        self._cleanup = cleanup
+        self._cond = threading.Condition()
+        self._heap = []
+        self._pending = {}
+        self._deferred = {}
+        self._active = set()
+        self._order = itertools.count()
+        self._threads = 0
+
+    def submit(self, box, priority=0):
+        """Queues the cleanup of *box*, and returns a
+        :class:`concurrent.futures.Future` of its completion."""
+        with self._cond:
+            future = None
+            if box in self._pending:
+                future, queued_priority, _ = self._pending[box]
+                if future.cancelled():
+                    future = None
+                elif priority <= queued_priority:
+                    return future
+            if future is None:
+                future = concurrent.futures.Future()
+            order = next(self._order)
+            self._pending[box] = (future, priority, order)
+            heapq.heappush(self._heap, (-priority, order, box))
+            if self._threads < self.workers:
+                self._threads += 1
+                worker = threading.Thread(target=self._work,
+                                          name='sandboxie-cleanup')
+                worker.daemon = True
+                worker.start()
+        return future
+
+    def _next_cleanup(self):
+        """Returns the next ``(box, future)`` to clean up, or ``None`` if
+        there is none. Must be called with ``self._cond`` held."""
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            box = entry[2]
+            pending = self._pending.get(box)
+            if pending is None or pending[2] != entry[1]:
+                # Superseded by a higher priority request for the same box.
+                continue
+            if box in self._active:
+                self._deferred[box] = entry
+                continue
+            self._active.add(box)
+            return box, self._pending.pop(box)[0]
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                cleanup = self._next_cleanup()
+                if cleanup is None:
+                    self._threads -= 1
+                    self._cond.notify_all()
+                    return
+            box, future = cleanup
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        self._cleanup(box)
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(None)
+            finally:
+                with self._cond:
+                    self._active.discard(box)
+                    entry = self._deferred.pop(box, None)
+                    if entry is not None:
+                        heapq.heappush(self._heap, entry)
+
+    def drain(self, timeout=None):
+        """Blocks until all queued cleanups have completed, or until
+        *timeout* seconds have passed. Returns ``False`` if the timeout
+        expired, ``True`` otherwise."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._threads, timeout)
+
+
+class _JobRunner(object):
+    """Runs ``(box, func)`` jobs on up to *max_workers* threads, running at
+    most *max_per_box* jobs of the same box at once. Jobs are started in
+    submission order, except that jobs of a box at its limit are skipped
+    over until one of its running jobs completes."""
+
+    def __init__(self, max_workers, max_per_box=None):
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+        self.max_workers = max_workers
+        self.max_per_box = max_per_box
+        self._cond = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._active = collections.Counter()
+        self._workers = 0
+
+    def submit(self, box, func):
+        """Schedules ``func()`` to be run, and returns a
+        :class:`concurrent.futures.Future` of its result."""
+        future = concurrent.futures.Future()
+        with self._cond:
+            self._pending.setdefault(box, collections.deque()).append(
+                (future, func))
+            if self._workers < self.max_workers:
+                self._workers += 1
+                worker = threading.Thread(target=self._work,
+                                          name='sandboxie-job-runner')
+                worker.daemon = True
+                worker.start()
+            else:
+                self._cond.notify()
+        return future
+
+    def _next_job(self):
+        """Returns the next runnable ``(box, future, func)``, or ``None`` if
+        no job is runnable. Must be called with ``self._cond`` held."""
+        for box, jobs in self._pending.items():
+            if (self.max_per_box is None
+                    or self._active[box] < self.max_per_box):
+                future, func = jobs.popleft()
+                if not jobs:
+                    del self._pending[box]
+                return box, future, func
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    if not self._pending:
+                        self._workers -= 1
+                        return
+                    self._cond.wait()
+                    job = self._next_job()
+                box, future, func = job
+                self._active[box] += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = func()
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                with self._cond:
+                    self._active[box] -= 1
+                    if not self._active[box]:
+                        del self._active[box]
+                    self._cond.notify_all()
+
+
+# Process-wide config cache, shared by all Sandboxie instances created with
+# ``shared_config_cache=True``.
+_shared_config_cache = _ConfigCache()
+
+
+class Metrics(object):
+    """Collects the latency, call and error counts of
+    :class:`Sandboxie` operations, and the number of config bytes read and
+    written, for inspection with :func:`snapshot` or scraping with
+    :func:`export_prometheus`.
+
+    The operations measured are the :class:`Sandboxie` methods that run
+    Start.exe, or that read Sandboxie.ini or the files of sandboxes, each
+    under its name, and the coroutines of :class:`AsyncSandboxie`, under
+    their name prefixed with ``async_``. Methods that only queue work, such
+    as :func:`Sandboxie.cleanup_async`, or that only read memory, such as
+    :func:`Sandboxie.resolve_template`, are not measured; the operations
+    they lead to are. :func:`Sandboxie.start_many` measures the submission
+    of its jobs, each of which is measured as a ``start``.
+
+    A :class:`Metrics` instance may be shared by several :class:`Sandboxie`
+    instances to aggregate their metrics.
+    """
+
+    #: The upper bounds, in seconds, of the latency histogram buckets.
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+               2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._observers = []
+        self.reset()
+
+    def reset(self):
+        """Discards all collected metrics."""
+        with self._lock:
+            self._operations = {}
+            self.bytes_read = 0
+            self.bytes_written = 0
+
+    def add_observer(self, observer):
+        """Registers *observer* to be called as
+        ``observer(operation, seconds, error)`` after each instrumented
+        operation, where *error* is the exception raised by the operation,
+        or ``None``. Returns *observer*."""
+        with self._lock:
+            self._observers.append(observer)
+        return observer
+
+    def remove_observer(self, observer):
+        with self._lock:
+            self._observers.remove(observer)
+
+    def observe(self, operation, seconds, error=None):
+        """Records a call of *operation* that took *seconds*, and raised
+        *error* unless it is ``None``."""
+        with self._lock:
+            stats = self._operations.get(operation)
+            if stats is None:
+                stats = self._operations[operation] = {
+                    'count': 0, 'errors': 0, 'sum': 0.0,
+                    'buckets': [0] * (len(self.buckets) + 1)}
+            stats['count'] += 1
+            stats['sum'] += seconds
+            stats['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+            if error is not None:
+                stats['errors'] += 1
+            observers = list(self._observers)
+        for observer in observers:
+            try:
+                observer(operation, seconds, error)
+            except Exception:
+                _log.exception('Metrics observer %r failed', observer)
+
+    def add_bytes(self, read=0, written=0):
+        """Records *read* bytes read from, and *written* bytes written to,
+        the Sandboxie.ini config."""
+        with self._lock:
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def snapshot(self):
+        """Returns a ``dict`` of the collected metrics: ``operations`` maps
+        each operation name to a ``dict`` of its call ``count``, ``errors``
+        count, total latency (``sum``) and latency histogram (``buckets``, a
+        list of cumulative ``(upper_bound, count)`` pairs); ``bytes_read``
+        and ``bytes_written`` are the config bytes read and written."""
+        with self._lock:
+            operations = {}
+            for operation, stats in self._operations.items():
+                cumulative = 0
+                buckets = []
+                for bound, count in zip(self.buckets + (float('inf'),),
+                                        stats['buckets']):
+                    cumulative += count
+                    buckets.append((bound, cumulative))
+                operations[operation] = {'count': stats['count'],
+                                         'errors': stats['errors'],
+                                         'sum': stats['sum'],
+                                         'buckets': buckets}
+            return {'operations': operations,
+                    'bytes_read': self.bytes_read,
+                    'bytes_written': self.bytes_written}
+
+    def export_prometheus(self, prefix='sandboxie'):
+        """Returns the collected metrics in the Prometheus text exposition
+        format, with metric names starting with *prefix*."""
+        snapshot = self.snapshot()
+        operations = sorted(snapshot['operations'].items())
+        name = prefix + '_operation_seconds'
+        lines = ['# HELP {0} Latency of operations.'.format(name),
+                 '# TYPE {0} histogram'.format(name)]
+        for operation, stats in operations:
+            for bound, count in stats['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{0}_bucket{{operation="{1}",le="{2}"}} {3}'
+                             .format(name, operation, le, count))
+            lines.append('{0}_sum{{operation="{1}"}} {2!r}'.format(
+                name, operation, stats['sum']))
+            lines.append('{0}_count{{operation="{1}"}} {2}'.format(
+                name, operation, stats['count']))
+
+        name = prefix + '_operation_errors_total'
+        lines.extend(['# HELP {0} Operations that raised.'.format(name),
+                      '# TYPE {0} counter'.format(name)])
+        for operation, stats in operations:
+            lines.append('{0}{{operation="{1}"}} {2}'.format(
+                name, operation, stats['errors']))
+
+        for direction in ('read', 'written'):
+            name = '{0}_config_bytes_{1}_total'.format(prefix, direction)
+            lines.extend([
+                '# HELP {0} Sandboxie.ini bytes {1}.'.format(name, direction),
+                '# TYPE {0} counter'.format(name),
+                '{0} {1}'.format(name, snapshot['bytes_' + direction])])
+        return '\n'.join(lines) + '\n'
+
+
+def _instrumented(func):
+    """Decorates the :class:`Sandboxie` method *func* to record its
+    latency and errors in ``self.metrics``, under its name."""
+    operation = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        error = None
+        try:
+            return func(self, *args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.metrics.observe(operation, time.perf_counter() - started,
+                                 error)
+    return wrapper
+
+
+def _instrumented_async(func):
+    """Decorates the :class:`AsyncSandboxie` coroutine method *func* to
+    record its latency and errors in the metrics of its :class:`Sandboxie`,
+    under its name prefixed with ``async_``."""
+    operation = 'async_' + func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        error = None
+        try:
+            return await func(self, *args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.sandboxie.metrics.observe(
+                operation, time.perf_counter() - started, error)
+    return wrapper
+
+
+class SubprocessRunner(object):
+    """Runs Start.exe command lines for :class:`Sandboxie` by spawning each
+    one as a new process. This is the default runner."""
+
+    def run(self, args, timeout=None):
+        """Runs the command line *args*, a list of arguments, and returns its
+        output as ``bytes``. Raises :class:`subprocess.CalledProcessError` if
+        it exits with a non-zero status, :class:`OSError` if it could not be
+        run, or :class:`subprocess.TimeoutExpired`, once it has been killed,
+        if it is still running after *timeout* seconds (unless ``None``)."""
+        return subprocess.check_output(args, timeout=timeout)
+
+    def spawn(self, args, stderr=None):
+        """Starts the command line *args*, and returns its
+        :class:`subprocess.Popen`, whose output is readable from its
+        ``stdout`` pipe. *stderr* is passed to :class:`subprocess.Popen`."""
+        return subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr)
+
+    def close(self):
+        """Releases the resources of the runner."""
+
+
+# Source of the helper processes of WorkerPoolRunner. Each one reads JSON
+# command lines and their timeouts from stdin, one per line, runs them, and
+# writes a JSON reply with the exit status and output of each one to stdout.
+# A command that times out is killed, and its reply has no exit status.
+_WORKER_SOURCE = """
+import json
+import subprocess
+import sys
+
+for line in sys.stdin.buffer:
+    args, timeout = json.loads(line.decode('utf-8'))
+    try:
+        process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE)
+        try:
+            output = process.communicate(timeout=timeout)[0]
+            reply = {'returncode': process.returncode}
+        except subprocess.TimeoutExpired:
+            process.kill()
+            output = process.communicate()[0]
+            reply = {'timeout': timeout}
+        reply['output'] = output.decode('latin-1')
+    except OSError as e:
+        reply = {'errno': e.errno, 'strerror': e.strerror}
+    sys.stdout.buffer.write(json.dumps(reply).encode('utf-8') + b'\\n')
+    sys.stdout.buffer.flush()
+"""
+
+
+class WorkerPoolRunner(object):
+    """Runs Start.exe command lines for :class:`Sandboxie` through a pool of
+    up to *workers* long-lived helper processes, which receive command lines
+    and send back their exit status and output over pipes.
+
+    Spawning a command from a small helper process, rather than from the
+    (possibly large) calling process, keeps the cost of each spawn low, and
+    the helpers themselves are only started once, on first use. A helper
+    that dies is replaced; the command it was running raises
+    :class:`SandboxieError`.
+
+    Can be used as a context manager, which calls :func:`close` on exit.
+    """
+
+    def __init__(self, workers=1):
+        if workers < 1:
+            raise ValueError('workers must be at least 1')
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._spawned = 0
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _spawn(self):
+        return subprocess.Popen([sys.executable, '-c', _WORKER_SOURCE],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _acquire(self):
+        """Returns an idle helper process, spawning one if fewer than
+        ``self.workers`` are running, or waiting for one otherwise.
+
+        :raises SandboxieError: if the runner is closed, including while
+                                waiting.
+        """
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    if self._closed:
+                        raise SandboxieError('The command runner is closed')
+                    spawn = self._spawned < self.workers
+                    if spawn:
+                        self._spawned += 1
+                if spawn:
+                    try:
+                        return self._spawn()
+                    except BaseException:
+                        with self._lock:
+                            self._spawned -= 1
+                        raise
+                worker = self._idle.get()
+            if worker is not None:
+                return worker
+            # A sentinel, put by close() or when a helper died. After a
+            # close it is passed on to wake the next waiter; otherwise, a
+            # helper may be spawned in place of the dead one.
+            with self._lock:
+                closed = self._closed
+            if closed:
+                self._idle.put(None)
+                raise SandboxieError('The command runner is closed')
+
+    def _release(self, worker):
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._idle.put(worker)
+        if closed:
+            self._stop(worker)
+
+    def _stop(self, worker, kill=False):
+        if kill:
+            worker.kill()
+        else:
+            worker.stdin.close()
+        worker.wait()
+        worker.stdout.close()
+        with self._lock:
+            self._spawned -= 1
+
+    def run(self, args, timeout=None):
+        """See :func:`SubprocessRunner.run`. The timeout is enforced by the
+        helper process, which kills the command."""
+        worker = self._acquire()
+        try:
+            worker.stdin.write(
+                json.dumps([list(args), timeout]).encode('utf-8') + b'\n')
+            worker.stdin.flush()
+            reply = worker.stdout.readline()
+            if not reply:
+                raise SandboxieError(
+                    'Command runner process exited with status {0}'.format(
+                        worker.poll()))
+        except BaseException as e:
+            self._stop(worker, kill=True)
+            self._idle.put(None)
+            if isinstance(e, OSError):
+                raise SandboxieError(
+                    'Command runner process failed: {0}'.format(e))
+            raise
+        self._release(worker)
+
+        reply = json.loads(reply.decode('utf-8'))
+        if 'errno' in reply:
+            raise OSError(reply['errno'], reply['strerror'])
+        output = reply['output'].encode('latin-1')
+        if 'timeout' in reply:
+            raise subprocess.TimeoutExpired(args, reply['timeout'],
+                                            output=output)
+        if reply['returncode']:
+            raise subprocess.CalledProcessError(reply['returncode'], args,
+                                                output=output)
+        return output
+
+    def spawn(self, args, stderr=None):
+        """See :func:`SubprocessRunner.spawn`. The command is started
+        directly, rather than by a helper process, whose replies are only
+        sent once a command exits."""
+        return subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr)
+
+    def close(self):
+        """Stops the idle helper processes, and any busy ones once their
+        command completes. Calls waiting for a helper raise
+        :class:`SandboxieError`."""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                self._stop(worker)
+        self._idle.put(None)
+
+
+class FakeRunner(object):
+    """An in-process stand-in for Start.exe, for driving :class:`Sandboxie`
+    in tests without Sandboxie installed.
+
+    Commands are not run; each one started in a sandbox is given a fake
+    process id and is considered running until it is terminated (or, if it
+    was started with ``wait=True``, it exits immediately). Config reloads
+    are counted in ``self.reloads``, sandboxes whose contents were deleted
+    are listed in ``self.deleted``, and every command line run is recorded
+    in ``self.calls``.
+
+    To emulate a slow or hung Start.exe, set ``self.delay`` to the number of
+    seconds each command line takes to run. Those that time out are killed
+    without taking effect, and are recorded in ``self.killed`` instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_pid = 1000
+        self.processes = collections.defaultdict(dict)
+        self.reloads = 0
+        self.deleted = []
+        self.calls = []
+        self.killed = []
+        self.delay = 0
+
+    def run(self, args, timeout=None):
+        """See :func:`SubprocessRunner.run`."""
+        delay = self.delay
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            with self._lock:
+                self.killed.append(list(args))
+            raise subprocess.TimeoutExpired(args, timeout, output=b'')
+        if delay:
+            time.sleep(delay)
+        return self._run(args)[0]
+
+    def spawn(self, args, stderr=None):
+        """See :func:`SubprocessRunner.spawn`. The whole output of the
+        command is readable at once, and the process is running until it is
+        terminated, as with :func:`run`."""
+        output, box, pid = self._run(args)
+        return _FakeProcess(self, box, pid, output, stderr)
+
+    def _run(self, args):
+        """Returns the output of the command line *args*, and the sandbox
+        and fake process id of the process it started, if any."""
+        options = [arg for arg in args[1:] if arg.startswith('/')]
+        command = args[-1] if len(args) > 1 else ''
+        box = None
+        pid = None
+        for option in options:
+            if option.startswith('/box:'):
+                box = option[len('/box:'):]
+        with self._lock:
+            self.calls.append(list(args))
+            if '/listpids' in options:
+                output = ''.join('{0}\r\n'.format(pid) for pid in
+                                 sorted(self.processes[box]))
+                return output.encode('ascii'), box, None
+            if '/reload' in options:
+                self.reloads += 1
+            elif '/terminate_all' in options:
+                self.processes.clear()
+            elif '/terminate' in options:
+                self.processes.pop(box, None)
+            elif command.startswith('delete_sandbox'):
+                self.deleted.append(box)
+            elif command and '/wait' not in options:
+                self._next_pid += 4
+                pid = self._next_pid
+                self.processes[box][pid] = command
+        return b'', box, pid
+
+    def close(self):
+        """See :func:`SubprocessRunner.close`."""
+
+
+class _FakeProcess(object):
+    """A :class:`subprocess.Popen` stand-in for the processes started by
+    :func:`FakeRunner.spawn`, which exit once terminated."""
+
+    def __init__(self, runner, box, pid, output, stderr=None):
+        self._runner = runner
+        self._box = box
+        self.pid = pid
+        self.returncode = None
+        self.stdout = io.BytesIO(output)
+        self.stderr = io.BytesIO() if stderr == subprocess.PIPE else None
+
+    def poll(self):
+        if self.returncode is None:
+            with self._runner._lock:
+                if self.pid not in self._runner.processes.get(self._box, ()):
+                    self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(self.pid, timeout)
+            time.sleep(0.01)
+        return self.returncode
+
+    def terminate(self):
+        with self._runner._lock:
+            self._runner.processes.get(self._box, {}).pop(self.pid, None)
+        if self.returncode is None:
+            self.returncode = 1
+
+    kill = terminate
+
+
+ProcessTable = collections.namedtuple('ProcessTable',
+                                      ['pids', 'latency', 'errors'])
+ProcessTable.__doc__ = """The processes running in a set of sandboxes, as
+returned by :func:`Sandboxie.process_table`: *pids* maps each sandbox to a
+``frozenset`` of process ids, *latency* maps each sandbox to the number of
+seconds its query took, and *errors* maps each sandbox that could not be
+queried to the exception raised."""
+
+
+class SandboxTransaction(object):
+    """A batch of sandbox changes to be applied to the Sandboxie.ini config
+    with a single write and a single reload. Obtained from
+    :func:`Sandboxie.batch`.
+
+    :ivar diff: The :class:`ConfigDiff` of the changes made to the config
+        once the transaction is committed, or ``None`` until then.
+    """
+
+    def __init__(self):
+        self._operations = []
+        self.diff = None
+
+    def __len__(self):
+        return len(self._operations)
+
+    def create(self, box, options):
+        """Creates (or replaces) the sandbox named *box*, with a ``dict`` of
+        sandbox *options*, or a :class:`SandboxieSection`, whose settings
+        are shared rather than copied."""
+        if isinstance(options, SandboxieSection):
+            options = SandboxieSection(box, options.entries)
+        else:
+            options = dict(options)
+        self._operations.append(('create', box, options))
+
+    def destroy(self, box):
+        """Destroys the sandbox named *box*."""
+        self._operations.append(('destroy', box, None))
+
+    def update(self, box, options):
+        """Sets the sandbox *options* of *box*, leaving its other options
+        untouched, and removes those whose value is ``None``. The sandbox is
+        created if it does not exist."""
+        self._operations.append(('update', box, dict(options)))
+
+    def apply(self, config):
+        """Applies the recorded changes, in order, to *config*."""
+        for operation, box, options in self._operations:
+            if operation == 'create':
+                config[box] = options
+            elif operation == 'destroy':
+                config.remove_section(box)
+            else:
+                if not config.has_section(box):
+                    config.add_section(box)
+                _apply_options(config[box], options)
+
+
+class SandboxedProcess(object):
+    """A handle to a command started in a sandbox by :func:`Sandboxie.spawn`
+    (or ``Sandboxie.start(..., stream=True)``), whose output is read as it
+    is produced, with bounded memory, rather than all at once on exit::
+
+        with sbie.spawn('build.exe', box='foo', wait=True) as process:
+            for line in process:
+                print(line)
+        print(process.returncode)
+
+    As with :class:`subprocess.Popen`, a process whose output is not read
+    blocks once the pipe buffers are full, so read both streams (e.g. from
+    separate threads) if stderr was piped separately, or pass
+    ``stderr=subprocess.STDOUT`` to merge it into stdout.
+
+    When used as a context manager, the process is killed on exit from the
+    block if it is still running, and its pipes are closed.
+    """
+
+    def __init__(self, sandboxie, box, args, process):
+        self.sandboxie = sandboxie
+        self.box = box
+        self.args = args
+        self.process = process
+        self._exited = False
+
+    @property
+    def pid(self):
+        """The process id of Start.exe."""
+        return self.process.pid
+
+    @property
+    def returncode(self):
+        """The exit status of Start.exe, or ``None`` if it is running."""
+        return self.process.returncode
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc_info):
+        if self.poll() is None:
+            self.kill()
+            self.wait()
+        for stream in (self.process.stdout, self.process.stderr):
+            if stream is not None:
+                stream.close()
 
-class SandboxieError(Exception):
-    pass
+    def __iter__(self):
+        return self.iter_lines()
+
+    def _stream(self, stream):
+        if stream not in ('stdout', 'stderr'):
+            raise ValueError('stream must be stdout or stderr')
+        pipe = getattr(self.process, stream)
+        if pipe is None:
+            raise ValueError('{0} is not piped'.format(stream))
+        return pipe
+
+    def iter_chunks(self, stream='stdout', chunk_size=65536):
+        """Yields the output of the process on *stream* (``'stdout'`` or
+        ``'stderr'``) as ``bytes`` chunks of at most *chunk_size* bytes, as
+        they become available, until the stream is closed."""
+        pipe = self._stream(stream)
+        while True:
+            chunk = pipe.read1(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def iter_lines(self, stream='stdout', max_line_length=65536):
+        """Yields the lines of output of the process on *stream*
+        (``'stdout'`` or ``'stderr'``) as ``bytes``, with their line ending,
+        until the stream is closed. Lines longer than *max_line_length* bytes
+        are split, so as to bound memory use."""
+        pipe = self._stream(stream)
+        while True:
+            line = pipe.readline(max_line_length)
+            if not line:
+                return
+            yield line
+
+    def _check_exited(self, returncode):
+        if returncode is not None and not self._exited:
+            self._exited = True
+            self.sandboxie.invalidate_process_cache(self.box)
+        return returncode
+
+    def poll(self):
+        """Returns the exit status of the process, or ``None`` if it is
+        still running."""
+        return self._check_exited(self.process.poll())
+
+    def wait(self, timeout=None):
+        """Waits for the process to exit, and returns its exit status.
+        Raises :class:`subprocess.TimeoutExpired` if it is still running
+        after *timeout* seconds."""
+        return self._check_exited(self.process.wait(timeout))
+
+    def terminate(self, box_processes=False):
+        """Terminates Start.exe. Since the sandboxed program is not a child
+        of Start.exe, it keeps running, unless *box_processes* is ``True``,
+        in which case all processes running in the sandbox are terminated
+        too (see :func:`Sandboxie.terminate_processes`)."""
+        if self.process.poll() is None:
+            self.process.terminate()
+        if box_processes:
+            self.sandboxie.terminate_processes(box=self.box)
+
+    def kill(self):
+        """Kills Start.exe."""
+        if self.process.poll() is None:
+            self.process.kill()
 
 
 class Sandboxie(object):
     """An interface to `Sandboxie <http://sandboxie.com>`_."""
 
-    def __init__(self, defaultbox='DefaultBox', install_dir=None):
+    def __init__(self, defaultbox='DefaultBox', install_dir=None,
+                 cache_config=True, shared_config_cache=False,
+                 lock_timeout=10.0, optimistic_writes=False,
+                 write_retries=10, reload_delay=None, reload_max_delay=None,
+                 process_cache_ttl=0, metrics=None, runner=None,
+                 cleanup_workers=2, fast_reset=False, snapshot_dir=None,
+                 index_dir=None, timeout=None, append_in_place=False):
         """
         :param defaultbox: The default sandbox in which sandboxed commands are
                            executed.
@@ -51,6 +2400,78 @@ class Sandboxie(object):
                             value of the ``SANDBOXIE_INSTALL_DIR`` environment
                             variable, or ``C:\Program Files\Sandboxie``,
                             if the environment variable is not set.
+        :param cache_config: If ``True``, the parsed Sandboxie.ini config is
+                             cached and only re-parsed when the file changes.
+        :param shared_config_cache: If ``True``, the config cache is shared
+                                    by all instances in the process that use
+                                    the same config file.
+        :param lock_timeout: The number of seconds to wait for the
+                             Sandboxie.ini lock file before raising
+                             :class:`ConfigLockTimeout`, or ``None`` to wait
+                             indefinitely.
+        :param optimistic_writes: If ``True``, config changes are computed
+                                  without holding the lock, and only written
+                                  if the config was not changed by another
+                                  writer in the meantime; otherwise they are
+                                  retried. If ``False``, the lock is held for
+                                  the whole read-modify-write.
+        :param write_retries: The number of times a conflicting optimistic
+                              write is retried before raising
+                              :class:`ConfigConflictError`.
+        :param append_in_place: If ``True``, config changes that only add
+                                sections are appended to Sandboxie.ini in
+                                place, so that they cost the size of the new
+                                sections rather than of the whole file. Such
+                                writes are **not atomic**: Sandboxie, or a
+                                reader that does not take the config lock,
+                                may see a partially written section, and a
+                                crash during the write leaves it truncated.
+                                If ``False``, every change is written to a
+                                temporary file that atomically replaces
+                                Sandboxie.ini.
+        :param reload_delay: If not ``None``, config reloads requested by
+                             config changes are coalesced, and performed in
+                             the background once no change has been made for
+                             *reload_delay* seconds. See
+                             :func:`request_reload`.
+        :param reload_max_delay: If not ``None``, coalesced reloads are
+                                 performed at most *reload_max_delay* seconds
+                                 after the first pending change, even if
+                                 changes keep being made.
+        :param process_cache_ttl: The number of seconds for which the result
+                                  of :func:`running_processes` is cached.
+                                  The cache is invalidated by starting or
+                                  terminating processes.
+        :param metrics: The :class:`Metrics` instance in which the latency
+                        and errors of operations are recorded. If ``None``,
+                        a new one is created. Available as
+                        ``self.metrics``.
+        :param runner: The object that runs Start.exe command lines, such as
+                       a :class:`SubprocessRunner` (the default if
+                       ``None``), a :class:`WorkerPoolRunner` or a
+                       :class:`FakeRunner`. Available as ``self.runner``.
+        :param cleanup_workers: The number of sandboxes cleaned up at once
+                                by :func:`cleanup_async`.
+        :param fast_reset: If ``True``, :func:`delete_contents` (and so
+                           :func:`cleanup_async` and :class:`SandboxPool`)
+                           empties sandboxes with :func:`reset_box`, rather
+                           than with Start.exe.
+        :param snapshot_dir: The folder in which :func:`snapshot_box` stores
+                             snapshots. If ``None``, they are stored in a
+                             ``.snapshots`` folder next to the content
+                             folder of the sandbox snapshotted or restored,
+                             which keeps them on the same drive, as hard
+                             links and reflinks require.
+        :param index_dir: The folder in which the content indexes of
+                          :func:`box_usage` and :func:`changed_files` are
+                          persisted. If ``None``, they are persisted in a
+                          ``.index`` folder next to the content folders of
+                          the sandboxes.
+        :param timeout: The number of seconds any Start.exe command line may
+                        run for, including those run in the background,
+                        before it is killed and :class:`CommandTimeout` is
+                        raised, or ``None`` for no limit. See also
+                        :func:`deadline`.
 
         Raises :class:`SandboxieError` if the Sandboxie.ini config file could
         not be located in the following directories:
@@ -60,6 +2481,15 @@ class Sandboxie(object):
             #. In the Sandboxie installation folder, typically
                ``C:\Program Files\Sandboxie``.
         """
+        self.metrics = Metrics() if metrics is None else metrics
+        self.runner = SubprocessRunner() if runner is None else runner
+        self.fast_reset = fast_reset
+        self.snapshot_dir = snapshot_dir
+        self.index_dir = index_dir
+        self.timeout = timeout
+        self._deadlines = threading.local()
+        self._content_indexes = {}
+        self._content_indexes_lock = threading.Lock()
         self.install_dir = install_dir
         if install_dir is None:
             self.install_dir = os.environ.get('SANDBOXIE_INSTALL_DIR',
@@ -69,6 +2499,29 @@ class Sandboxie(object):
         if self.config_path is None:
             raise SandboxieError(('Could not find Sandboxie.ini config. Is '
                                   'Sandboxie installed?'))
+        self.lock_timeout = lock_timeout
+        self.optimistic_writes = optimistic_writes
+        self.write_retries = write_retries
+        self.append_in_place = append_in_place
+        self._process_cache = _ProcessCache(process_cache_ttl)
+        # Counts of the config changes committed, and of those that were
+        # committed when the last successful reload started.
+        self._changes = 0
+        self._changes_reloaded = 0
+        self._reload_lock = threading.Lock()
+        self._reload_coalescer = None
+        if reload_delay is not None:
+            self._reload_coalescer = _ReloadCoalescer(
+                lambda: self.reload_config(), reload_delay, reload_max_delay)
+        self._section_index = None
+        self._templates = {}
+        self._resolved_templates = {}
+        self._templates_lock = threading.Lock()
+        self._cleanup_queue = _CleanupQueue(self._cleanup, cleanup_workers)
+        self._config_cache = None
+        if cache_config:
+            self._config_cache = (_shared_config_cache if shared_config_cache
+                                  else _ConfigCache())
 
     def _find_config_path(self):
         """Returns the absolute path to the Sandboxie.ini config, or ``None``
@@ -80,64 +2533,585 @@ class Sandboxie(object):
                 return path
         return None
 
+    @_instrumented
     def _open_config_file(self, mode='r', encoding='utf-16-le'):
         return io.open(self.config_path, mode, encoding=encoding)
 
-    def _shell_output(self, *args, **kwargs):
-        return subprocess.check_output(*args, **kwargs)
+    @_instrumented
+    def _shell_output(self, args):
+        timeout = self._time_left(self.timeout)
+        if timeout is not None and timeout <= 0:
+            raise CommandTimeout(args, 0)
+        try:
+            return self.runner.run(args, timeout)
+        except subprocess.TimeoutExpired:
+            raise CommandTimeout(args, timeout)
+
+    def _lock_config(self):
+        """Returns a context manager holding the cross-process lock that
+        serializes writes to the Sandboxie.ini config. Waiting for the lock
+        is bounded by the current :func:`deadline`."""
+        timeout = self._time_left(self.lock_timeout)
+        if timeout is not None:
+            timeout = max(timeout, 0)
+        return _FileLock(self.config_path + '.lock', timeout)
+
+    def _current_deadline(self):
+        """Returns the :func:`time.monotonic` time of the innermost
+        :func:`deadline` of the calling thread, or ``None``."""
+        deadlines = getattr(self._deadlines, 'stack', None)
+        return deadlines[-1] if deadlines else None
+
+    def _time_left(self, timeout):
+        """Returns the lesser of *timeout* and the number of seconds left
+        until the current deadline (which may be negative), either of which
+        may be ``None`` for no limit."""
+        deadline = self._current_deadline()
+        if deadline is None:
+            return timeout
+        left = deadline - time.monotonic()
+        return left if timeout is None else min(timeout, left)
+
+    @contextlib.contextmanager
+    def _deadline_at(self, when):
+        deadlines = self._deadlines.__dict__.setdefault('stack', [])
+        current = self._current_deadline()
+        deadlines.append(when if current is None else min(when, current))
+        try:
+            yield deadlines[-1]
+        finally:
+            deadlines.pop()
+
+    def deadline(self, seconds):
+        """A context manager that bounds the time taken by all calls made
+        in the block, by the calling thread, to *seconds* from now::
+
+            with sbie.deadline(5):
+                sbie.create_sandbox('foo', {'Enabled': 'yes'})
+                sbie.start('setup.exe', box='foo', wait=True)
+
+        Each Start.exe command line run in the block, including those run
+        internally (such as the config reload of :func:`create_sandbox`), is
+        killed, raising :class:`CommandTimeout`, if it is still running at
+        the deadline, and is not run at all once the deadline has passed.
+        Waiting for the config lock is bounded too. The deadline also
+        applies to the commands that :func:`start_many` and
+        :func:`process_table` run in their worker threads, but not to work
+        done in the background, such as coalesced reloads, which is only
+        bounded by the *timeout* parameter of :class:`Sandboxie`.
+
+        Deadlines may be nested; an inner deadline cannot extend an outer
+        one. Yields the deadline, as a :func:`time.monotonic` time.
+        """
+        return self._deadline_at(time.monotonic() + seconds)
+
+    def _bind_deadline(self, func):
+        """Returns a function that calls *func* under the current deadline
+        of the calling thread, so that it applies when *func* is called from
+        another thread."""
+        deadline = self._current_deadline()
+        if deadline is None:
+            return func
 
-    def _write_config(self, config):
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            with self._deadline_at(deadline):
+                return func(*args, **kwargs)
+        return call
+
+    @_instrumented
+    def _write_config(self, config, base=None, diff=None):
         """Writes *config* to ``self.config_path``.
 
-        :param config: a :class:`configparser.ConfigParser` instance of a
+        If *base*, the :class:`_ConfigVersion` that *config* was derived
+        from, is given and is still the current version of the file, only
+        the sections that differ between the two are written: added sections
+        are appended to the file in place, and changed or removed sections
+        are spliced into or out of the file's otherwise untouched content.
+        Otherwise the whole of *config* is serialized.
+
+        Unless the changes are pure additions and ``self.append_in_place`` is
+        set, the config is written to a temporary file which then atomically
+        replaces Sandboxie.ini, so that readers never observe a partially
+        written file. Callers should hold :func:`_lock_config`.
+
+        :param config: a :class:`SandboxieConfig` instance of a Sandboxie.ini
+            config.
+        :param base: the :class:`_ConfigVersion` *config* was derived from.
+        :param diff: the :class:`ConfigDiff` of *config* compared to the
+            config of *base*, if already known.
+        """
+        if (base is None or base.layout is None
+                or _stat_signature(self.config_path) != base.signature):
+            newline = os.linesep if base is None else base.newline
+            bom = base is not None and base.bom
+            data = _encode_config_text(config.to_string(), newline)
+            if bom:
+                data = _UTF16_BOM + data
+            signature = self._replace_config_data([data])
+            version = _ConfigVersion(config, _scan_sections(data), newline,
+                                     bom, signature)
+        else:
+            version = self._write_config_changes(config, base, diff)
+        if self._config_cache is not None and version is not base:
+            version.config = config.copy()
+            self._config_cache.put(self.config_path, version.signature,
+                                   version)
+
+    def _write_config_changes(self, config, base, diff=None):
+        """Writes the sections of *config* that differ from those of *base*,
+        as listed by the :class:`ConfigDiff` *diff*, if given. Returns the
+        new :class:`_ConfigVersion` of the file, without its config.
+        """
+        if diff is None:
+            added, removed, changed = _diff_sections(base.config, config)
+        else:
+            added, removed, changed = diff.added, diff.removed, diff.changed
+        if not (added or removed or changed):
+            return base
+        removed, changed = set(removed), set(changed)
+        newline = base.newline
+        added_chunks = _encode_sections(config, added, newline)
+
+        if self.append_in_place and not (removed or changed):
+            # Not atomic, which the caller has opted in to. Only the last
+            # character of the file is read, to check that it ends a line.
+            with self._open_config_file(mode='r+b', encoding=None) as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(size - len(_LF), 0))
+                tail = f.read()
+                self.metrics.add_bytes(read=len(tail))
+                chunks = []
+                layout = list(base.layout)
+                if not _ends_with_newline(tail):
+                    # Make sure appended sections start on a line of their
+                    # own.
+                    chunks.append(newline.encode('utf-16-le'))
+                    if layout:
+                        name, start, end = layout[-1]
+                        layout[-1] = (name, start, end + len(chunks[0]))
+                offset = size + sum(len(chunk) for chunk in chunks)
+                for section, chunk in zip(added, added_chunks):
+                    layout.append((section, offset, offset + len(chunk)))
+                    chunks.append(chunk)
+                    offset += len(chunk)
+                appended = b''.join(chunks)
+                f.seek(0, os.SEEK_END)
+                f.write(appended)
+                self.metrics.add_bytes(written=len(appended))
+                f.flush()
+                os.fsync(f.fileno())
+                st = os.fstat(f.fileno())
+            signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+            return _ConfigVersion(None, layout, newline, base.bom, signature)
+
+        with self._open_config_file(mode='rb', encoding=None) as config_file:
+            data = config_file.read()
+        self.metrics.add_bytes(read=len(data))
+
+        # Splice the changes into the untouched content, which is kept as
+        # memoryview slices of the original data, so that it is neither
+        # copied nor re-encoded until the file is written.
+        view = memoryview(data)
+        preamble_end = base.layout[0][1] if base.layout else len(data)
+        chunks = [view[:preamble_end]]
+        sections = []
+        written = set()
+        for name, start, end in base.layout:
+            if name in removed:
+                continue
+            if name in changed:
+                # The settings of a repeated section are merged into its
+                # first occurrence.
+                if name in written:
+                    continue
+                written.add(name)
+                sections.append((name, _encode_config_text(
+                    _format_section(config, name), newline)))
+            else:
+                sections.append((name, view[start:end]))
+        last_chunk = sections[-1][1] if sections else chunks[0]
+        if added and not _ends_with_newline(last_chunk):
+            newline_chunk = newline.encode('utf-16-le')
+            if sections:
+                name, chunk = sections[-1]
+                sections[-1] = (name, bytes(chunk) + newline_chunk)
+            else:
+                chunks.append(newline_chunk)
+        sections.extend(zip(added, added_chunks))
+        layout = []
+        offset = sum(len(chunk) for chunk in chunks)
+        for name, chunk in sections:
+            chunks.append(chunk)
+            layout.append((name, offset, offset + len(chunk)))
+            offset += len(chunk)
+        signature = self._replace_config_data(chunks)
+        return _ConfigVersion(None, layout, newline, base.bom, signature)
+
+    def _replace_config_data(self, chunks):
+        """Atomically replaces the contents of ``self.config_path`` with the
+        concatenated byte strings *chunks*. Returns the stat signature of the
+        new file.
+        """
+        config_dir, config_name = os.path.split(self.config_path)
+        fd, temp_path = tempfile.mkstemp(prefix=config_name + '.',
+                                         suffix='.tmp', dir=config_dir)
+        try:
+            with io.open(fd, 'wb') as config_file:
+                for chunk in chunks:
+                    config_file.write(chunk)
+                    self.metrics.add_bytes(written=len(chunk))
+                config_file.flush()
+                os.fsync(config_file.fileno())
+                st = os.fstat(config_file.fileno())
+            if os.path.exists(self.config_path):
+                shutil.copymode(self.config_path, temp_path)
+            _replace_file(temp_path, self.config_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        # Renaming preserves the inode and mtime, so the signature of the
+        # temporary file is that of the new Sandboxie.ini.
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _update_config(self, update):
+        """Calls *update* with the parsed Sandboxie.ini config to modify it,
+        then writes the config, unless *update* did not change it. Returns
+        the :class:`ConfigDiff` of the changes made by *update*.
+
+        If ``self.optimistic_writes`` is ``True``, *update* is called without
+        holding the config lock, and the lock is only taken to check that
+        the config file is unchanged before writing it. If it has changed,
+        *update* is called again on the new config, up to
+        ``self.write_retries`` times, so *update* must be safe to repeat.
+        """
+        if not self.optimistic_writes:
+            with self._lock_config():
+                base = self._load_config()
+                config = base.config.copy()
+                update(config)
+                diff = _diff_config(base.config, config)
+                if diff:
+                    self._write_config(config, base, diff)
+                return diff
+        for attempt in range(self.write_retries + 1):
+            if attempt:
+                # Back off randomly so conflicting writers spread out.
+                time.sleep(random.uniform(0, 0.001 * 2 ** min(attempt, 8)))
+            base = self._load_config()
+            config = base.config.copy()
+            update(config)
+            diff = _diff_config(base.config, config)
+            if not diff:
+                # Nothing to write: the update was a no-op on the version of
+                # the config it was applied to.
+                return diff
+            with self._lock_config():
+                if _stat_signature(self.config_path) == base.signature:
+                    self._write_config(config, base, diff)
+                    return diff
+        raise ConfigConflictError(
+            'Gave up updating {0} after {1} conflicting writes'.format(
+                self.config_path, self.write_retries + 1))
+
+    @_instrumented
+    def _parse_config(self):
+        """Reads and parses the Sandboxie.ini config. Returns a
+        :class:`_ConfigVersion`."""
+        signature = _stat_signature(self.config_path)
+        with self._open_config_file(mode='rb', encoding=None) as config_file:
+            data = config_file.read()
+        self.metrics.add_bytes(read=len(data))
+        config = SandboxieConfig.from_string(data.decode('utf-16-le'))
+        layout = _scan_sections(data)
+        if set(name for name, _, _ in layout) != set(config.sections()):
+            # Should not happen, as the parser and the scanner recognize the
+            # same section headers, but the incremental writer relies on it.
+            layout = None
+        return _ConfigVersion(config, layout, _detect_newline(data),
+                              data[:2] == _UTF16_BOM, signature)
+
+    def _load_config(self):
+        """Returns the current :class:`_ConfigVersion` of the Sandboxie.ini
+        config, from the cache if possible. Its config must not be
+        modified."""
+        if self._config_cache is None:
+            return self._parse_config()
+        return self._config_cache.get(self.config_path, self._parse_config)
+
+    @_instrumented
+    def get_config(self):
+        """Returns a :class:`SandboxieConfig` instance of the parsed
             Sandboxie.ini config.
+
+        If config caching is enabled, the file is only re-parsed when it has
+        changed since the last call, and a copy of the cached config is
+        returned, so that it may be freely modified by the caller.
         """
-        with self._open_config_file(mode='w') as config_file:
-            config.write(config_file)
+        return self._load_config().config.copy()
+
+    def config_cache_info(self):
+        """Returns a :class:`ConfigCacheInfo` named tuple of the config
+        cache's ``hits``, ``misses`` and current size (``currsize``), or
+        ``None`` if config caching is disabled."""
+        if self._config_cache is None:
+            return None
+        return self._config_cache.info()
+
+    def clear_config_cache(self):
+        """Discards the cached Sandboxie.ini config, forcing it to be
+        re-parsed on the next access."""
+        if self._config_cache is not None:
+            self._config_cache.invalidate(self.config_path)
 
     @contextlib.contextmanager
-    def _modify_config(self):
-        """A context manager that yields a :class:`configparser.ConfigParser`
-        instance of the parsed Sandboxie.ini config (to allow for
-        modifications), then writes the config to ``self.config_path`` upon
-        completion of the block.
+    def _indexed_config_file(self):
+        """A context manager that yields the open binary Sandboxie.ini
+        config file and its :class:`_SectionIndex`. The index is only rebuilt
+        when the file has changed since it was last built."""
+        with self._open_config_file(mode='rb', encoding=None) as config_file:
+            st = os.fstat(config_file.fileno())
+            index = self._section_index
+            if (index is None or index.signature
+                    != (st.st_mtime_ns, st.st_size, st.st_ino)):
+                index = self._section_index = _SectionIndex.build(config_file)
+            yield config_file, index
+
+    @_instrumented
+    def list_boxes(self):
+        """Returns a list of the names of all sandboxes defined in the
+        Sandboxie.ini config.
+
+        This and the other per-sandbox lookups, :func:`box_exists` and
+        :func:`get_box_options`, use an index of the config file's sections,
+        so that they do not need to parse the whole file.
         """
-        config = self.get_config()
-        yield config
-        self._write_config(config)
+        with self._indexed_config_file() as (_, index):
+            return [name for name in index.spans if _is_box_section(name)]
 
-    def get_config(self):
-        """Returns a :class:`configparser.ConfigParser` instance of the parsed
-            Sandboxie.ini config."""
-        config = configparser.ConfigParser(strict=False)
-        with self._open_config_file(mode='r') as config_file:
-            config.read_file(config_file)
-        return config
+    @_instrumented
+    def box_exists(self, box):
+        """Returns whether sandbox *box* is defined in the Sandboxie.ini
+        config."""
+        with self._indexed_config_file() as (_, index):
+            return box in index.spans and _is_box_section(box)
+
+    @_instrumented
+    def get_box_options(self, box=None):
+        """Returns a :class:`SandboxieSection` of the options of sandbox
+        *box*, parsed from its section of the Sandboxie.ini config only. If
+        *box* is ``None``, ``self.defaultbox`` is used.
 
+        Raises :class:`configparser.NoSectionError` if the sandbox does not
+        exist.
+        """
+        if box is None:
+            box = self.defaultbox
+        section = None
+        if _is_box_section(box):
+            with self._indexed_config_file() as (config_file, index):
+                section = index.read_section(config_file, box)
+                self.metrics.add_bytes(read=sum(
+                    end - start for start, end in index.spans.get(box, ())))
+        if section is None:
+            raise configparser.NoSectionError(box)
+        return section
+
+    @contextlib.contextmanager
+    def batch(self):
+        """A context manager that yields a :class:`SandboxTransaction`, whose
+        recorded changes are applied upon completion of the block with a
+        single write of the Sandboxie.ini config and a single reload::
+
+            with sbie.batch() as tx:
+                tx.create('foo', {'Enabled': 'yes'})
+                tx.destroy('bar')
+
+        If the block raises, no changes are applied. Once the block has
+        completed, the changes made to the config are available as
+        ``tx.diff`` (see :func:`commit`).
+        """
+        transaction = SandboxTransaction()
+        yield transaction
+        self.commit(transaction)
+
+    def _committed(self, transaction, diff):
+        """Records and logs the :class:`ConfigDiff` *diff* of the committed
+        *transaction*. Returns whether the config needs reloading: if it
+        changed, or if an earlier change was not reloaded successfully."""
+        transaction.diff = diff
+        with self._reload_lock:
+            if diff:
+                self._changes += 1
+            pending = self._changes > self._changes_reloaded
+        if diff:
+            _log.info('Changed %s: %s', self.config_path, diff)
+        elif pending:
+            _log.info('%s is unchanged, but an earlier change was not '
+                      'reloaded; reloading it', self.config_path)
+        else:
+            _log.debug('%s is unchanged; skipped writing and reloading it',
+                       self.config_path)
+        return pending
+
+    def _reloaded(self, changes):
+        """Records that a reload, started when *changes* config changes had
+        been committed, succeeded."""
+        with self._reload_lock:
+            self._changes_reloaded = max(self._changes_reloaded, changes)
+
+    @_instrumented
+    def commit(self, transaction):
+        """Applies the changes recorded in the :class:`SandboxTransaction`
+        *transaction* with a single write of the Sandboxie.ini config, then
+        requests a config reload.
+
+        Returns the :class:`ConfigDiff` of the changes that were made. If
+        there are none, for instance because the sandboxes created already
+        exist with the same options, or those destroyed do not exist, the
+        config is not written, and is only reloaded if the reload of an
+        earlier change failed or timed out.
+        """
+        diff = ConfigDiff([], [], collections.OrderedDict())
+        if transaction:
+            diff = self._update_config(transaction.apply)
+        if self._committed(transaction, diff):
+            self.request_reload()
+        return diff
+
+    @_instrumented
     def create_sandbox(self, box, options):
         """Creates a sandbox named *box*, with a ``dict`` of sandbox
-        *options*."""
-        with self._modify_config() as config:
-            config[box] = options
-        self.reload_config()
+        *options*. Returns the :class:`ConfigDiff` of the changes made (see
+        :func:`commit`)."""
+        with self.batch() as transaction:
+            transaction.create(box, options)
+        return transaction.diff
+
+    @_instrumented
+    def create_sandboxes(self, boxes):
+        """Creates a sandbox for each item of the ``dict`` *boxes*, which
+        maps sandbox names to ``dict`` objects of sandbox options. Returns
+        the :class:`ConfigDiff` of the changes made."""
+        with self.batch() as transaction:
+            for box, options in boxes.items():
+                transaction.create(box, options)
+        return transaction.diff
 
+    @_instrumented
     def destroy_sandbox(self, box):
         """Destroys the sandbox named *box*. Counterpart to
-        :func:`create_sandbox`."""
-        with self._modify_config() as config:
-            config.remove_section(box)
-        self.reload_config()
+        :func:`create_sandbox`. Returns the :class:`ConfigDiff` of the
+        changes made."""
+        with self.batch() as transaction:
+            transaction.destroy(box)
+        return transaction.diff
 
+    @_instrumented
+    def destroy_sandboxes(self, boxes):
+        """Destroys each sandbox named in the iterable *boxes*. Counterpart
+        to :func:`create_sandboxes`. Returns the :class:`ConfigDiff` of the
+        changes made."""
+        with self.batch() as transaction:
+            for box in boxes:
+                transaction.destroy(box)
+        return transaction.diff
+
+    def define_template(self, name, options, base=None):
+        """Defines the sandbox template *name*, for creating sandboxes with
+        :func:`create_from_template`, with the options of the template
+        *base*, if not ``None``, updated with the mapping *options*.
+
+        As with :class:`SandboxieSection`, an option whose value is a
+        ``list`` or ``tuple`` is repeated; an option whose value is ``None``
+        is removed from those inherited from *base*. Raises
+        :class:`ValueError` if an option is invalid. Redefining a template
+        also affects the templates that inherit from it.
+        """
+        _apply_options(SandboxieSection(name), options)
+        with self._templates_lock:
+            self._templates[name] = (base, dict(options))
+            self._resolved_templates.clear()
+
+    def _resolve_template(self, name, seen=()):
+        """Returns the cached :class:`SandboxieSection` of the options of
+        template *name*. Must be called with ``self._templates_lock``
+        held."""
+        section = self._resolved_templates.get(name)
+        if section is not None:
+            return section
+        if name in seen:
+            raise ValueError('Template {0!r} inherits from itself'.format(
+                name))
+        if name not in self._templates:
+            raise ValueError('Unknown template: {0!r}'.format(name))
+        base, options = self._templates[name]
+        section = SandboxieSection(name)
+        if base is not None:
+            section = SandboxieSection(name, self._resolve_template(
+                base, seen + (name,)).entries)
+        _apply_options(section, options)
+        self._resolved_templates[name] = section
+        return section
+
+    def resolve_template(self, name):
+        """Returns a :class:`SandboxieSection` of the options of template
+        *name*, merged with those of the templates it inherits from. Raises
+        :class:`ValueError` if the template, or one it inherits from, is
+        not defined, or if templates inherit from each other in a cycle.
+
+        Templates are only resolved once, until they are redefined, and the
+        settings of the returned sections are shared with sandboxes created
+        from the template.
+        """
+        with self._templates_lock:
+            section = self._resolve_template(name)
+        return SandboxieSection(name, section.entries)
+
+    @_instrumented
+    def create_from_template(self, template, names, overrides=None):
+        """Creates a sandbox for each name in the iterable *names*, with the
+        options of *template* (see :func:`define_template`), with a single
+        write of the Sandboxie.ini config and a single reload. Returns the
+        :class:`ConfigDiff` of the changes made.
+
+        Sandboxes without overrides share the settings of the resolved
+        template, and these are only formatted for writing once.
+
+        :param overrides: The options specific to some sandboxes, applied as
+            by :func:`define_template`: either a ``dict`` mapping sandbox
+            names to mappings of options, or a function that takes a
+            sandbox name and returns a mapping of options, or ``None``.
+        """
+        base = self.resolve_template(template)
+        if overrides is None:
+            overrides = {}
+        get_overrides = (overrides if callable(overrides)
+                         else lambda name: overrides.get(name))
+        with self.batch() as transaction:
+            for name in names:
+                options = base
+                box_overrides = get_overrides(name)
+                if box_overrides:
+                    options = SandboxieSection(name, base.entries)
+                    _apply_options(options, box_overrides)
+                transaction.create(name, options)
+        return transaction.diff
+
+    @_instrumented
     def start(self, command=None, box=None, silent=True, wait=False,
               nosbiectrl=True, elevate=False, disable_forced=False,
               reload=False, terminate=False, terminate_all=False,
-              listpids=False):
+              listpids=False, stream=False, timeout=None):
         """Executes *command* under the supervision of Sandboxie by invoking
         `Sandboxie's Start Command Line`_.
 
         Returns the output of Start.exe on success. Raises
         :class:`subprocess.CalledProcessError` or :class:`WindowsError` on
-        failure.
+        failure. If *stream* is ``True``, returns a
+        :class:`SandboxedProcess` as soon as Start.exe is started instead;
+        see :func:`spawn`.
 
         :param box: The name of the sandbox sandbox to execute the command in.
             If ``None``, the command will be executed in the default sandbox,
@@ -161,10 +3135,94 @@ class Sandboxie(object):
         :param listpids: If ``True``, return string containing line-separated
             process ids of all sandboxed processes in sandbox *box* Only
             applies when *command* is ``None``.
+        :param stream: If ``True``, return a :class:`SandboxedProcess` from
+            which the output of Start.exe is read as it is produced.
+        :param timeout: If not ``None``, the number of seconds Start.exe may
+            run for before it is killed and :class:`CommandTimeout` is
+            raised, as if the call were made in a :func:`deadline` block.
+            Does not apply if *stream* is ``True``; use
+            :func:`SandboxedProcess.wait` instead.
 
         .. _Sandboxie's Start Command Line:
             http://www.sandboxie.com/index.php?StartCommandLine
         """
+        if stream:
+            return self.spawn(command, box, silent=silent, wait=wait,
+                              nosbiectrl=nosbiectrl, elevate=elevate,
+                              disable_forced=disable_forced, reload=reload,
+                              terminate=terminate,
+                              terminate_all=terminate_all, listpids=listpids)
+        args = self._start_args(command, box, silent, wait, nosbiectrl,
+                                elevate, disable_forced, reload, terminate,
+                                terminate_all, listpids)
+        try:
+            if timeout is None:
+                return self._shell_output(args)
+            with self.deadline(timeout):
+                return self._shell_output(args)
+        finally:
+            if command is None and terminate_all:
+                self._process_cache.invalidate()
+            elif command is not None or terminate:
+                self._process_cache.invalidate(
+                    self.defaultbox if box is None else box)
+
+    @_instrumented
+    def spawn(self, command=None, box=None, stderr=None, **kwargs):
+        """Starts *command* under the supervision of Sandboxie like
+        :func:`start`, which takes the same keyword arguments, but returns a
+        :class:`SandboxedProcess` as soon as Start.exe is started, from
+        which its output can be read as it is produced.
+
+        :param stderr: Where the standard error of Start.exe goes, as for
+            :class:`subprocess.Popen`: ``None`` to inherit it, as
+            :func:`start` does, ``subprocess.PIPE`` to read it from the
+            handle, or ``subprocess.STDOUT`` to merge it into stdout.
+        """
+        if box is None:
+            box = self.defaultbox
+        args = self._start_args(command, box, **kwargs)
+        process = self.runner.spawn(args, stderr)
+        self._process_cache.invalidate(box)
+        return SandboxedProcess(self, box, args, process)
+
+    @_instrumented
+    def start_many(self, jobs, max_workers=8, max_per_box=None):
+        """Executes many commands under the supervision of Sandboxie, with
+        bounded concurrency.
+
+        Returns a list of :class:`concurrent.futures.Future`, in the order of
+        *jobs*, each of which resolves to the output of :func:`start` for its
+        job, or to the exception it raised (e.g.
+        :class:`subprocess.CalledProcessError`). Use
+        :func:`concurrent.futures.as_completed` to process the results as
+        they become available.
+
+        :param jobs: An iterable of ``(command, box)`` or
+            ``(command, box, options)`` tuples, where *options* is a ``dict``
+            of keyword arguments to :func:`start`. If *box* is ``None``,
+            ``self.defaultbox`` is used.
+        :param max_workers: The maximum number of commands executed at once.
+        :param max_per_box: If not ``None``, the maximum number of commands
+            executed at once in any one sandbox.
+        """
+        runner = _JobRunner(max_workers, max_per_box)
+        futures = []
+        for job in jobs:
+            command, box = job[:2]
+            options = job[2] if len(job) > 2 else {}
+            if box is None:
+                box = self.defaultbox
+            futures.append(runner.submit(box, self._bind_deadline(
+                functools.partial(self.start, command, box=box, **options))))
+        return futures
+
+    def _start_args(self, command=None, box=None, silent=True, wait=False,
+                    nosbiectrl=True, elevate=False, disable_forced=False,
+                    reload=False, terminate=False, terminate_all=False,
+                    listpids=False):
+        """Returns the Start.exe command line for :func:`start`, as a list of
+        arguments."""
         if box is None:
             box = self.defaultbox
         options = ['/box:{0}'.format(box)]
@@ -195,30 +3253,1283 @@ class Sandboxie(object):
 
         start_exe = os.path.join(self.install_dir, 'Start.exe')
         command = command or ''
-        return self._shell_output([start_exe] + options + [command])
+        return [start_exe] + options + [command]
 
+    @_instrumented
     def reload_config(self, **kwargs):
         """Reloads the Sandboxie.ini config."""
+        changes = self._changes
         self.start(reload=True, **kwargs)
+        self._reloaded(changes)
+
+    def request_reload(self):
+        """Requests a reload of the Sandboxie.ini config after it has been
+        changed. If reloads are coalesced (see the *reload_delay* parameter of
+        :class:`Sandboxie`), the config is only marked as needing a reload,
+        which happens in the background; otherwise it is reloaded
+        immediately."""
+        if self._reload_coalescer is None:
+            self.reload_config()
+        else:
+            self._reload_coalescer.request()
+
+    def flush_reload(self):
+        """Immediately performs any pending coalesced config reload."""
+        if self._reload_coalescer is not None:
+            self._reload_coalescer.flush()
 
+    def wait_reloaded(self, timeout=None):
+        """Blocks until all config reloads requested so far have been
+        performed, or until *timeout* seconds have passed. Returns ``False``
+        if the timeout expired, ``True`` otherwise. Re-raises the error of a
+        failed reload.
+
+        Raises :class:`CommandTimeout` if the current :func:`deadline`
+        passes first.
+        """
+        if self._reload_coalescer is None:
+            return True
+        left = self._time_left(timeout)
+        if left == timeout:
+            return self._reload_coalescer.wait(timeout)
+        if self._reload_coalescer.wait(max(left, 0)):
+            return True
+        raise CommandTimeout(self._start_args(reload=True), max(left, 0))
+
+    @_instrumented
     def delete_contents(self, box=None, **kwargs):
         """Deletes the contents of sandbox *box*. If *box* is ``None``,
         ``self.defaultbox`` is used.
+
+        If the *fast_reset* parameter of :class:`Sandboxie` is set, the
+        contents are deleted with :func:`reset_box`, waiting for the
+        deletion to complete only if *wait* is ``True``; otherwise, a
+        failure to delete them is logged.
+        """
+        if self.fast_reset:
+            deleted = self.reset_box(box)
+            if kwargs.get('wait'):
+                deleted.result()
+            else:
+                _log_background_error(
+                    deleted, 'Could not delete the old contents of sandbox '
+                    '%r', box or self.defaultbox)
+            return
+        self.start('delete_sandbox_silent', box=box, **kwargs)
+
+    @_instrumented
+    def box_root(self, box=None):
+        """Returns the path of the folder holding the contents of sandbox
+        *box*, as set by its ``FileRootPath`` setting, or else by that of
+        ``GlobalSettings``, or else Sandboxie's default,
+        ``C:\\Sandbox\\%USER%\\%SANDBOX%``. If *box* is ``None``,
+        ``self.defaultbox`` is used.
+
+        Raises :class:`configparser.NoSectionError` if the sandbox does not
+        exist.
+        """
+        if box is None:
+            box = self.defaultbox
+        section = self.get_box_options(box)
+        root = section.get('FileRootPath')
+        if root is None:
+            with self._indexed_config_file() as (config_file, index):
+                settings = index.read_section(config_file, 'GlobalSettings')
+            if settings is not None:
+                root = settings.get('FileRootPath')
+        return _expand_file_root(root or _DEFAULT_FILE_ROOT, box)
+
+    @_instrumented
+    def reset_box(self, box=None, max_workers=8):
+        """Empties sandbox *box* at once, by renaming its content folder
+        (see :func:`box_root`) to a sibling "tombstone" folder, which is then
+        deleted in the background, scanning up to *max_workers* directories
+        at once. Tombstones left over by earlier resets of the sandbox, e.g.
+        by a process that exited before it could delete them, are deleted
+        too. If *box* is ``None``, ``self.defaultbox`` is used.
+
+        Returns a :class:`concurrent.futures.Future` that resolves to
+        ``None`` once the tombstones are deleted, or to the exception raised.
+        The processes running in the sandbox should be terminated first,
+        since on Windows their open files prevent the rename, raising
+        :class:`OSError`.
+        """
+        if box is None:
+            box = self.defaultbox
+        root = os.path.normpath(self.box_root(box))
+        tombstone = root + _TOMBSTONE_SUFFIX + uuid.uuid4().hex
+        try:
+            os.rename(root, tombstone)
+        except FileNotFoundError:
+            pass
+
+        def remove_tombstones():
+            for path in glob.glob(glob.escape(root) + _TOMBSTONE_SUFFIX + '*'):
+                _remove_tree(path, max_workers)
+
+        return _JobRunner(1).submit(box, remove_tombstones)
+
+    @contextlib.contextmanager
+    def _refreshed_content_index(self, box, full):
+        """A context manager that yields the refreshed :class:`_ContentIndex`
+        of sandbox *box*, loaded on first use, while holding its lock."""
+        if box is None:
+            box = self.defaultbox
+        root = os.path.normpath(self.box_root(box))
+        index_dir = self.index_dir
+        if index_dir is None:
+            index_dir = os.path.join(os.path.dirname(root), '.index')
+        path = os.path.join(index_dir, box + '.json.gz')
+        with self._content_indexes_lock:
+            index = self._content_indexes.get(box)
+            if index is None or index.root != root or index.path != path:
+                index = _ContentIndex.load(root, path)
+                self._content_indexes[box] = index
+        with index.lock:
+            index.refresh(full)
+            yield index
+
+    @_instrumented
+    def box_usage(self, box=None, full=False):
+        """Returns a :class:`BoxUsage` of the number and total size of the
+        files in sandbox *box*. If *box* is ``None``, ``self.defaultbox`` is
+        used.
+
+        The files are tracked by an index that is persisted between runs
+        (see the *index_dir* parameter of :class:`Sandboxie`), and refreshed
+        by only re-scanning the directories whose modification time changed,
+        so the cost of a call is proportional to the number of directories
+        and changes rather than of files. Since files modified in place do
+        not change the modification time of their directory, their new size
+        is only seen if *full* is ``True``, which re-scans every directory.
+        """
+        with self._refreshed_content_index(box, full) as index:
+            return BoxUsage(index.files, index.size)
+
+    @_instrumented
+    def changed_files(self, box=None, since=None, full=False):
+        """Returns a :class:`ContentChanges` of the files of sandbox *box*
+        added, modified or deleted since the checkpoint *since*, as returned
+        by an earlier call of this method or of :func:`content_checkpoint`,
+        or since the index of the sandbox was created if *since* is
+        ``None``. If *box* is ``None``, ``self.defaultbox`` is used.
+
+        Its cost is proportional to the number of changes, in addition to
+        that of refreshing the index; see :func:`box_usage`. Only the changes
+        seen by the last 16 refreshes that found any are retained; raises
+        :class:`CheckpointExpired` if *since* is older than that, in which
+        case list the whole sandbox by passing ``None``.
+        """
+        with self._refreshed_content_index(box, full) as index:
+            return index.changes(since or 0)
+
+    @_instrumented
+    def content_checkpoint(self, box=None, full=False):
+        """Returns a checkpoint of the current contents of sandbox *box*,
+        for :func:`changed_files`. If *box* is ``None``, ``self.defaultbox``
+        is used."""
+        with self._refreshed_content_index(box, full) as index:
+            return index.generation
+
+    def snapshot_path(self, name, box=None):
+        """Returns the path of the folder of the snapshot *name* of
+        :func:`snapshot_box`, as located for sandbox *box* (see the
+        *snapshot_dir* parameter of :class:`Sandboxie`). If *box* is
+        ``None``, ``self.defaultbox`` is used."""
+        if (not name or name in (os.curdir, os.pardir)
+                or os.path.basename(name) != name or '/' in name):
+            raise ValueError('Invalid snapshot name: {0!r}'.format(name))
+        snapshot_dir = self.snapshot_dir
+        if snapshot_dir is None:
+            root = os.path.normpath(self.box_root(box))
+            snapshot_dir = os.path.join(os.path.dirname(root), '.snapshots')
+        return os.path.join(snapshot_dir, name)
+
+    @_instrumented
+    def snapshot_box(self, box=None, name=None, hardlink=False,
+                     max_workers=8):
+        """Captures the contents of sandbox *box* as the snapshot *name*,
+        replacing any existing snapshot of that name, for restoring into any
+        sandbox with :func:`restore_box`. If *box* is ``None``,
+        ``self.defaultbox`` is used; if *name* is ``None``, *box* is used.
+
+        Files are copied as cheaply as possible: with reflinks on
+        copy-on-write filesystems, else with :func:`os.copy_file_range`,
+        else with plain copies, up to *max_workers* at once. If *hardlink*
+        is ``True``, files are hard linked instead, which is only safe if
+        the files in the sandbox are replaced rather than modified in place.
+
+        Returns a :class:`collections.Counter` of the number of files
+        copied with each method: ``'hardlink'``, ``'reflink'``,
+        ``'copy_file_range'`` or ``'copy'``. A replaced snapshot is deleted
+        in the background, and a failure to delete it is logged.
+        """
+        if box is None:
+            box = self.defaultbox
+        root = os.path.normpath(self.box_root(box))
+        snapshot = self.snapshot_path(name or box, box)
+        staging = snapshot + _STAGING_SUFFIX + uuid.uuid4().hex
+        os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+        counts = collections.Counter()
+        try:
+            if os.path.isdir(root):
+                counts = _TreeCloner(hardlink, max_workers).clone_tree(
+                    root, staging)
+            else:
+                os.mkdir(staging)
+        except BaseException:
+            _remove_tree(staging, max_workers)
+            raise
+
+        if os.path.exists(snapshot):
+            tombstone = snapshot + _TOMBSTONE_SUFFIX + uuid.uuid4().hex
+            os.rename(snapshot, tombstone)
+            removed = _JobRunner(1).submit(tombstone, functools.partial(
+                _remove_tree, tombstone, max_workers))
+            _log_background_error(removed, 'Could not delete the replaced '
+                                  'snapshot %r', name or box)
+        os.rename(staging, snapshot)
+        return counts
+
+    @_instrumented
+    def restore_box(self, box=None, name=None, hardlink=False,
+                    max_workers=8):
+        """Replaces the contents of sandbox *box* with a copy of the snapshot
+        *name* taken by :func:`snapshot_box`. If *box* is ``None``,
+        ``self.defaultbox`` is used; if *name* is ``None``, *box* is used.
+
+        The copy is made next to the sandbox's content folder, which is then
+        swapped in with :func:`reset_box`, so the sandbox keeps its previous
+        contents until the copy is complete; a failure to delete them in the
+        background is logged. Files are copied as by
+        :func:`snapshot_box`, whose *hardlink* caveat applies doubly here:
+        hard linked files modified in the sandbox also change the snapshot.
+
+        Returns a :class:`collections.Counter` of the number of files
+        copied with each method. Raises :class:`SandboxieError` if there is
+        no such snapshot.
         """
-        self.start('delete_sandbox_silent', box=None, **kwargs)
+        if box is None:
+            box = self.defaultbox
+        root = os.path.normpath(self.box_root(box))
+        snapshot = self.snapshot_path(name or box, box)
+        if not os.path.isdir(snapshot):
+            raise SandboxieError('No snapshot named {0!r}'.format(
+                name or box))
+        staging = root + _STAGING_SUFFIX + uuid.uuid4().hex
+        os.makedirs(os.path.dirname(root), exist_ok=True)
+        try:
+            counts = _TreeCloner(hardlink, max_workers).clone_tree(
+                snapshot, staging)
+        except BaseException:
+            _remove_tree(staging, max_workers)
+            raise
+        deleted = self.reset_box(box, max_workers)
+        _log_background_error(deleted, 'Could not delete the old contents '
+                              'of sandbox %r', box)
+        os.rename(staging, root)
+        return counts
 
+    @_instrumented
     def terminate_processes(self, box=None, **kwargs):
         """Terminates all processes running in sandbox *box* If *box* is
         ``None``, ``self.defaultbox`` is used."""
         self.start(terminate=True, box=box, **kwargs)
 
+    def _cleanup(self, box):
+        self.terminate_processes(box=box)
+        self.delete_contents(box=box, wait=True)
+
+    def cleanup_async(self, box=None, priority=0):
+        """Queues the termination of all processes running in sandbox *box*,
+        and the deletion of its contents, to be done in the background, and
+        returns a :class:`concurrent.futures.Future` that resolves to
+        ``None`` once done, or to the exception raised. If *box* is
+        ``None``, ``self.defaultbox`` is used.
+
+        Up to *cleanup_workers* sandboxes (see :class:`Sandboxie`) are
+        cleaned up at once, those queued with a higher *priority* first.
+        Requests for a sandbox whose cleanup is queued but has not started
+        yet share its future, and raise its priority if theirs is higher.
+        """
+        if box is None:
+            box = self.defaultbox
+        return self._cleanup_queue.submit(box, priority)
+
+    def drain(self, timeout=None):
+        """Blocks until all cleanups queued by :func:`cleanup_async` have
+        completed, or until *timeout* seconds have passed. Returns ``False``
+        if the timeout expired, ``True`` otherwise."""
+        return self._cleanup_queue.drain(timeout)
+
+    @_instrumented
     def terminate_all_processes(self, **kwargs):
         """Terminates all processes running in **all** sandboxes."""
         self.start(terminate_all=True, **kwargs)
 
+    @_instrumented
     def running_processes(self, box=None, **kwargs):
-        """Returns a generator of integer process ids for each process running
-        in sandbox *box*. If *box* is ``None``, ``self.defaultbox`` is used.
+        """Returns a ``frozenset`` of the integer process ids of each process
+        running in sandbox *box*. If *box* is ``None``, ``self.defaultbox`` is
+        used.
+
+        Concurrent calls for the same sandbox share a single run of
+        Start.exe, and if the *process_cache_ttl* parameter of
+        :class:`Sandboxie` is set, results are cached for that long. A call
+        that joins a run in progress still only waits for it until its own
+        *timeout* or :func:`deadline`.
+        """
+        if box is None:
+            box = self.defaultbox
+
+        def list_pids():
+            output = self.start(listpids=True, box=box, wait=True, **kwargs)
+            return _parse_pids(output)
+
+        # Calls with different timeouts still share a run of Start.exe.
+        options = dict(kwargs)
+        timeout = self._time_left(options.pop('timeout', None))
+        key = (box,) + tuple(sorted(options.items()))
+        try:
+            return self._process_cache.get(key, list_pids, timeout)
+        except subprocess.TimeoutExpired as e:
+            raise CommandTimeout(self._start_args(
+                listpids=True, box=box, wait=True, **options), e.timeout)
+
+    @_instrumented
+    def process_table(self, boxes=None, max_workers=8):
+        """Returns a :class:`ProcessTable` of the processes running in each
+        sandbox of the iterable *boxes*, or in all sandboxes defined in the
+        config if *boxes* is ``None``.
+
+        Up to *max_workers* sandboxes are queried at once, so that the whole
+        table takes about as long as the slowest sandbox to query. A sandbox
+        that could not be queried is left out of the table's ``pids``, and
+        its exception is recorded in its ``errors``.
+        """
+        if boxes is None:
+            boxes = self.list_boxes()
+
+        def query(box):
+            started = time.monotonic()
+            try:
+                return self.running_processes(box)
+            finally:
+                latency[box] = time.monotonic() - started
+
+        latency = {}
+        runner = _JobRunner(max_workers)
+        query = self._bind_deadline(query)
+        futures = [(box, runner.submit(box, functools.partial(query, box)))
+                   for box in boxes]
+        table = ProcessTable({}, latency, {})
+        for box, future in futures:
+            error = future.exception()
+            if error is None:
+                table.pids[box] = future.result()
+            else:
+                table.errors[box] = error
+        return table
+
+    def invalidate_process_cache(self, box=None):
+        """Discards the cached :func:`running_processes` results of sandbox
+        *box*, or of all sandboxes if *box* is ``None``."""
+        self._process_cache.invalidate(box)
+
+
+def _parse_pids(output):
+    """Returns a ``frozenset`` of the integer process ids parsed from the
+    output of Start.exe ``/listpids``."""
+    return frozenset(int(pid) for pid in output.split())
+
+
+class AsyncSandboxie(object):
+    """An :mod:`asyncio` interface to `Sandboxie <http://sandboxie.com>`_,
+    whose operations are coroutines.
+
+    Start.exe is run with :func:`asyncio.create_subprocess_exec`, so no
+    thread is held while it runs, and Sandboxie.ini is read and written in
+    the event loop's default executor, so as not to block the loop. If the
+    :class:`Sandboxie` instance was given a runner other than
+    :class:`SubprocessRunner`, command lines are run with it in the
+    executor instead.
+
+    Running Start.exe directly requires an event loop that supports
+    subprocesses. On Windows, that is only the default from Python 3.8;
+    with earlier versions, use a :class:`asyncio.ProactorEventLoop`::
+
+        asyncio.set_event_loop(asyncio.ProactorEventLoop())
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Takes the same arguments as :class:`Sandboxie`.
+
+        :param sandboxie: An existing :class:`Sandboxie` instance to use for
+                          config handling and command lines, instead of
+                          creating one from the other arguments.
+        """
+        sandboxie = kwargs.pop('sandboxie', None)
+        if sandboxie is None:
+            sandboxie = Sandboxie(*args, **kwargs)
+        self.sandboxie = sandboxie
+
+    @property
+    def defaultbox(self):
+        return self.sandboxie.defaultbox
+
+    async def _run_in_executor(self, func, *args):
+        loop = asyncio.get_event_loop()
+        call = functools.partial(func, *args)
+        return await loop.run_in_executor(None, call)
+
+    async def _shell_output(self, args, timeout=None):
+        if self.sandboxie.timeout is not None:
+            timeout = (self.sandboxie.timeout if timeout is None
+                       else min(timeout, self.sandboxie.timeout))
+        if not isinstance(self.sandboxie.runner, SubprocessRunner):
+            try:
+                return await self._run_in_executor(
+                    self.sandboxie.runner.run, args, timeout)
+            except subprocess.TimeoutExpired:
+                raise CommandTimeout(args, timeout)
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=subprocess.PIPE)
+        try:
+            output, _ = await asyncio.wait_for(process.communicate(),
+                                               timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            if isinstance(e, asyncio.TimeoutError):
+                raise CommandTimeout(args, timeout)
+            raise
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, args,
+                                                output=output)
+        return output
+
+    @_instrumented_async
+    async def get_config(self):
+        """See :func:`Sandboxie.get_config`."""
+        return await self._run_in_executor(self.sandboxie.get_config)
+
+    @_instrumented_async
+    async def commit(self, transaction):
+        """See :func:`Sandboxie.commit`."""
+        diff = ConfigDiff([], [], collections.OrderedDict())
+        if transaction:
+            diff = await self._run_in_executor(self.sandboxie._update_config,
+                                               transaction.apply)
+        if self.sandboxie._committed(transaction, diff):
+            await self.request_reload()
+        return diff
+
+    @_instrumented_async
+    async def create_sandbox(self, box, options):
+        """See :func:`Sandboxie.create_sandbox`."""
+        return await self.create_sandboxes({box: options})
+
+    @_instrumented_async
+    async def create_sandboxes(self, boxes):
+        """See :func:`Sandboxie.create_sandboxes`."""
+        transaction = SandboxTransaction()
+        for box, options in boxes.items():
+            transaction.create(box, options)
+        return await self.commit(transaction)
+
+    @_instrumented_async
+    async def destroy_sandbox(self, box):
+        """See :func:`Sandboxie.destroy_sandbox`."""
+        return await self.destroy_sandboxes([box])
+
+    @_instrumented_async
+    async def destroy_sandboxes(self, boxes):
+        """See :func:`Sandboxie.destroy_sandboxes`."""
+        transaction = SandboxTransaction()
+        for box in boxes:
+            transaction.destroy(box)
+        return await self.commit(transaction)
+
+    @_instrumented_async
+    async def start(self, command=None, box=None, timeout=None, **kwargs):
+        """See :func:`Sandboxie.start`. :func:`Sandboxie.deadline` does not
+        apply to coroutines; bound the time taken by a group of calls with
+        :func:`asyncio.wait_for` instead."""
+        args = self.sandboxie._start_args(command, box, **kwargs)
+        try:
+            return await self._shell_output(args, timeout)
+        finally:
+            if command is None and kwargs.get('terminate_all'):
+                self.sandboxie.invalidate_process_cache()
+            elif command is not None or kwargs.get('terminate'):
+                self.sandboxie.invalidate_process_cache(
+                    self.defaultbox if box is None else box)
+
+    @_instrumented_async
+    async def reload_config(self, **kwargs):
+        """See :func:`Sandboxie.reload_config`."""
+        changes = self.sandboxie._changes
+        await self.start(reload=True, **kwargs)
+        self.sandboxie._reloaded(changes)
+
+    async def request_reload(self):
+        """See :func:`Sandboxie.request_reload`."""
+        if self.sandboxie._reload_coalescer is None:
+            await self.reload_config()
+        else:
+            self.sandboxie._reload_coalescer.request()
+
+    @_instrumented_async
+    async def delete_contents(self, box=None, **kwargs):
+        """See :func:`Sandboxie.delete_contents`."""
+        if self.sandboxie.fast_reset:
+            deleted = await self._run_in_executor(self.sandboxie.reset_box,
+                                                  box)
+            if kwargs.get('wait'):
+                await asyncio.wrap_future(deleted)
+            else:
+                _log_background_error(
+                    deleted, 'Could not delete the old contents of sandbox '
+                    '%r', box or self.defaultbox)
+            return
+        await self.start('delete_sandbox_silent', box=box, **kwargs)
+
+    @_instrumented_async
+    async def terminate_processes(self, box=None, **kwargs):
+        """See :func:`Sandboxie.terminate_processes`."""
+        await self.start(terminate=True, box=box, **kwargs)
+
+    @_instrumented_async
+    async def terminate_all_processes(self, **kwargs):
+        """See :func:`Sandboxie.terminate_all_processes`."""
+        await self.start(terminate_all=True, **kwargs)
+
+    @_instrumented_async
+    async def running_processes(self, box=None, **kwargs):
+        """See :func:`Sandboxie.running_processes`."""
+        output = await self.start(listpids=True, box=box, wait=True,
+                                  **kwargs)
+        return _parse_pids(output)
+
+
+ProcessEvent = collections.namedtuple('ProcessEvent', ['kind', 'box', 'pid'])
+ProcessEvent.__doc__ = """An event reported by :class:`ProcessWatcher`: the
+process *pid* has ``'started'`` or ``'exited'`` (the event's *kind*) in
+sandbox *box*."""
+
+
+class ProcessWatcher(object):
+    """Watches the processes running in a set of sandboxes, and reports
+    processes starting and exiting as :class:`ProcessEvent` objects, to
+    callbacks registered with :func:`subscribe` or to iterators returned by
+    :func:`events`.
+
+    A background thread periodically takes a snapshot of the process ids in
+    each sandbox with :func:`Sandboxie.running_processes`, and compares it
+    with the previous one. The polling interval adapts to activity: it drops
+    to *min_interval* after changes are seen, and backs off towards
+    *max_interval* while nothing changes. Start.exe is therefore run at most
+    once per sandbox per interval, however many consumers there are.
+
+    Use as a context manager to start and stop watching::
+
+        with sandboxie.ProcessWatcher(sbie, boxes=['foo']) as watcher:
+            for event in watcher.events():
+                print(event)
+    """
+
+    def __init__(self, sandboxie, boxes=None, min_interval=0.5,
+                 max_interval=10.0, backoff=2.0):
+        """
+        :param sandboxie: The :class:`Sandboxie` instance to query.
+        :param boxes: An iterable of the names of the sandboxes to watch. If
+                      ``None``, all sandboxes defined in the config are
+                      watched, as listed by :func:`Sandboxie.list_boxes` on
+                      each poll.
+        :param min_interval: The minimum number of seconds between polls.
+        :param max_interval: The maximum number of seconds between polls.
+        :param backoff: The factor the polling interval is multiplied by
+                        after each poll that saw no changes.
+        """
+        self.sandboxie = sandboxie
+        self.boxes = None if boxes is None else set(boxes)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.polls = 0
+        self.errors = {}
+        self._snapshot = {}
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def snapshot(self):
+        """A ``dict`` mapping each watched sandbox to a ``frozenset`` of the
+        ids of the processes running in it, as of the last poll."""
+        with self._lock:
+            return dict(self._snapshot)
+
+    def add_box(self, box):
+        with self._lock:
+            if self.boxes is not None:
+                self.boxes.add(box)
+
+    def remove_box(self, box):
+        with self._lock:
+            if self.boxes is not None:
+                self.boxes.discard(box)
+            self._snapshot.pop(box, None)
+
+    def subscribe(self, callback):
+        """Registers *callback* to be called with each :class:`ProcessEvent`,
+        from the watcher's thread. Returns *callback*."""
+        with self._lock:
+            self._callbacks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._callbacks.remove(callback)
+
+    def events(self, timeout=None):
+        """Returns an iterator of the :class:`ProcessEvent` objects reported
+        once iteration has started, which ends when the watcher is stopped,
+        or when no event has been reported for *timeout* seconds. Close the
+        iterator to stop receiving events before then."""
+        events = queue.Queue()
+        self.subscribe(events.put)
+        try:
+            last_event = time.monotonic()
+            while True:
+                try:
+                    # Wake up regularly to notice the watcher being stopped.
+                    event = events.get(timeout=0.1)
+                except queue.Empty:
+                    if self._stopped.is_set():
+                        return
+                    if (timeout is not None
+                            and time.monotonic() - last_event >= timeout):
+                        return
+                    continue
+                last_event = time.monotonic()
+                yield event
+        finally:
+            self.unsubscribe(events.put)
+
+    def poll(self):
+        """Takes a snapshot of the processes running in the watched
+        sandboxes, reports the changes since the previous snapshot to the
+        subscribers, and returns them as a list of :class:`ProcessEvent`
+        objects.
+
+        The exception raised when querying a sandbox is recorded in
+        ``self.errors`` under its name, until a later poll succeeds, and the
+        sandbox is left out of the snapshot. If the sandboxes could not be
+        listed, the exception is recorded under ``None``, and nothing is
+        reported.
+        """
+        with self._lock:
+            boxes = self.boxes
+        if boxes is None:
+            try:
+                boxes = self.sandboxie.list_boxes()
+            except (SandboxieError, OSError) as e:
+                self.errors[None] = e
+                return []
+            self.errors.pop(None, None)
+        events = []
+        snapshot = {}
+        for box in sorted(boxes):
+            try:
+                pids = frozenset(self.sandboxie.running_processes(box=box))
+            except (subprocess.CalledProcessError, SandboxieError,
+                    OSError) as e:
+                self.errors[box] = e
+                continue
+            self.errors.pop(box, None)
+            snapshot[box] = pids
+        with self._lock:
+            for box, pids in snapshot.items():
+                previous = self._snapshot.get(box, frozenset())
+                events.extend(ProcessEvent('started', box, pid)
+                              for pid in sorted(pids - previous))
+                events.extend(ProcessEvent('exited', box, pid)
+                              for pid in sorted(previous - pids))
+                self._snapshot[box] = pids
+            for box in set(self._snapshot) - set(boxes):
+                del self._snapshot[box]
+            callbacks = list(self._callbacks)
+            self.polls += 1
+            if events:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff,
+                                    self.max_interval)
+        for event in events:
+            for callback in callbacks:
+                try:
+                    callback(event)
+                except Exception:
+                    _log.exception('Process watcher callback %r failed',
+                                   callback)
+        return events
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except Exception:
+                # Keep watching: the next poll may well succeed.
+                _log.exception('Process watcher poll failed')
+                with self._lock:
+                    self.interval = min(self.interval * self.backoff,
+                                        self.max_interval)
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        """Starts watching in a background thread."""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='sandboxie-process-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops watching, and waits up to *timeout* seconds for the
+        background thread to exit."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+SandboxPoolStats = collections.namedtuple('SandboxPoolStats', [
+    'size', 'idle', 'leased', 'recycling', 'leases', 'waits', 'wait_time',
+    'max_wait_time'])
+SandboxPoolStats.__doc__ = """Statistics of a :class:`SandboxPool`: the
+number of its sandboxes in total and in each state, the number of leases,
+how many of them had to wait for a sandbox to be created or returned, and
+the total and maximum time, in seconds, that leases took."""
+
+
+class SandboxPool(object):
+    """A pool of ready-to-use sandboxes, all created with the options
+    ``dict`` *options*, so that jobs do not have to pay for creating and
+    destroying a sandbox each.
+
+    Sandboxes are leased with :func:`lease`::
+
+        with SandboxPool(sbie, {'Enabled': 'yes'}, min_size=4) as pool:
+            with pool.lease() as box:
+                sbie.start('job.exe', box=box, wait=True)
+
+    Upon return, a sandbox is recycled in the background, by terminating its
+    processes and deleting its contents, before it can be leased again. A
+    sandbox that could not be recycled is destroyed.
+
+    :param sandboxie: The :class:`Sandboxie` instance that manages the
+                      sandboxes.
+    :param min_size: The number of sandboxes created up front, with a single
+                     config write and reload, and below which the pool is
+                     never trimmed.
+    :param max_size: The maximum number of sandboxes. Leases wait for a
+                     sandbox to be returned once this many exist.
+    :param prefix: The prefix of the names of the pool's sandboxes, which
+                   are numbered, skipping names already in use.
+    :param idle_timeout: If not ``None``, sandboxes left idle for this many
+                         seconds are destroyed in the background, down to
+                         *min_size* sandboxes.
+    :param recycle_workers: The number of sandboxes recycled at once.
+    """
+
+    def __init__(self, sandboxie, options, min_size=0, max_size=8,
+                 prefix='PoolBox', idle_timeout=None, recycle_workers=2):
+        if max_size < 1 or not 0 <= min_size <= max_size:
+            raise ValueError('Expected 0 <= min_size <= max_size and '
+                             'max_size >= 1')
+        self.sandboxie = sandboxie
+        self.options = dict(options)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.prefix = prefix
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        self._idle = collections.deque()
+        self._leased = set()
+        self._recycling = set()
+        self._provisioning = 0
+        self._closed = False
+        self._leases = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._used_names = set(box.lower() for box in sandboxie.list_boxes())
+        self._numbers = itertools.count(1)
+        self._recycler = _JobRunner(recycle_workers)
+
+        boxes = [self._new_name() for _ in range(min_size)]
+        if boxes:
+            sandboxie.create_sandboxes(
+                dict((box, self.options) for box in boxes))
+            # Sandboxie must know about new boxes before starting into them.
+            sandboxie.flush_reload()
+            now = time.monotonic()
+            self._idle.extend((box, now) for box in boxes)
+
+        self._stopped = threading.Event()
+        self._trimmer = None
+        if idle_timeout is not None:
+            self._trimmer = threading.Thread(target=self._trim_periodically,
+                                             name='sandboxie-pool-trimmer')
+            self._trimmer.daemon = True
+            self._trimmer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _new_name(self):
+        while True:
+            box = '{0}{1}'.format(self.prefix, next(self._numbers))
+            if box.lower() not in self._used_names:
+                self._used_names.add(box.lower())
+                return box
+
+    def _size(self):
+        return (len(self._idle) + len(self._leased) + len(self._recycling)
+                + self._provisioning)
+
+    def acquire(self, timeout=None):
+        """Returns the name of a sandbox leased from the pool, which must be
+        given back with :func:`release`. Prefer :func:`lease`.
+
+        An idle sandbox is used if there is one; otherwise a new one is
+        created if the pool has fewer than *max_size* sandboxes, or else the
+        call waits for one to be returned and recycled. Raises
+        :class:`SandboxPoolTimeout` if none is available within *timeout*
+        seconds. The config is reloaded before a new sandbox is leased, even
+        if reloads are coalesced.
+        """
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        create = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise SandboxieError('The sandbox pool is closed')
+                if self._idle:
+                    box, _ = self._idle.pop()
+                    break
+                if self._size() < self.max_size:
+                    box = self._new_name()
+                    self._provisioning += 1
+                    create = True
+                    break
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise SandboxPoolTimeout(
+                            'No sandbox became available within {0} '
+                            'seconds'.format(timeout))
+                self._cond.wait(remaining)
+
+        if create:
+            try:
+                self.sandboxie.create_sandbox(box, self.options)
+                self.sandboxie.flush_reload()
+            except BaseException:
+                with self._cond:
+                    self._provisioning -= 1
+                    self._cond.notify_all()
+                raise
+
+        waited = time.monotonic() - started
+        with self._cond:
+            if create:
+                self._provisioning -= 1
+            self._leased.add(box)
+            self._leases += 1
+            if waited > 0.001:
+                self._waits += 1
+            self._wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
+        self.sandboxie.metrics.observe('SandboxPool.lease', waited)
+        return box
+
+    def release(self, box):
+        """Returns the leased sandbox *box* to the pool, to be recycled in
+        the background."""
+        with self._cond:
+            if box not in self._leased:
+                raise ValueError('{0!r} is not leased from this pool'.format(
+                    box))
+            self._leased.remove(box)
+            self._recycling.add(box)
+        self._recycler.submit(box, functools.partial(self._recycle, box))
+
+    @contextlib.contextmanager
+    def lease(self, timeout=None):
+        """A context manager that yields the name of a sandbox leased with
+        :func:`acquire`, and releases it upon completion of the block."""
+        box = self.acquire(timeout)
+        try:
+            yield box
+        finally:
+            self.release(box)
+
+    def _recycle(self, box):
+        try:
+            self.sandboxie.terminate_processes(box=box)
+            self.sandboxie.delete_contents(box=box, wait=True)
+        except Exception:
+            _log.exception('Could not recycle sandbox %r; destroying it', box)
+            recycled = False
+        else:
+            recycled = True
+        with self._cond:
+            if recycled and not self._closed:
+                self._recycling.discard(box)
+                self._idle.append((box, time.monotonic()))
+                self._cond.notify_all()
+                return
+        # The sandbox counts as recycling until it is destroyed, so that
+        # close() waits for it.
+        self._destroy([box])
+        with self._cond:
+            self._recycling.discard(box)
+            self._cond.notify_all()
+
+    def _destroy(self, boxes):
+        try:
+            self.sandboxie.destroy_sandboxes(boxes)
+        except Exception:
+            _log.exception('Could not destroy pooled sandboxes %r', boxes)
+
+    def trim(self):
+        """Destroys the sandboxes that have been idle for at least
+        *idle_timeout* seconds, as long as the pool has more than
+        *min_size* sandboxes. Returns a list of their names."""
+        if self.idle_timeout is None:
+            return []
+        boxes = []
+        with self._cond:
+            now = time.monotonic()
+            while (self._idle and self._size() > self.min_size
+                   and now - self._idle[0][1] >= self.idle_timeout):
+                boxes.append(self._idle.popleft()[0])
+        if boxes:
+            self._destroy(boxes)
+        return boxes
+
+    def _trim_periodically(self):
+        while not self._stopped.wait(self.idle_timeout / 2.0):
+            self.trim()
+
+    def stats(self):
+        """Returns a :class:`SandboxPoolStats` of the pool."""
+        with self._cond:
+            return SandboxPoolStats(
+                self._size(), len(self._idle), len(self._leased),
+                len(self._recycling), self._leases, self._waits,
+                self._wait_time, self._max_wait_time)
+
+    def close(self):
+        """Waits for returned sandboxes to be recycled, and destroys all
+        idle sandboxes. Sandboxes still leased are destroyed when they are
+        returned."""
+        self._stopped.set()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            while self._recycling:
+                self._cond.wait()
+            boxes = [box for box, _ in self._idle]
+            self._idle.clear()
+        if self._trimmer is not None:
+            self._trimmer.join()
+        if boxes:
+            self._destroy(boxes)
+
+
+JobSchedulerStats = collections.namedtuple('JobSchedulerStats', [
+    'queued', 'running', 'peak_queued', 'submitted', 'completed', 'failed',
+    'rejected', 'wait_time', 'max_wait_time'])
+JobSchedulerStats.__doc__ = """Statistics of a :class:`JobScheduler`: the
+number of jobs queued and running, the largest number ever queued at once,
+the number of jobs submitted, completed (including those that failed),
+failed and rejected because the queue was full, and the total and maximum
+time, in seconds, that jobs waited in the queue before starting."""
+
+
+class JobScheduler(object):
+    """Runs a stream of sandboxed jobs with admission control, so that
+    Sandboxie is kept busy without being overloaded::
+
+        with JobScheduler(sbie, max_workers=8, max_per_box=2,
+                          max_queued=1000) as scheduler:
+            for job in jobs:
+                scheduler.submit(job.command, box=job.box, wait=True,
+                                 priority=job.priority, tenant=job.user)
+
+    Jobs run on up to *max_workers* threads, and at most *max_per_box* jobs
+    (unless ``None``) run in the same sandbox at once. Queued jobs are
+    started highest priority first; jobs of equal priority are started in
+    fair turns across tenants, in proportion to their weights (start-time
+    fair queuing), so that a tenant submitting many jobs does not hold up
+    the others. Jobs of a sandbox at its limit are skipped over until one
+    of its running jobs completes.
+
+    The time jobs wait in the queue is recorded in the metrics of the
+    :class:`Sandboxie` instance, under ``JobScheduler.wait``; see also
+    :func:`stats`.
+
+    :param sandboxie: The :class:`Sandboxie` instance that runs the jobs.
+    :param max_workers: The maximum number of jobs run at once.
+    :param max_per_box: If not ``None``, the maximum number of jobs run at
+                        once in any one sandbox.
+    :param max_queued: If not ``None``, the maximum number of jobs waiting
+                       to start. Submitting a job to a full queue raises
+                       :class:`JobQueueFull`, after waiting for room if
+                       *block* is ``True``.
+    :param block: Whether to wait for room in a full queue, rather than
+                  reject jobs at once.
+    :param tenant_weights: A ``dict`` mapping tenants to their share of the
+                           workers, relative to the default weight of 1.
+    """
+
+    def __init__(self, sandboxie, max_workers=8, max_per_box=None,
+                 max_queued=None, block=True, tenant_weights=None):
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+        if max_per_box is not None and max_per_box < 1:
+            raise ValueError('max_per_box must be at least 1')
+        if max_queued is not None and max_queued < 1:
+            raise ValueError('max_queued must be at least 1')
+        self.sandboxie = sandboxie
+        self.max_workers = max_workers
+        self.max_per_box = max_per_box
+        self.max_queued = max_queued
+        self.block = block
+        self.tenant_weights = dict(tenant_weights or {})
+        self._cond = threading.Condition()
+        # Entries are (-priority, tag, order, box, future, func, submitted)
+        # tuples. Those of a sandbox found at its limit are moved to its
+        # heap in self._blocked, and moved back one at a time as its jobs
+        # complete.
+        self._heap = []
+        self._blocked = {}
+        self._active = collections.Counter()
+        self._order = itertools.count()
+        self._virtual_time = 0.0
+        self._tenant_tags = {}
+        self._queued = 0
+        self._running = 0
+        self._workers = 0
+        self._closed = False
+        self._peak_queued = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, command=None, box=None, priority=0, tenant=None,
+               queue_timeout=None, **kwargs):
+        """Queues *command* to be run in sandbox *box* with
+        :func:`Sandboxie.start`, which takes the other keyword arguments.
+        Returns a :class:`concurrent.futures.Future` of its output. See
+        :func:`submit_call`."""
+        if box is None:
+            box = self.sandboxie.defaultbox
+        return self.submit_call(
+            functools.partial(self.sandboxie.start, command, box=box,
+                              **kwargs),
+            box, priority, tenant, queue_timeout)
+
+    def submit_call(self, func, box=None, priority=0, tenant=None,
+                    queue_timeout=None):
+        """Queues ``func()``, a job that uses sandbox *box* (or
+        ``self.sandboxie.defaultbox`` if ``None``), and returns a
+        :class:`concurrent.futures.Future` of its result. A job may be
+        cancelled with the future until it starts.
+
+        The current :func:`Sandboxie.deadline` applies to the job, and bounds
+        the wait for room in a full queue, as does *queue_timeout*, in
+        seconds, unless ``None``. Raises :class:`JobQueueFull` if the queue
+        is still full then, or :class:`SandboxieError` if the scheduler is
+        closed.
+
+        :param priority: Jobs of higher priority are started first.
+        :param tenant: The tenant the job is run for, whose jobs take fair
+            turns with those of the other tenants of the same priority.
         """
-        output = self.start(listpids=True, box=box, wait=True, **kwargs)
-        return (int(pid) for pid in output.split())
+        if box is None:
+            box = self.sandboxie.defaultbox
+        func = self.sandboxie._bind_deadline(func)
+        future = concurrent.futures.Future()
+        with self._cond:
+            self._admit(self.sandboxie._time_left(queue_timeout))
+            tag = (max(self._virtual_time,
+                       self._tenant_tags.get(tenant, 0.0))
+                   + 1.0 / self.tenant_weights.get(tenant, 1))
+            self._tenant_tags[tenant] = tag
+            heapq.heappush(self._heap, (-priority, tag, next(self._order),
+                                        box, future, func, time.monotonic()))
+            self._queued += 1
+            self._submitted += 1
+            self._peak_queued = max(self._peak_queued, self._queued)
+            future.add_done_callback(self._job_done)
+            if self._workers < self.max_workers:
+                self._workers += 1
+                worker = threading.Thread(target=self._work,
+                                          name='sandboxie-scheduler')
+                worker.daemon = True
+                worker.start()
+            else:
+                self._cond.notify_all()
+        return future
+
+    def _admit(self, timeout):
+        """Waits for room in the queue, for up to *timeout* seconds if
+        ``self.block``. Must be called with ``self._cond`` held."""
+        if self._closed:
+            raise SandboxieError('The job scheduler is closed')
+        if self.max_queued is None or self._queued < self.max_queued:
+            return
+        if self.block and self._cond.wait_for(
+                lambda: self._closed or self._queued < self.max_queued,
+                timeout):
+            if self._closed:
+                raise SandboxieError('The job scheduler is closed')
+            return
+        self._rejected += 1
+        raise JobQueueFull('The job queue is full ({0} jobs)'.format(
+            self.max_queued))
+
+    def _job_done(self, future):
+        if future.cancelled():
+            # The job had not started, so it is still counted as queued.
+            with self._cond:
+                self._queued -= 1
+                self._cond.notify_all()
+
+    def _unblock(self, box):
+        """Moves the first job of *box* set aside at its limit, if any, back
+        to the queue. Must be called with ``self._cond`` held."""
+        blocked = self._blocked.get(box)
+        if blocked:
+            heapq.heappush(self._heap, heapq.heappop(blocked))
+            if not blocked:
+                del self._blocked[box]
+
+    def _next_job(self):
+        """Returns the heap entry of the next job to run, marked as running,
+        or ``None`` if no job is runnable. Must be called with
+        ``self._cond`` held."""
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            box, future = entry[3], entry[4]
+            if (self.max_per_box is not None
+                    and self._active[box] >= self.max_per_box):
+                heapq.heappush(self._blocked.setdefault(box, []), entry)
+            elif future.set_running_or_notify_cancel():
+                return entry
+            else:
+                self._unblock(box)
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                entry = self._next_job()
+                while entry is None:
+                    if not self._queued:
+                        self._workers -= 1
+                        self._cond.notify_all()
+                        return
+                    self._cond.wait()
+                    entry = self._next_job()
+                _, tag, _, box, future, func, submitted = entry
+                waited = time.monotonic() - submitted
+                self._virtual_time = max(self._virtual_time, tag)
+                self._queued -= 1
+                self._running += 1
+                self._active[box] += 1
+                self._wait_time += waited
+                self._max_wait_time = max(self._max_wait_time, waited)
+                self._cond.notify_all()
+            self.sandboxie.metrics.observe('JobScheduler.wait', waited)
+            failed = False
+            try:
+                try:
+                    result = func()
+                except BaseException as e:
+                    failed = True
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._active[box] -= 1
+                    if not self._active[box]:
+                        del self._active[box]
+                    self._completed += 1
+                    self._failed += failed
+                    self._unblock(box)
+                    self._cond.notify_all()
+
+    def drain(self, timeout=None):
+        """Blocks until all queued jobs have completed, or until *timeout*
+        seconds have passed. Returns ``False`` if the timeout expired,
+        ``True`` otherwise."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not (self._queued or self._running), timeout)
+
+    def stats(self):
+        """Returns a :class:`JobSchedulerStats` of the scheduler."""
+        with self._cond:
+            return JobSchedulerStats(
+                self._queued, self._running, self._peak_queued,
+                self._submitted, self._completed, self._failed,
+                self._rejected, self._wait_time, self._max_wait_time)
+
+    def close(self, cancel=False, wait=True):
+        """Stops accepting jobs. If *cancel* is ``True``, the jobs that have
+        not started are cancelled; if *wait* is ``True``, waits for the
+        others to complete."""
+        with self._cond:
+            self._closed = True
+            if cancel:
+                entries = self._heap + [entry for blocked in
+                                        self._blocked.values()
+                                        for entry in blocked]
+                for entry in entries:
+                    entry[4].cancel()
+            self._cond.notify_all()
+        if wait:
+            self.drain()
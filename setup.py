@@ -1,15 +1,14 @@
 # coding: utf-8
 
+import sys
 from distutils.core import setup
 
 import _meta
 
-requirements = []
+if sys.version_info < (3, 5):
+    sys.exit('sandboxie requires Python 3.5 or later.')
 
-try:
-    import configparser
-except ImportError:
-    requirements.append('configparser')
+requirements = []
 
 setup(
     name='sandboxie',
@@ -19,9 +18,8 @@ setup(
     py_modules=['sandboxie', '_meta'],
     install_requires=requirements,
     classifiers=['Programming Language :: Python',
-                 'Programming Language :: Python :: 2.7',
                  'Programming Language :: Python :: 3',
-                 'Programming Language :: Python :: 3.2',
+                 'Programming Language :: Python :: 3.5',
                  'Natural Language :: English',
                  'Operating System :: Microsoft :: Windows',
                  'License :: OSI Approved :: MIT License',
@@ -1,18 +1,39 @@
 from __future__ import unicode_literals
 
+import asyncio
+import collections
 import configparser
 import contextlib
+import functools
+import getpass
 import io
+import itertools
+import multiprocessing
 import os
 import shutil
+import stat
 import subprocess
+import sys
 import tempfile
-import types
+import threading
+import time
 import unittest
 
 import mock
 
-from sandboxie import Sandboxie, SandboxieError
+import sandboxie
+from sandboxie import Sandboxie, SandboxieConfig, SandboxieError
+
+
+def _create_boxes_in_process(install_dir, prefix, count, optimistic):
+    # Processes started with the "spawn" method (the only one on Windows)
+    # do not inherit the environment set up by the test.
+    os.environ = {'WinDir': 'does_not_exist'}
+    sbie = Sandboxie(install_dir=install_dir, optimistic_writes=optimistic,
+                     write_retries=1000)
+    sbie.reload_config = lambda **kwargs: None
+    for i in range(count):
+        sbie.create_sandbox('{0}{1}'.format(prefix, i), {'Enabled': 'yes'})
 
 
 class SandboxieUnitTests(unittest.TestCase):
@@ -111,6 +132,522 @@ class SandboxieUnitTests(unittest.TestCase):
 
         sbie.start.assert_called_once(reload=True)
 
+    def _write_ini(self, text):
+        with io.open(self.config_path, 'w', encoding='utf-16-le') as f:
+            f.write(text)
+
+    def test_get_config_is_cached_until_file_changes(self):
+        self._write_ini('[foo]\nEnabled=yes\n')
+        self.assertEqual(self.sbie.get_config()['foo']['Enabled'], 'yes')
+        self.assertEqual(self.sbie.get_config()['foo']['Enabled'], 'yes')
+        self.assertEqual(self.sbie.config_cache_info()[:2], (1, 1))
+
+        self._write_ini('[foo]\nEnabled=no\nextra=1\n')
+        self.assertEqual(self.sbie.get_config()['foo']['Enabled'], 'no')
+        self.assertEqual(self.sbie.config_cache_info()[:2], (1, 2))
+
+    def test_get_config_returns_copy_of_cached_config(self):
+        self._write_ini('[foo]\nFileRootPath=C:\\Sandbox\\%SANDBOX%\n')
+        config = self.sbie.get_config()
+        config.remove_section('foo')
+        config = self.sbie.get_config()
+        self.assertEqual(config.get('foo', 'FileRootPath', raw=True),
+                         'C:\\Sandbox\\%SANDBOX%')
+        self.assertEqual(self.sbie.config_cache_info().hits, 1)
+
+    def test_config_cache_can_be_shared_or_disabled(self):
+        self._write_ini('[foo]\nEnabled=yes\n')
+        sbie1 = Sandboxie(install_dir=self.config_dir,
+                          shared_config_cache=True)
+        sbie2 = Sandboxie(install_dir=self.config_dir,
+                          shared_config_cache=True)
+        sbie1.get_config()
+        before = sbie2.config_cache_info()
+        sbie2.get_config()
+        self.assertEqual(sbie2.config_cache_info().hits, before.hits + 1)
+        sbie1.clear_config_cache()
+
+        sbie = Sandboxie(install_dir=self.config_dir, cache_config=False)
+        self.assertEqual(sbie.get_config()['foo']['Enabled'], 'yes')
+        self.assertEqual(sbie.config_cache_info(), None)
+
+    def _read_ini(self):
+        with io.open(self.config_path, 'r', encoding='utf-16-le') as f:
+            config = configparser.ConfigParser(interpolation=None)
+            config.read_file(f)
+        return config
+
+    def test_batch_writes_and_reloads_once(self):
+        self._write_ini('[old]\nEnabled=yes\n[keep]\nEnabled=yes\n')
+        self.sbie.reload_config = mock.Mock()
+        self.sbie._write_config = mock.Mock(wraps=self.sbie._write_config)
+        with self.sbie.batch() as tx:
+            tx.create('foo', {'Enabled': 'yes'})
+            tx.destroy('old')
+            tx.update('keep', {'ConfigLevel': '7'})
+        self.assertEqual(self.sbie._write_config.call_count, 1)
+        self.assertEqual(self.sbie.reload_config.call_count, 1)
+
+        config = self._read_ini()
+        self.assertEqual(config.sections(), ['keep', 'foo'])
+        self.assertEqual(dict(config['keep']),
+                         {'enabled': 'yes', 'configlevel': '7'})
+
+    def test_batch_update_removes_none_options(self):
+        self._write_ini('[foo]\nEnabled=yes\nConfigLevel=7\n')
+        self.sbie.reload_config = mock.Mock()
+        with self.sbie.batch() as tx:
+            tx.update('foo', {'ConfigLevel': None, 'Template': None})
+        self.assertEqual(dict(self._read_ini()['foo']), {'enabled': 'yes'})
+        self.assertEqual(tx.diff.changed['foo'],
+                         sandboxie.SectionDiff([], ['ConfigLevel'], []))
+
+    def test_batch_applies_nothing_when_block_raises(self):
+        self.sbie.reload_config = mock.Mock()
+        try:
+            with self.sbie.batch() as tx:
+                tx.create('foo', {'Enabled': 'yes'})
+                raise KeyError()
+        except KeyError:
+            pass
+        self.assertEqual(self._read_ini().sections(), [])
+        self.assertFalse(self.sbie.reload_config.called)
+
+    def test_commit_returns_diff(self):
+        self._write_ini('[old]\nEnabled=yes\n'
+                        '[keep]\nEnabled=yes\nOpenFilePath=a\n')
+        self.sbie.reload_config = mock.Mock()
+        with self.sbie.batch() as tx:
+            tx.create('foo', {'Enabled': 'yes'})
+            tx.destroy('old')
+            tx.update('keep', {'ConfigLevel': '7', 'Enabled': 'no',
+                               'OpenFilePath': ['a', 'b']})
+        self.assertEqual(tx.diff.added, ['foo'])
+        self.assertEqual(tx.diff.removed, ['old'])
+        self.assertEqual(list(tx.diff.changed), ['keep'])
+        self.assertEqual(tx.diff.changed['keep'], sandboxie.SectionDiff(
+            ['ConfigLevel'], [], ['Enabled', 'OpenFilePath']))
+        self.assertEqual(str(tx.diff), 'added foo; removed old; changed keep '
+                         '(+ConfigLevel, ~Enabled, ~OpenFilePath)')
+
+        diff = self.sbie.create_sandbox('bar', {'Enabled': 'yes'})
+        self.assertEqual(diff.added, ['bar'])
+        self.assertTrue(diff)
+
+    def test_noop_changes_skip_write_and_reload(self):
+        self._write_ini('[foo]\nEnabled=yes\nConfigLevel=7\n')
+        self.sbie.reload_config = mock.Mock()
+        self.sbie._write_config = mock.Mock(wraps=self.sbie._write_config)
+        signature = sandboxie._stat_signature(self.config_path)
+        for optimistic in (False, True):
+            self.sbie.optimistic_writes = optimistic
+            diff = self.sbie.create_sandbox(
+                'foo', {'Enabled': 'yes', 'ConfigLevel': '7'})
+            self.assertFalse(diff)
+            self.assertEqual(str(diff), 'no changes')
+            self.assertFalse(self.sbie.destroy_sandbox('missing'))
+            with self.sbie.batch() as tx:
+                tx.update('foo', {'ConfigLevel': '7'})
+            self.assertFalse(tx.diff)
+        self.assertFalse(self.sbie._write_config.called)
+        self.assertFalse(self.sbie.reload_config.called)
+        self.assertEqual(sandboxie._stat_signature(self.config_path),
+                         signature)
+
+        self.assertTrue(self.sbie.destroy_sandbox('foo'))
+        self.assertEqual(self.sbie.reload_config.call_count, 1)
+
+    def test_create_and_destroy_sandboxes(self):
+        self.sbie.reload_config = mock.Mock()
+        self.sbie.create_sandboxes(dict(('box{0}'.format(i),
+                                         {'Enabled': 'yes'})
+                                        for i in range(5)))
+        self.assertEqual(len(self._read_ini().sections()), 5)
+        self.sbie.destroy_sandboxes(['box1', 'box3'])
+        self.assertEqual(sorted(self._read_ini().sections()),
+                         ['box0', 'box2', 'box4'])
+        self.assertEqual(self.sbie.reload_config.call_count, 2)
+
+    def _test_concurrent_writers(self, optimistic):
+        workers = [multiprocessing.Process(
+                       target=_create_boxes_in_process,
+                       args=(self.config_dir, 'w{0}_'.format(i), 10,
+                             optimistic))
+                   for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+        self.assertEqual(len(self._read_ini().sections()), 40)
+        leftovers = [name for name in os.listdir(self.config_dir)
+                     if name.endswith('.tmp')]
+        self.assertEqual(leftovers, [])
+
+    def test_concurrent_locked_writers_do_not_lose_updates(self):
+        self._test_concurrent_writers(optimistic=False)
+
+    def test_concurrent_optimistic_writers_do_not_lose_updates(self):
+        self._test_concurrent_writers(optimistic=True)
+
+    def test_optimistic_write_retries_on_conflict(self):
+        self.sbie.optimistic_writes = True
+        self.sbie.reload_config = mock.Mock()
+        other = Sandboxie(install_dir=self.config_dir)
+        other.reload_config = mock.Mock()
+        calls = []
+
+        def update(config):
+            calls.append(1)
+            if len(calls) == 1:
+                other.create_sandbox('other', {'Enabled': 'yes'})
+            config['mine'] = {'Enabled': 'yes'}
+
+        self.sbie._update_config(update)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sorted(self._read_ini().sections()),
+                         ['mine', 'other'])
+
+    def test_optimistic_write_gives_up_after_retries(self):
+        self.sbie.optimistic_writes = True
+        self.sbie.write_retries = 2
+
+        def update(config):
+            with io.open(self.config_path, 'a', encoding='utf-16-le') as f:
+                f.write('\n')
+            config['foo'] = {'Enabled': 'yes'}
+
+        self.assertRaises(sandboxie.ConfigConflictError,
+                          self.sbie._update_config, update)
+
+    def test_config_lock_times_out(self):
+        self.sbie.lock_timeout = 0.05
+        with self.sbie._lock_config():
+            other = Sandboxie(install_dir=self.config_dir, lock_timeout=0.05)
+            self.assertRaises(sandboxie.ConfigLockTimeout,
+                              other.create_sandbox, 'foo', {})
+
+    def test_coalesced_reloads(self):
+        sbie = Sandboxie(install_dir=self.config_dir, reload_delay=0.05)
+        sbie.start = mock.Mock()
+        for i in range(10):
+            sbie.create_sandbox('box{0}'.format(i), {'Enabled': 'yes'})
+        self.assertEqual(sbie.start.call_count, 0)
+        self.assertTrue(sbie.wait_reloaded(timeout=5))
+        sbie.start.assert_called_once_with(reload=True)
+
+    def test_coalesced_reload_max_delay(self):
+        sbie = Sandboxie(install_dir=self.config_dir, reload_delay=10,
+                         reload_max_delay=0.05)
+        sbie.start = mock.Mock()
+        sbie.request_reload()
+        self.assertTrue(sbie.wait_reloaded(timeout=5))
+        self.assertEqual(sbie.start.call_count, 1)
+
+    def test_flush_reload(self):
+        sbie = Sandboxie(install_dir=self.config_dir, reload_delay=10)
+        sbie.start = mock.Mock()
+        self.assertTrue(sbie.wait_reloaded(timeout=0))
+        sbie.request_reload()
+        sbie.request_reload()
+        self.assertFalse(sbie.wait_reloaded(timeout=0.01))
+        sbie.flush_reload()
+        sbie.flush_reload()
+        self.assertTrue(sbie.wait_reloaded(timeout=0))
+        sbie.start.assert_called_once_with(reload=True)
+
+    def test_wait_reloaded_raises_reload_error(self):
+        sbie = Sandboxie(install_dir=self.config_dir, reload_delay=0)
+        sbie.start = mock.Mock(side_effect=subprocess.CalledProcessError(
+            1, 'Start.exe'))
+        sbie.request_reload()
+        self.assertRaises(subprocess.CalledProcessError,
+                          sbie.wait_reloaded, 5)
+
+    def _mock_start_tracking_concurrency(self, fail_box=None):
+        lock = threading.Lock()
+        active = collections.Counter()
+        peaks = collections.Counter()
+
+        def start(command, box=None, **kwargs):
+            with lock:
+                active[box] += 1
+                active['*'] += 1
+                peaks[box] = max(peaks[box], active[box])
+                peaks['*'] = max(peaks['*'], active['*'])
+            time.sleep(0.01)
+            with lock:
+                active[box] -= 1
+                active['*'] -= 1
+            if box == fail_box:
+                raise subprocess.CalledProcessError(1, command)
+            return '{0} {1}'.format(box, command)
+
+        self.sbie.start = start
+        return peaks
+
+    def test_start_many_returns_ordered_futures(self):
+        self._mock_start_tracking_concurrency(fail_box='bad')
+        jobs = [('a.exe', 'box1'), ('b.exe', None, {'wait': True}),
+                ('c.exe', 'bad')]
+        futures = self.sbie.start_many(jobs, max_workers=2)
+        self.assertEqual(futures[0].result(), 'box1 a.exe')
+        self.assertEqual(futures[1].result(), 'DefaultBox b.exe')
+        self.assertTrue(isinstance(futures[2].exception(),
+                                   subprocess.CalledProcessError))
+
+    def test_start_many_bounds_concurrency(self):
+        peaks = self._mock_start_tracking_concurrency()
+        jobs = [('x.exe', 'box{0}'.format(i % 3)) for i in range(30)]
+        futures = self.sbie.start_many(jobs, max_workers=4, max_per_box=1)
+        for future in futures:
+            future.result()
+        self.assertTrue(peaks['*'] <= 3)
+        self.assertEqual(max(peaks[b] for b in ('box0', 'box1', 'box2')), 1)
+
+        peaks = self._mock_start_tracking_concurrency()
+        futures = self.sbie.start_many(jobs, max_workers=4)
+        for future in futures:
+            future.result()
+        self.assertTrue(1 < peaks['*'] <= 4)
+
+    def _read_ini_bytes(self):
+        with io.open(self.config_path, 'rb') as f:
+            return f.read()
+
+    def test_write_appends_new_sections_in_place(self):
+        original = ('; global comment\r\n[GlobalSettings]\r\n'
+                    'FileRootPath=C:\\Sandbox\r\n\r\n'
+                    '[a]\r\nEnabled=yes ; note\r\n'
+                    '[b]\r\nEnabled=no')
+        self._write_ini(original)
+        inode = os.stat(self.config_path).st_ino
+        self.sbie.reload_config = mock.Mock()
+        self.sbie.append_in_place = True
+        self.sbie.create_sandboxes({'c': {'Enabled': 'yes'}})
+
+        data = self._read_ini_bytes()
+        self.assertEqual(os.stat(self.config_path).st_ino, inode)
+        self.assertEqual(data.decode('utf-16-le'), original +
+                         '\r\n[c]\r\nEnabled=yes\r\n\r\n')
+        self.assertEqual(self._read_ini().sections(),
+                         ['GlobalSettings', 'a', 'b', 'c'])
+
+        # Only the end of the file is read to append to it.
+        bytes_read = self.sbie.metrics.bytes_read
+        self.sbie.create_sandboxes({'d': {'Enabled': 'yes'}})
+        self.assertEqual(self.sbie.metrics.bytes_read - bytes_read, 2)
+        self.assertEqual(self._read_ini().sections(),
+                         ['GlobalSettings', 'a', 'b', 'c', 'd'])
+        self.assertEqual(self.sbie.get_box_options('d').entries,
+                         (('Enabled', 'yes'),))
+
+    def test_write_appends_new_sections_atomically_by_default(self):
+        original = '[a]\r\nEnabled=yes\r\n[b]\r\nEnabled=no'
+        self._write_ini(original)
+        self.sbie.reload_config = mock.Mock()
+        self.sbie._replace_config_data = mock.Mock(
+            wraps=self.sbie._replace_config_data)
+        self.sbie.create_sandboxes({'c': {'Enabled': 'yes'}})
+        self.sbie.create_sandboxes({'d': {'Enabled': 'yes'}})
+
+        self.assertEqual(self.sbie._replace_config_data.call_count, 2)
+        self.assertEqual(self._read_ini_bytes().decode('utf-16-le'),
+                         original + '\r\n[c]\r\nEnabled=yes\r\n\r\n'
+                         '[d]\r\nEnabled=yes\r\n\r\n')
+        self.assertEqual(self.sbie.get_box_options('c').entries,
+                         (('Enabled', 'yes'),))
+
+    def test_write_splices_changed_and_removed_sections(self):
+        original = ('[a]\nEnabled=yes\n; keep me\n\n'
+                    '[b]\nEnabled=no\n\n'
+                    '[c]\nEnabled=yes\n'
+                    '[d]\nEnabled=yes\n')
+        self._write_ini(original)
+        self.sbie.reload_config = mock.Mock()
+        with self.sbie.batch() as tx:
+            tx.update('b', {'Enabled': 'yes'})
+            tx.destroy('c')
+            tx.create('e', {'Enabled': 'no'})
+
+        self.assertEqual(self._read_ini_bytes().decode('utf-16-le'),
+                         '[a]\nEnabled=yes\n; keep me\n\n'
+                         '[b]\nEnabled=yes\n\n'
+                         '[d]\nEnabled=yes\n'
+                         '[e]\nEnabled=no\n\n')
+
+        # The cached layout matches the written file, so further changes
+        # are spliced correctly.
+        self.sbie.destroy_sandbox('d')
+        self.sbie.destroy_sandbox('a')
+        self.assertEqual(self._read_ini_bytes().decode('utf-16-le'),
+                         '[b]\nEnabled=yes\n\n[e]\nEnabled=no\n\n')
+
+    def test_write_merges_changed_duplicate_sections(self):
+        self._write_ini('[a]\nx=1\n[b]\ny=2\n[a]\nz=3\n')
+        self.sbie.reload_config = mock.Mock()
+        self.sbie.create_sandbox('c', {'Enabled': 'yes'})
+        self.assertEqual(self._read_ini_bytes().decode('utf-16-le'),
+                         '[a]\nx=1\n[b]\ny=2\n[a]\nz=3\n'
+                         '[c]\nEnabled=yes\n\n')
+        with self.sbie.batch() as tx:
+            tx.update('a', {'w': '4'})
+        self.assertEqual(self._read_ini_bytes().decode('utf-16-le'),
+                         '[a]\nx=1\nz=3\nw=4\n\n[b]\ny=2\n'
+                         '[c]\nEnabled=yes\n\n')
+
+    def test_write_preserves_byte_order_mark(self):
+        with io.open(self.config_path, 'wb') as f:
+            f.write(b'\xff\xfe' + '[a]\r\nx=1\r\n'.encode('utf-16-le'))
+        self.sbie.reload_config = mock.Mock()
+        self.assertEqual(self.sbie.get_config()['a']['x'], '1')
+        self.sbie.create_sandbox('b', {'y': '2'})
+        self.sbie.destroy_sandbox('a')
+        self.assertEqual(self._read_ini_bytes(), b'\xff\xfe' +
+                         '[b]\r\ny=2\r\n\r\n'.encode('utf-16-le'))
+
+    def test_box_lookups(self):
+        self._write_ini('\ufeff[GlobalSettings]\r\nFileRootPath=C:\\S\r\n'
+                        '[UserSettings_0123]\r\nx=1\r\n'
+                        '[Template_Local_Foo]\r\nx=1\r\n'
+                        '[DefaultBox]\r\nEnabled=y\r\n'
+                        '[foo]\r\nOpenFilePath=a\r\n'
+                        '[TemplateBox]\r\nEnabled=y\r\n'
+                        '[DefaultBox]\r\nOpenFilePath=b\r\n')
+        self.assertEqual(self.sbie.list_boxes(),
+                         ['DefaultBox', 'foo', 'TemplateBox'])
+        self.assertTrue(self.sbie.box_exists('foo'))
+        self.assertTrue(self.sbie.box_exists('TemplateBox'))
+        self.assertFalse(self.sbie.box_exists('Template_Local_Foo'))
+        self.assertFalse(self.sbie.box_exists('bar'))
+        self.assertFalse(self.sbie.box_exists('GlobalSettings'))
+
+        options = self.sbie.get_box_options()
+        self.assertEqual(options.entries, (('Enabled', 'y'),
+                                           ('OpenFilePath', 'b')))
+        self.assertEqual(self.sbie.get_box_options('foo')['OpenFilePath'],
+                         'a')
+        self.assertRaises(configparser.NoSectionError,
+                          self.sbie.get_box_options, 'bar')
+        self.assertRaises(configparser.NoSectionError,
+                          self.sbie.get_box_options, 'GlobalSettings')
+
+    def test_box_lookups_index_is_rebuilt_only_when_file_changes(self):
+        self._write_ini('[foo]\nEnabled=y\n')
+        with mock.patch('sandboxie._SectionIndex.build',
+                        wraps=sandboxie._SectionIndex.build) as build:
+            self.assertTrue(self.sbie.box_exists('foo'))
+            self.assertEqual(self.sbie.get_box_options('foo')['Enabled'], 'y')
+            self.assertEqual(build.call_count, 1)
+
+            self.sbie.reload_config = mock.Mock()
+            self.sbie.create_sandbox('bar', {'Enabled': 'n'})
+            self.assertEqual(self.sbie.get_box_options('bar')['Enabled'], 'n')
+            self.assertEqual(self.sbie.get_box_options('foo')['Enabled'], 'y')
+            self.assertEqual(build.call_count, 2)
+
+    def test_box_lookups_on_empty_config(self):
+        self.assertEqual(self.sbie.list_boxes(), [])
+        self.assertFalse(self.sbie.box_exists('foo'))
+
+    def test_templates_are_resolved_with_inheritance(self):
+        self.sbie.define_template('base', {'Enabled': 'yes',
+                                           'ConfigLevel': '7',
+                                           'OpenFilePath': ['a', 'b']})
+        self.sbie.define_template('worker', {'ConfigLevel': None,
+                                             'OpenFilePath': 'c',
+                                             'BoxNameTitle': 'n'},
+                                  base='base')
+        self.assertEqual(self.sbie.resolve_template('worker').entries,
+                         (('Enabled', 'yes'), ('OpenFilePath', 'c'),
+                          ('BoxNameTitle', 'n')))
+        self.assertTrue(self.sbie.resolve_template('worker').entries
+                        is self.sbie.resolve_template('worker').entries)
+
+        self.sbie.define_template('base', {'Enabled': 'no'})
+        self.assertEqual(self.sbie.resolve_template('worker').entries,
+                         (('Enabled', 'no'), ('OpenFilePath', 'c'),
+                          ('BoxNameTitle', 'n')))
+
+        self.assertRaises(ValueError, self.sbie.define_template, 'bad',
+                          {'Bad=Name': 'x'})
+        self.sbie.define_template('orphan', {}, base='missing')
+        self.assertRaises(ValueError, self.sbie.resolve_template, 'orphan')
+        self.sbie.define_template('a', {}, base='b')
+        self.sbie.define_template('b', {}, base='a')
+        self.assertRaises(ValueError, self.sbie.resolve_template, 'a')
+
+    def test_create_from_template(self):
+        self._write_ini('[foo]\nEnabled=yes\n')
+        self.sbie.reload_config = mock.Mock()
+        self.sbie.define_template('worker', {'Enabled': 'yes',
+                                             'OpenFilePath': ['a', 'b']})
+        self.sbie.create_from_template(
+            'worker', ['box1', 'box2', 'box3'],
+            overrides={'box2': {'FileRootPath': 'C:\\box2',
+                                'OpenFilePath': None}})
+        self.sbie.create_from_template(
+            'worker', ['box4'], overrides=lambda name: {'Enabled': 'no'})
+        self.assertEqual(self.sbie.reload_config.call_count, 2)
+        self.assertEqual(
+            self._read_ini_bytes().decode('utf-16-le'),
+            '[foo]\nEnabled=yes\n'
+            '[box1]\nEnabled=yes\nOpenFilePath=a\nOpenFilePath=b\n\n'
+            '[box2]\nEnabled=yes\nFileRootPath=C:\\box2\n\n'
+            '[box3]\nEnabled=yes\nOpenFilePath=a\nOpenFilePath=b\n\n'
+            '[box4]\nEnabled=no\nOpenFilePath=a\nOpenFilePath=b\n\n')
+        config = self.sbie.get_config()
+        self.assertTrue(config['box1'].entries is config['box3'].entries)
+        self.assertRaises(ValueError, self.sbie.create_from_template,
+                          'missing', ['box5'])
+
+    def test_metrics_record_operations(self):
+        self._write_ini('[foo]\nEnabled=y\n')
+        size = len(self._read_ini_bytes())
+        observed = []
+        self.sbie.metrics.add_observer(
+            lambda operation, seconds, error: observed.append(operation))
+        self.sbie._shell_output = mock.Mock(
+            side_effect=[b'', subprocess.CalledProcessError(1, 'Start.exe')])
+        self.sbie.create_sandbox('bar', {'Enabled': 'y'})
+        self.assertRaises(subprocess.CalledProcessError, self.sbie.start,
+                          'test.exe')
+
+        snapshot = self.sbie.metrics.snapshot()
+        operations = snapshot['operations']
+        for operation in ('create_sandbox', 'commit', '_parse_config',
+                          '_write_config', 'reload_config'):
+            self.assertEqual(operations[operation]['count'], 1, operation)
+            self.assertEqual(operations[operation]['buckets'][-1][1], 1)
+        self.assertEqual(operations['start']['count'], 2)
+        self.assertEqual(operations['start']['errors'], 1)
+        self.assertTrue(operations['_open_config_file']['count'] > 0)
+        self.assertTrue(snapshot['bytes_read'] >= size)
+        self.assertEqual(snapshot['bytes_written'],
+                         len(self._read_ini_bytes()))
+        self.assertTrue('create_sandbox' in observed)
+
+    def test_metrics_export_prometheus(self):
+        metrics = sandboxie.Metrics()
+        metrics.observe('start', 0.003)
+        metrics.observe('start', 2, error=OSError())
+        metrics.add_bytes(read=10, written=5)
+        text = metrics.export_prometheus()
+        for line in (
+                '# TYPE sandboxie_operation_seconds histogram',
+                'sandboxie_operation_seconds_bucket'
+                '{operation="start",le="0.0025"} 0',
+                'sandboxie_operation_seconds_bucket'
+                '{operation="start",le="0.005"} 1',
+                'sandboxie_operation_seconds_bucket'
+                '{operation="start",le="+Inf"} 2',
+                'sandboxie_operation_seconds_sum{operation="start"} 2.003',
+                'sandboxie_operation_seconds_count{operation="start"} 2',
+                'sandboxie_operation_errors_total{operation="start"} 1',
+                'sandboxie_config_bytes_read_total 10',
+                'sandboxie_config_bytes_written_total 5'):
+            self.assertTrue(line in text.splitlines(), line)
+
     def test_reload_delegates_to_start(self):
         self.sbie.start = mock.Mock()
         self.sbie.reload_config()
@@ -139,13 +676,89 @@ class SandboxieUnitTests(unittest.TestCase):
         self.sbie.running_processes()
         self.sbie.start.assert_called_once(listpids=True, box=None)
 
-    def test_running_processes_returns_pidlist_generator(self):
+    def test_running_processes_returns_pid_set(self):
         self.sbie._shell_output = mock.Mock()
         pidlist = '\r\n'.join(('13', '2705', '1336', '2914'))
         self.sbie._shell_output.return_value = pidlist
-        pid_generator = self.sbie.running_processes()
-        self.assertEqual(type(pid_generator), types.GeneratorType)
-        self.assertEqual(tuple(pid_generator), (13, 2705, 1336, 2914))
+        pids = self.sbie.running_processes()
+        self.assertEqual(type(pids), frozenset)
+        self.assertEqual(pids, frozenset((13, 2705, 1336, 2914)))
+
+    def test_running_processes_coalesces_concurrent_calls(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def shell_output(args):
+            started.set()
+            release.wait(5)
+            return '13\r\n'
+
+        self.sbie._shell_output = mock.Mock(side_effect=shell_output)
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.sbie.running_processes()))
+            for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [frozenset([13])] * 5)
+        self.assertEqual(self.sbie._shell_output.call_count, 1)
+
+    def test_process_table(self):
+        self._write_ini('[GlobalSettings]\n[a]\n[b]\n[bad]\n')
+
+        def running_processes(box):
+            time.sleep(0.1)
+            if box == 'bad':
+                raise subprocess.CalledProcessError(1, 'Start.exe')
+            return frozenset([len(box)])
+
+        self.sbie.running_processes = running_processes
+        started = time.monotonic()
+        table = self.sbie.process_table(max_workers=3)
+        self.assertTrue(time.monotonic() - started < 0.25)
+        self.assertEqual(table.pids, {'a': frozenset([1]),
+                                      'b': frozenset([1])})
+        self.assertEqual(list(table.errors), ['bad'])
+        self.assertEqual(sorted(table.latency), ['a', 'b', 'bad'])
+        self.assertTrue(all(latency >= 0.1
+                            for latency in table.latency.values()))
+
+        table = self.sbie.process_table(boxes=['b'])
+        self.assertEqual(table.pids, {'b': frozenset([1])})
+
+    def test_running_processes_cache(self):
+        sbie = Sandboxie(install_dir=self.config_dir, process_cache_ttl=60)
+        sbie._shell_output = mock.Mock(return_value='13\r\n')
+        sbie.running_processes('foo')
+        sbie.running_processes('foo')
+        sbie.running_processes('bar')
+        self.assertEqual(sbie._shell_output.call_count, 2)
+
+        sbie.start('notepad.exe', box='foo')
+        sbie.running_processes('foo')
+        sbie.running_processes('bar')
+        self.assertEqual(sbie._shell_output.call_count, 4)
+
+        sbie.terminate_processes(box='bar')
+        sbie.running_processes('foo')
+        sbie.running_processes('bar')
+        self.assertEqual(sbie._shell_output.call_count, 6)
+
+        sbie.terminate_all_processes()
+        sbie.running_processes('foo')
+        sbie.running_processes('bar')
+        self.assertEqual(sbie._shell_output.call_count, 9)
+
+        sbie.invalidate_process_cache('foo')
+        sbie.running_processes('foo')
+        sbie.running_processes('bar')
+        self.assertEqual(sbie._shell_output.call_count, 10)
 
     def test_start_command_with_spaces(self):
         self._test_start(self.default_start_options,
@@ -219,6 +832,1261 @@ class SandboxieUnitTests(unittest.TestCase):
         self._test_start(expected_options, command=None, terminate_all=True)
 
 
+# A stand-in for Start.exe that echoes its arguments, lists pids 13 and 2705
+# for /listpids, and fails for boxes named "missing".
+FAKE_START_EXE = '''#!{python}
+import sys
+args = sys.argv[1:]
+if '/box:missing' in args:
+    sys.exit(1)
+if '/listpids' in args:
+    sys.stdout.write('13\\r\\n2705\\r\\n')
+else:
+    sys.stdout.write(' '.join(args))
+'''
+
+
+STREAMING_START_EXE = '''#!{python}
+import sys
+import time
+command = sys.argv[-1]
+if command == 'lines':
+    for i in range(1000):
+        sys.stdout.write('line {{0}}\\n'.format(i))
+    sys.stderr.write('error\\n')
+elif command == 'long':
+    sys.stdout.write('x' * 100000)
+elif command == 'sleep':
+    sys.stdout.write('sleeping\\n')
+    sys.stdout.flush()
+    time.sleep(60)
+'''
+
+
+def install_fake_start_exe(install_dir, source=FAKE_START_EXE):
+    path = os.path.join(install_dir, 'Start.exe')
+    with io.open(path, 'w') as f:
+        f.write(source.format(python=sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def run_coroutine(coroutine):
+    # Drives the loop by hand, as asyncio.run is new in Python 3.7.
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class ProcessWatcherUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.pids = {'foo': [1, 2], 'bar': []}
+        self.sbie = mock.Mock()
+        self.sbie.running_processes.side_effect = (
+            lambda box: iter(self.pids[box]))
+        self.sbie.list_boxes.return_value = ['foo', 'bar']
+
+    def _consume_events(self, watcher, count):
+        """Consumes *count* events of *watcher* in a thread, which is
+        returned with the list they are added to once it has subscribed."""
+        events = watcher.events(timeout=5)
+        received = []
+        consumer = threading.Thread(
+            target=lambda: received.extend(itertools.islice(events, count)))
+        consumer.daemon = True
+        consumer.start()
+        deadline = time.monotonic() + 5
+        while not watcher._callbacks:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        return events, consumer, received
+
+    def test_poll_reports_started_and_exited_processes(self):
+        watcher = sandboxie.ProcessWatcher(self.sbie, boxes=['foo', 'bar'])
+        received = []
+        watcher.subscribe(received.append)
+        ProcessEvent = sandboxie.ProcessEvent
+        self.assertEqual(watcher.poll(), [ProcessEvent('started', 'foo', 1),
+                                          ProcessEvent('started', 'foo', 2)])
+        self.pids = {'foo': [2], 'bar': [3]}
+        self.assertEqual(watcher.poll(), [ProcessEvent('started', 'bar', 3),
+                                          ProcessEvent('exited', 'foo', 1)])
+        self.assertEqual(len(received), 4)
+        self.assertEqual(watcher.snapshot, {'foo': frozenset([2]),
+                                            'bar': frozenset([3])})
+
+    def test_poll_watches_all_boxes_by_default(self):
+        watcher = sandboxie.ProcessWatcher(self.sbie)
+        watcher.poll()
+        self.assertEqual(sorted(watcher.snapshot), ['bar', 'foo'])
+
+    def test_poll_interval_adapts_to_activity(self):
+        watcher = sandboxie.ProcessWatcher(self.sbie, min_interval=1,
+                                           max_interval=5)
+        watcher.poll()
+        self.assertEqual(watcher.interval, 1)
+        watcher.poll()
+        watcher.poll()
+        self.assertEqual(watcher.interval, 4)
+        watcher.poll()
+        self.assertEqual(watcher.interval, 5)
+        self.pids['bar'] = [7]
+        watcher.poll()
+        self.assertEqual(watcher.interval, 1)
+
+    def test_poll_keeps_previous_snapshot_on_error(self):
+        watcher = sandboxie.ProcessWatcher(self.sbie, boxes=['foo'])
+        watcher.poll()
+        error = subprocess.CalledProcessError(1, 'Start.exe')
+        self.sbie.running_processes.side_effect = error
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.errors, {'foo': error})
+        self.assertEqual(watcher.snapshot, {'foo': frozenset([1, 2])})
+
+    def test_watcher_survives_timeouts_and_failures(self):
+        runner = sandboxie.FakeRunner()
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        with io.open(os.path.join(config_dir, 'Sandboxie.ini'), 'w'):
+            pass
+        os.environ = {'WinDir': 'does_not_exist'}
+        sbie = Sandboxie(install_dir=config_dir, runner=runner, timeout=0.05)
+        runner.delay = 0.2
+        watcher = sandboxie.ProcessWatcher(sbie, boxes=['foo'],
+                                           min_interval=0.01,
+                                           max_interval=0.01)
+        with watcher:
+            deadline = time.monotonic() + 5
+            while 'foo' not in watcher.errors:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+            self.assertTrue(isinstance(watcher.errors['foo'],
+                                       sandboxie.CommandTimeout))
+            _, consumer, received = self._consume_events(watcher, 1)
+            runner.delay = 0
+            sbie.start('a.exe', box='foo')
+            consumer.join(5)
+            self.assertEqual([event.kind for event in received], ['started'])
+        self.assertEqual(watcher.errors, {})
+
+        self.sbie.list_boxes.side_effect = SandboxieError('gone')
+        watcher = sandboxie.ProcessWatcher(self.sbie)
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(list(watcher.errors), [None])
+
+        calls = []
+
+        def running_processes(box):
+            calls.append(box)
+            if len(calls) == 1:
+                raise KeyError('bug')
+            return iter(self.pids[box])
+        self.sbie.running_processes.side_effect = running_processes
+        watcher = sandboxie.ProcessWatcher(self.sbie, boxes=['foo'],
+                                           min_interval=0.01,
+                                           max_interval=0.01)
+        with watcher:
+            deadline = time.monotonic() + 5
+            while not watcher.polls:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+        self.assertEqual(watcher.snapshot, {'foo': frozenset([1, 2])})
+
+    def test_events_iterator(self):
+        watcher = sandboxie.ProcessWatcher(self.sbie, boxes=['foo'],
+                                           min_interval=0.01)
+        # An iterator only subscribes once it is iterated.
+        watcher.events()
+        self.assertEqual(watcher._callbacks, [])
+        events, consumer, received = self._consume_events(watcher, 2)
+        with watcher:
+            consumer.join(5)
+            self.assertEqual([event.kind for event in received],
+                             ['started', 'started'])
+            self.pids['foo'] = []
+            self.assertEqual([next(events).pid, next(events).pid], [1, 2])
+        self.assertEqual(list(events), [])
+        self.assertEqual(watcher._callbacks, [])
+
+        watcher = sandboxie.ProcessWatcher(self.sbie, boxes=['foo'],
+                                           min_interval=0.01)
+        self.pids['foo'] = [3]
+        events, consumer, received = self._consume_events(watcher, 1)
+        with watcher:
+            consumer.join(5)
+            self.assertEqual([event.pid for event in received], [3])
+            events.close()
+            self.assertEqual(watcher._callbacks, [])
+
+
+class SandboxieConfigUnitTests(unittest.TestCase):
+    TEXT = ('\ufeff; comment\r\n'
+            '[GlobalSettings]\r\n'
+            'FileRootPath=C:\\Sandbox\\%USER%\\%SANDBOX%\r\n'
+            '\r\n'
+            '[DefaultBox]\r\n'
+            'Enabled=y\r\n'
+            '# another comment\r\n'
+            'OpenFilePath=a.exe,C:\\a\r\n'
+            'OpenFilePath = b.exe,C:\\b\r\n'
+            'not a setting\r\n'
+            '[DefaultBox]\r\n'
+            'OpenFilePath=c.exe,C:\\c\r\n')
+
+    def setUp(self):
+        self.config = SandboxieConfig.from_string(self.TEXT)
+
+    def test_parse(self):
+        self.assertEqual(self.config.sections(),
+                         ['GlobalSettings', 'DefaultBox'])
+        self.assertEqual(self.config['GlobalSettings']['FileRootPath'],
+                         'C:\\Sandbox\\%USER%\\%SANDBOX%')
+        self.assertEqual(self.config['DefaultBox'].entries,
+                         (('Enabled', 'y'),
+                          ('OpenFilePath', 'a.exe,C:\\a'),
+                          ('OpenFilePath', 'b.exe,C:\\b'),
+                          ('OpenFilePath', 'c.exe,C:\\c')))
+
+    def test_settings_are_case_insensitive_and_multi_valued(self):
+        box = self.config['DefaultBox']
+        self.assertEqual(box['openfilepath'], 'a.exe,C:\\a')
+        self.assertEqual(self.config.get_all('DefaultBox', 'OPENFILEPATH'),
+                         ['a.exe,C:\\a', 'b.exe,C:\\b', 'c.exe,C:\\c'])
+        self.assertEqual(list(box), ['Enabled', 'OpenFilePath'])
+        self.assertEqual(len(box), 2)
+
+        box['openfilepath'] = ['x', 'y']
+        box.add('ForceProcess', 'z.exe')
+        box['Enabled'] = 'n'
+        self.assertEqual(box.entries,
+                         (('Enabled', 'n'), ('OpenFilePath', 'x'),
+                          ('OpenFilePath', 'y'), ('ForceProcess', 'z.exe')))
+        del box['OpenFilePath']
+        self.assertEqual(dict(box), {'Enabled': 'n', 'ForceProcess': 'z.exe'})
+
+    def test_typed_getters(self):
+        config = SandboxieConfig.from_string(
+            '[foo]\nEnabled=y\nDropAdminRights=off\nConfigLevel=7\n'
+            'Ratio=0.5\nBad=maybe\n')
+        self.assertIs(config.getboolean('foo', 'Enabled'), True)
+        self.assertIs(config.getboolean('foo', 'dropadminrights'), False)
+        self.assertEqual(config.getint('foo', 'ConfigLevel'), 7)
+        self.assertEqual(config.getfloat('foo', 'Ratio'), 0.5)
+        self.assertRaises(ValueError, config.getboolean, 'foo', 'Bad')
+        self.assertRaises(ValueError, config.getint, 'foo', 'Ratio')
+        self.assertEqual(config.getint('foo', 'nope', fallback=3), 3)
+        self.assertEqual(config.getboolean('bar', 'Enabled', fallback=None),
+                         None)
+        self.assertRaises(configparser.NoOptionError, config.getint,
+                          'foo', 'nope')
+        self.assertRaises(configparser.NoSectionError, config.getboolean,
+                          'bar', 'Enabled')
+
+    def test_configparser_compatible_interface(self):
+        config = self.config
+        self.assertEqual(config.get('DefaultBox', 'Enabled'), 'y')
+        self.assertEqual(config.get('DefaultBox', 'nope', fallback=1), 1)
+        self.assertRaises(configparser.NoOptionError, config.get,
+                          'DefaultBox', 'nope')
+        self.assertRaises(configparser.NoSectionError, config.get,
+                          'nope', 'Enabled')
+        self.assertRaises(configparser.DuplicateSectionError,
+                          config.add_section, 'DefaultBox')
+        config['foo'] = {'Enabled': 'yes'}
+        config.set('foo', 'ConfigLevel', '7')
+        self.assertEqual(config.items('foo'),
+                         [('Enabled', 'yes'), ('ConfigLevel', '7')])
+        self.assertTrue(config.remove_option('foo', 'ConfigLevel'))
+        self.assertTrue(config.remove_section('foo'))
+        self.assertFalse(config.remove_section('foo'))
+
+    def test_invalid_settings_are_rejected(self):
+        box = self.config['DefaultBox']
+        self.assertRaises(ValueError, box.__setitem__, 'a=b', 'c')
+        self.assertRaises(ValueError, box.__setitem__, 'a', 'b\nc')
+        self.assertRaises(ValueError, self.config.add_section, 'a]\n[b')
+
+    def test_copy_is_independent(self):
+        copy = self.config.copy()
+        self.assertEqual(copy, self.config)
+        copy['DefaultBox']['Enabled'] = 'n'
+        copy.remove_section('GlobalSettings')
+        self.assertEqual(self.config['DefaultBox']['Enabled'], 'y')
+        self.assertTrue(self.config.has_section('GlobalSettings'))
+
+    def test_round_trip(self):
+        text = self.config.to_string()
+        self.assertEqual(text.split('\n')[:3],
+                         ['[GlobalSettings]',
+                          'FileRootPath=C:\\Sandbox\\%USER%\\%SANDBOX%',
+                          ''])
+        self.assertEqual(SandboxieConfig.from_string(text), self.config)
+
+        parser = configparser.ConfigParser(strict=False, interpolation=None)
+        parser.read_string(text)
+        self.assertEqual(parser.sections(), self.config.sections())
+
+
+class FakeSandboxieTestCase(unittest.TestCase):
+    """Sets up a temporary install dir whose Sandboxie.ini holds
+    ``config_text``, and ``self.sbie``, a :class:`Sandboxie` instance using
+    it, created with ``sandboxie_options``, which runs commands with
+    ``self.runner``, a :class:`sandboxie.FakeRunner`."""
+
+    config_text = ''
+    sandboxie_options = {}
+
+    def setUp(self):
+        os.environ = {'WinDir': 'does_not_exist'}
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        self.config_path = os.path.join(self.config_dir, 'Sandboxie.ini')
+        self._write_ini(self.config_text)
+        self.runner = sandboxie.FakeRunner()
+        self.sbie = Sandboxie(install_dir=self.config_dir, runner=self.runner,
+                              **self.sandboxie_options)
+
+    def _write_ini(self, text):
+        with io.open(self.config_path, 'w', encoding='utf-16-le') as f:
+            f.write(text)
+
+
+class AsyncSandboxieUnitTests(FakeSandboxieTestCase):
+    def setUp(self):
+        FakeSandboxieTestCase.setUp(self)
+        install_fake_start_exe(self.config_dir)
+        self.sbie = sandboxie.AsyncSandboxie(install_dir=self.config_dir)
+
+    def _run(self, coroutine):
+        return run_coroutine(coroutine)
+
+    def test_start_runs_start_exe(self):
+        output = self._run(self.sbie.start('test.exe', box='foo'))
+        self.assertEqual(output.split(),
+                         [b'/box:foo', b'/silent', b'/nosbiectrl',
+                          b'test.exe'])
+
+    def test_start_raises_called_process_error(self):
+        self.assertRaises(subprocess.CalledProcessError, self._run,
+                          self.sbie.start('test.exe', box='missing'))
+
+    def test_running_processes(self):
+        pids = self._run(self.sbie.running_processes(box='foo'))
+        self.assertEqual(pids, frozenset([13, 2705]))
+
+    def test_concurrent_operations(self):
+        async def start_many():
+            return await asyncio.gather(*[
+                self.sbie.start('test{0}.exe'.format(i))
+                for i in range(20)])
+
+        outputs = self._run(start_many())
+        self.assertEqual([output.split()[-1] for output in outputs],
+                         [('test{0}.exe'.format(i)).encode()
+                          for i in range(20)])
+
+    def test_operations_are_instrumented(self):
+        self._run(self.sbie.running_processes(box='foo'))
+        self.assertRaises(subprocess.CalledProcessError, self._run,
+                          self.sbie.start('test.exe', box='missing'))
+        operations = self.sbie.sandboxie.metrics.snapshot()['operations']
+        self.assertEqual(operations['async_running_processes']['count'], 1)
+        self.assertEqual(operations['async_start']['count'], 2)
+        self.assertEqual(operations['async_start']['errors'], 1)
+
+    def test_create_and_destroy_sandbox(self):
+        self._run(self.sbie.create_sandbox('foo', {'Enabled': 'yes'}))
+        config = self._run(self.sbie.get_config())
+        self.assertEqual(config['foo']['Enabled'], 'yes')
+        self._run(self.sbie.destroy_sandbox('foo'))
+        config = self._run(self.sbie.get_config())
+        self.assertFalse(config.has_section('foo'))
+
+
+class CommandRunnerUnitTests(FakeSandboxieTestCase):
+    def setUp(self):
+        FakeSandboxieTestCase.setUp(self)
+        self.start_exe = install_fake_start_exe(self.config_dir)
+
+    def test_worker_pool_runner_runs_commands(self):
+        with sandboxie.WorkerPoolRunner(workers=2) as runner:
+            sbie = Sandboxie(install_dir=self.config_dir, runner=runner)
+            self.assertEqual(sbie.running_processes(box='foo'),
+                             frozenset([13, 2705]))
+            self.assertEqual(sbie.start('test.exe', box='foo').split(),
+                             [b'/box:foo', b'/silent', b'/nosbiectrl',
+                              b'test.exe'])
+            self.assertRaises(subprocess.CalledProcessError, sbie.start,
+                              'test.exe', box='missing')
+            self.assertRaises(OSError, runner.run,
+                              [os.path.join(self.config_dir, 'missing')])
+
+            futures = sbie.start_many(
+                [('test{0}.exe'.format(i), 'foo') for i in range(10)],
+                max_workers=4)
+            self.assertEqual([f.result().split()[-1] for f in futures],
+                             [('test{0}.exe'.format(i)).encode()
+                              for i in range(10)])
+            self.assertEqual(runner._spawned, 2)
+        self.assertEqual(runner._spawned, 0)
+        self.assertRaises(SandboxieError, runner.run, [self.start_exe])
+
+    def test_worker_pool_runner_replaces_dead_workers(self):
+        with sandboxie.WorkerPoolRunner() as runner:
+            self.assertEqual(runner.run([self.start_exe, 'a']), b'a')
+            worker = runner._idle.get()
+            worker.kill()
+            worker.wait()
+            runner._idle.put(worker)
+            self.assertRaises(SandboxieError, runner.run,
+                              [self.start_exe, 'b'])
+            self.assertEqual(runner.run([self.start_exe, 'c']), b'c')
+
+    def test_worker_pool_runner_close_wakes_waiting_calls(self):
+        install_fake_start_exe(self.config_dir, STREAMING_START_EXE)
+        runner = sandboxie.WorkerPoolRunner(workers=1)
+        errors = []
+
+        def run(timeout):
+            try:
+                runner.run([self.start_exe, 'sleep'], timeout)
+            except (SandboxieError, subprocess.TimeoutExpired) as e:
+                errors.append(e)
+
+        busy = threading.Thread(target=run, args=(2,))
+        busy.daemon = True
+        busy.start()
+        while runner._spawned == 0:
+            time.sleep(0.01)
+        waiting = threading.Thread(target=run, args=(2,))
+        waiting.daemon = True
+        waiting.start()
+        time.sleep(0.2)
+        runner.close()
+        waiting.join(1)
+        self.assertFalse(waiting.is_alive())
+        self.assertTrue(isinstance(errors[0], SandboxieError))
+        busy.join(10)
+        self.assertTrue(isinstance(errors[1], subprocess.TimeoutExpired))
+        self.assertEqual(runner._spawned, 0)
+        self.assertRaises(SandboxieError, runner.run, [self.start_exe])
+
+    def test_worker_pool_runner_replaces_worker_dying_under_waiter(self):
+        install_fake_start_exe(self.config_dir, STREAMING_START_EXE)
+        runner = sandboxie.WorkerPoolRunner(workers=1)
+        spawned = []
+        spawn = runner._spawn
+        runner._spawn = lambda: spawned.append(spawn()) or spawned[-1]
+        results = {}
+
+        def run(name, args):
+            try:
+                results[name] = runner.run([self.start_exe] + args, 30)
+            except SandboxieError as e:
+                results[name] = e
+
+        busy = threading.Thread(target=run, args=('busy', ['sleep']))
+        busy.daemon = True
+        busy.start()
+        while not spawned:
+            time.sleep(0.01)
+        waiting = threading.Thread(target=run, args=('waiting', ['long']))
+        waiting.daemon = True
+        waiting.start()
+        time.sleep(0.2)
+        spawned[0].kill()
+        busy.join(10)
+        waiting.join(10)
+        self.assertFalse(waiting.is_alive())
+        self.assertTrue(isinstance(results['busy'], SandboxieError))
+        self.assertEqual(results['waiting'], b'x' * 100000)
+        self.assertEqual(len(spawned), 2)
+        runner.close()
+        self.assertEqual(runner._spawned, 0)
+
+    def test_spawn_streams_output(self):
+        install_fake_start_exe(self.config_dir, STREAMING_START_EXE)
+        sbie = Sandboxie(install_dir=self.config_dir)
+        with sbie.spawn('lines', stderr=subprocess.PIPE) as process:
+            lines = list(process)
+            self.assertEqual(len(lines), 1000)
+            self.assertEqual(lines[-1], b'line 999\n')
+            self.assertEqual(list(process.iter_lines('stderr')),
+                             [b'error\n'])
+            self.assertEqual(process.wait(5), 0)
+        self.assertEqual(process.args[1:], ['/box:DefaultBox', '/silent',
+                                            '/nosbiectrl', 'lines'])
+
+        with sbie.start('lines', stream=True,
+                        wait=True) as process:
+            self.assertTrue(isinstance(process, sandboxie.SandboxedProcess))
+            self.assertRaises(ValueError, list, process.iter_lines('stderr'))
+            self.assertEqual(sum(len(chunk) for chunk in
+                                 process.iter_chunks(chunk_size=100)), 8890)
+
+        with sbie.spawn('long') as process:
+            lines = list(process.iter_lines(max_line_length=1000))
+            self.assertEqual(len(lines), 100)
+            self.assertEqual(set(len(line) for line in lines), set([1000]))
+
+    def test_spawn_can_be_terminated(self):
+        install_fake_start_exe(self.config_dir, STREAMING_START_EXE)
+        sbie = Sandboxie(install_dir=self.config_dir)
+        with sbie.spawn('sleep') as process:
+            self.assertEqual(next(iter(process)), b'sleeping\n')
+            self.assertEqual(process.poll(), None)
+            self.assertRaises(subprocess.TimeoutExpired, process.wait, 0.05)
+            process.terminate()
+            self.assertNotEqual(process.wait(5), 0)
+
+        with sbie.spawn('sleep') as process:
+            pass
+        self.assertNotEqual(process.returncode, None)
+        self.assertTrue(process.process.stdout.closed)
+
+    def test_fake_runner_spawns_processes(self):
+        runner = sandboxie.FakeRunner()
+        sbie = Sandboxie(install_dir=self.config_dir, runner=runner)
+        process = sbie.spawn('a.exe', box='foo')
+        self.assertEqual(process.poll(), None)
+        self.assertEqual(sbie.running_processes(box='foo'),
+                         frozenset([process.pid]))
+        process.terminate()
+        self.assertEqual(process.wait(1), 1)
+        self.assertEqual(sbie.running_processes(box='foo'), frozenset())
+        self.assertEqual(sbie.spawn('b.exe', wait=True).wait(1), 0)
+
+    def test_fake_runner_drives_sandboxie(self):
+        runner = sandboxie.FakeRunner()
+        sbie = Sandboxie(install_dir=self.config_dir, runner=runner)
+        sbie.create_sandbox('foo', {'Enabled': 'yes'})
+        self.assertEqual(runner.reloads, 1)
+        sbie.start('a.exe', box='foo')
+        sbie.start('b.exe', box='foo')
+        sbie.start('c.exe', box='foo', wait=True)
+        sbie.start('d.exe')
+        self.assertEqual(len(sbie.running_processes(box='foo')), 2)
+        self.assertEqual(len(sbie.running_processes()), 1)
+        sbie.terminate_processes(box='foo')
+        self.assertEqual(sbie.running_processes(box='foo'), frozenset())
+        self.assertEqual(len(sbie.running_processes()), 1)
+        sbie.terminate_all_processes()
+        self.assertEqual(sbie.running_processes(), frozenset())
+        self.assertEqual(len(runner.calls), 12)
+
+    def test_async_sandboxie_uses_runner(self):
+        runner = sandboxie.FakeRunner()
+        sbie = sandboxie.AsyncSandboxie(install_dir=self.config_dir,
+                                        runner=runner)
+        run_coroutine(sbie.start('a.exe', box='foo'))
+        pids = run_coroutine(sbie.running_processes(box='foo'))
+        self.assertEqual(pids, frozenset(runner.processes['foo']))
+        self.assertEqual(len(pids), 1)
+
+    def test_async_sandboxie_invalidates_process_cache(self):
+        runner = sandboxie.FakeRunner()
+        sbie = sandboxie.AsyncSandboxie(install_dir=self.config_dir,
+                                        runner=runner, process_cache_ttl=60)
+        cached = sbie.sandboxie.running_processes
+        self.assertEqual(cached(box='foo'), frozenset())
+        run_coroutine(sbie.start('a.exe', box='foo'))
+        self.assertEqual(len(cached(box='foo')), 1)
+        run_coroutine(sbie.start('b.exe'))
+        self.assertEqual(len(cached()), 1)
+        run_coroutine(sbie.terminate_processes(box='foo'))
+        self.assertEqual(cached(box='foo'), frozenset())
+        run_coroutine(sbie.terminate_all_processes())
+        self.assertEqual(cached(), frozenset())
+
+    def test_runners_kill_commands_that_time_out(self):
+        install_fake_start_exe(self.config_dir, STREAMING_START_EXE)
+        with sandboxie.WorkerPoolRunner() as pooled:
+            for runner in (sandboxie.SubprocessRunner(), pooled):
+                started = time.monotonic()
+                self.assertRaises(subprocess.TimeoutExpired, runner.run,
+                                  [self.start_exe, 'sleep'], 0.2)
+                self.assertLess(time.monotonic() - started, 10)
+            self.assertEqual(pooled.run([self.start_exe, 'long'], 10),
+                             b'x' * 100000)
+
+        sbie = sandboxie.AsyncSandboxie(install_dir=self.config_dir)
+        with self.assertRaises(sandboxie.CommandTimeout) as cm:
+            run_coroutine(sbie.start('sleep', timeout=0.2))
+        self.assertEqual(cm.exception.timeout, 0.2)
+
+    def test_timeouts(self):
+        runner = sandboxie.FakeRunner()
+        sbie = Sandboxie(install_dir=self.config_dir, runner=runner,
+                         timeout=0.05)
+        runner.delay = 0.2
+        with self.assertRaises(sandboxie.CommandTimeout) as cm:
+            sbie.start('a.exe', box='foo')
+        self.assertEqual(cm.exception.timeout, 0.05)
+        self.assertEqual(cm.exception.cmd[-1], 'a.exe')
+        self.assertEqual(runner.killed, [cm.exception.cmd])
+        self.assertEqual(runner.processes['foo'], {})
+
+        sbie.timeout = None
+        self.assertRaises(sandboxie.CommandTimeout, sbie.start, 'b.exe',
+                          box='foo', timeout=0.05)
+        runner.delay = 0.01
+        sbie.start('c.exe', box='foo', timeout=5)
+        self.assertEqual(len(runner.processes['foo']), 1)
+
+    def test_failed_reload_is_retried_by_next_commit(self):
+        runner = sandboxie.FakeRunner()
+        sbie = Sandboxie(install_dir=self.config_dir, runner=runner)
+        runner.delay = 0.2
+        with sbie.deadline(0.05):
+            self.assertRaises(sandboxie.CommandTimeout, sbie.create_sandbox,
+                              'foo', {'Enabled': 'yes'})
+        self.assertEqual(runner.reloads, 0)
+        runner.delay = 0
+        diff = sbie.create_sandbox('foo', {'Enabled': 'yes'})
+        self.assertFalse(diff)
+        self.assertEqual(runner.reloads, 1)
+        sbie.create_sandbox('foo', {'Enabled': 'yes'})
+        self.assertEqual(runner.reloads, 1)
+
+    def test_deadline_applies_to_nested_calls_and_threads(self):
+        runner = sandboxie.FakeRunner()
+        sbie = Sandboxie(install_dir=self.config_dir, runner=runner)
+        runner.delay = 0.2
+        with sbie.deadline(0.05) as deadline:
+            # An inner deadline cannot extend the outer one.
+            with sbie.deadline(10) as inner:
+                self.assertEqual(inner, deadline)
+                self.assertRaises(sandboxie.CommandTimeout,
+                                  sbie.create_sandbox, 'foo', {})
+            self.assertTrue(sbie.box_exists('foo'))
+            self.assertEqual(runner.reloads, 0)
+            self.assertEqual(len(runner.killed), 1)
+            self.assertRaises(sandboxie.CommandTimeout, sbie.start, 'a.exe',
+                              timeout=10)
+            self.assertEqual(len(runner.killed), 1)
+
+        with sbie.deadline(0.05):
+            table = sbie.process_table(['foo', 'bar'])
+            futures = sbie.start_many([('a.exe', 'foo'), ('b.exe', 'bar')])
+            for future in futures:
+                self.assertTrue(isinstance(future.exception(),
+                                           sandboxie.CommandTimeout))
+        self.assertEqual(set(table.errors), set(['foo', 'bar']))
+        for error in table.errors.values():
+            self.assertTrue(isinstance(error, sandboxie.CommandTimeout))
+        self.assertEqual(runner.calls, [])
+
+        runner.delay = 0
+        sbie.start('a.exe', box='foo')
+        self.assertEqual(len(runner.processes['foo']), 1)
+
+    def test_deadline_bounds_waits_for_shared_calls(self):
+        runner = sandboxie.FakeRunner()
+        sbie = Sandboxie(install_dir=self.config_dir, runner=runner,
+                         reload_delay=1)
+        runner.delay = 1
+        leader = threading.Thread(target=sbie.running_processes, args=('foo',))
+        leader.start()
+        self.addCleanup(leader.join)
+        while not sbie._process_cache._flights:
+            time.sleep(0.001)
+        started = time.monotonic()
+        with sbie.deadline(0.1):
+            self.assertRaises(sandboxie.CommandTimeout,
+                              sbie.running_processes, 'foo')
+        self.assertRaises(sandboxie.CommandTimeout, sbie.running_processes,
+                          'foo', timeout=0.1)
+        self.assertLess(time.monotonic() - started, 0.5)
+
+        runner.delay = 0
+        sbie.create_sandbox('bar', {'Enabled': 'yes'})
+        with sbie.deadline(0.05):
+            self.assertRaises(sandboxie.CommandTimeout, sbie.wait_reloaded)
+        self.assertFalse(sbie.wait_reloaded(0.01))
+        self.assertTrue(sbie.wait_reloaded(5))
+
+
+class SandboxPoolUnitTests(FakeSandboxieTestCase):
+    config_text = '[PoolBox1]\nEnabled=yes\n'
+
+    def _wait_for(self, predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            self.assertTrue(time.monotonic() < deadline)
+            time.sleep(0.01)
+
+    def test_pool_provisions_and_recycles_sandboxes(self):
+        with sandboxie.SandboxPool(self.sbie, {'Enabled': 'yes'},
+                                   min_size=2, max_size=2) as pool:
+            self.assertEqual(self.sbie.list_boxes(),
+                             ['PoolBox1', 'PoolBox2', 'PoolBox3'])
+            self.assertEqual(self.runner.reloads, 1)
+            with pool.lease() as first:
+                self.sbie.start('job.exe', box=first)
+                second = pool.acquire()
+            self.assertEqual(set([first, second]),
+                             set(['PoolBox2', 'PoolBox3']))
+            self.assertEqual(pool.acquire(timeout=5), first)
+            self.assertEqual(self.runner.deleted, [first])
+            self.assertEqual(self.sbie.running_processes(box=first),
+                             frozenset())
+            stats = pool.stats()
+            self.assertEqual((stats.size, stats.idle, stats.leased,
+                              stats.recycling, stats.leases),
+                             (2, 0, 2, 0, 3))
+            self.assertEqual(self.runner.reloads, 1)
+            pool.release(first)
+            pool.release(second)
+        self.assertEqual(self.sbie.list_boxes(), ['PoolBox1'])
+
+    def test_pool_reloads_config_before_leasing_new_sandboxes(self):
+        sbie = Sandboxie(install_dir=self.config_dir, runner=self.runner,
+                         reload_delay=60)
+        with sandboxie.SandboxPool(sbie, {'Enabled': 'yes'},
+                                   min_size=1, max_size=2) as pool:
+            self.assertEqual(self.runner.reloads, 1)
+            with pool.lease():
+                self.assertEqual(self.runner.reloads, 1)
+                with pool.lease():
+                    self.assertEqual(self.runner.reloads, 2)
+
+    def test_lease_times_out_when_pool_is_exhausted(self):
+        pool = sandboxie.SandboxPool(self.sbie, {'Enabled': 'yes'},
+                                     max_size=1)
+        box = pool.acquire()
+        self.assertEqual(self.sbie.list_boxes(), ['PoolBox1', box])
+        self.assertRaises(sandboxie.SandboxPoolTimeout, pool.acquire,
+                          timeout=0.05)
+        self.assertRaises(ValueError, pool.release, 'PoolBox1')
+        pool.release(box)
+        pool.close()
+        self.assertEqual(self.sbie.list_boxes(), ['PoolBox1'])
+        self.assertRaises(SandboxieError, pool.acquire)
+
+    def test_idle_sandboxes_are_trimmed(self):
+        with sandboxie.SandboxPool(self.sbie, {'Enabled': 'yes'},
+                                   min_size=1, max_size=3,
+                                   idle_timeout=0.05) as pool:
+            boxes = [pool.acquire() for _ in range(3)]
+            for box in boxes:
+                pool.release(box)
+            self._wait_for(lambda: len(self.sbie.list_boxes()) == 2)
+            self.assertEqual(pool.stats().size, 1)
+
+    def test_sandboxes_that_fail_to_recycle_are_destroyed(self):
+        with sandboxie.SandboxPool(self.sbie, {'Enabled': 'yes'}) as pool:
+            self.sbie.terminate_processes = mock.Mock(
+                side_effect=SandboxieError('boom'))
+            with self.assertLogs('sandboxie', 'ERROR'):
+                with pool.lease():
+                    pass
+                self._wait_for(lambda: pool.stats().size == 0)
+            self.assertEqual(self.sbie.list_boxes(), ['PoolBox1'])
+
+
+class JobSchedulerUnitTests(FakeSandboxieTestCase):
+    config_text = '[foo]\nEnabled=yes\n'
+
+    def _block(self, scheduler, box='foo'):
+        """Submits a job that runs until the returned event is set."""
+        release = threading.Event()
+        started = threading.Event()
+
+        def job():
+            started.set()
+            release.wait(5)
+        future = scheduler.submit_call(job, box=box)
+        self.assertTrue(started.wait(5))
+        return release, future
+
+    def test_scheduler_runs_jobs(self):
+        with sandboxie.JobScheduler(self.sbie, max_workers=4) as scheduler:
+            futures = [scheduler.submit('job{0}.exe'.format(i),
+                                        box='box{0}'.format(i % 3))
+                       for i in range(20)]
+            failing = scheduler.submit_call(lambda: 1 / 0)
+            self.assertTrue(scheduler.drain(5))
+        for future in futures:
+            self.assertEqual(future.result(), b'')
+        self.assertRaises(ZeroDivisionError, failing.result)
+        self.assertEqual(sum(len(processes) for processes in
+                             self.runner.processes.values()), 20)
+        stats = scheduler.stats()
+        self.assertEqual((stats.queued, stats.running, stats.submitted,
+                          stats.completed, stats.failed, stats.rejected),
+                         (0, 0, 21, 21, 1, 0))
+        self.assertEqual(self.sbie.metrics.snapshot()['operations'][
+            'JobScheduler.wait']['count'], 21)
+        self.assertRaises(SandboxieError, scheduler.submit, 'late.exe')
+
+    def test_scheduler_orders_jobs_by_priority_and_tenant(self):
+        scheduler = sandboxie.JobScheduler(self.sbie, max_workers=1)
+        release, _ = self._block(scheduler)
+        order = []
+        for tenant, count in (('a', 4), ('b', 2)):
+            for i in range(count):
+                name = '{0}{1}'.format(tenant, i)
+                scheduler.submit_call(functools.partial(order.append, name),
+                                      tenant=tenant)
+        scheduler.submit_call(functools.partial(order.append, 'urgent'),
+                              tenant='c', priority=5)
+        cancelled = scheduler.submit_call(
+            functools.partial(order.append, 'cancelled'), tenant='c')
+        self.assertTrue(cancelled.cancel())
+        self.assertEqual(scheduler.stats().queued, 7)
+        release.set()
+        scheduler.close()
+        self.assertEqual(order, ['urgent', 'a0', 'b0', 'a1', 'b1', 'a2',
+                                 'a3'])
+        self.assertEqual(scheduler.stats().peak_queued, 8)
+
+    def test_scheduler_limits_jobs_per_box(self):
+        running = collections.Counter()
+        peaks = collections.Counter()
+        lock = threading.Lock()
+
+        def job(box):
+            with lock:
+                running[box] += 1
+                peaks[box] = max(peaks[box], running[box])
+            time.sleep(0.01)
+            with lock:
+                running[box] -= 1
+
+        with sandboxie.JobScheduler(self.sbie, max_workers=4,
+                                    max_per_box=2) as scheduler:
+            futures = [scheduler.submit_call(functools.partial(job, box), box)
+                       for box in ['foo'] * 8 + ['bar'] * 2]
+        for future in futures:
+            future.result()
+        self.assertEqual(peaks, {'foo': 2, 'bar': 2})
+
+    def test_scheduler_applies_backpressure(self):
+        scheduler = sandboxie.JobScheduler(self.sbie, max_workers=1,
+                                           max_queued=2, block=False)
+        release, _ = self._block(scheduler)
+        first = scheduler.submit('a.exe')
+        scheduler.submit('b.exe')
+        self.assertRaises(sandboxie.JobQueueFull, scheduler.submit, 'c.exe')
+        self.assertTrue(first.cancel())
+        scheduler.submit('c.exe')
+
+        scheduler.block = True
+        self.assertRaises(sandboxie.JobQueueFull, scheduler.submit, 'd.exe',
+                          queue_timeout=0.05)
+        with self.sbie.deadline(0.05):
+            self.assertRaises(sandboxie.JobQueueFull, scheduler.submit,
+                              'd.exe')
+        self.assertEqual(scheduler.stats().rejected, 3)
+
+        threading.Timer(0.05, release.set).start()
+        scheduler.submit('d.exe', queue_timeout=5).result(5)
+        scheduler.close()
+        processes = self.runner.processes[self.sbie.defaultbox]
+        self.assertEqual(sorted(processes.values()),
+                         ['b.exe', 'c.exe', 'd.exe'])
+
+    def test_scheduler_close_cancels_queued_jobs(self):
+        scheduler = sandboxie.JobScheduler(self.sbie, max_workers=1,
+                                           max_per_box=1)
+        release, running = self._block(scheduler)
+        queued = [scheduler.submit('a.exe'), scheduler.submit('b.exe')]
+        threading.Timer(0.05, release.set).start()
+        scheduler.close(cancel=True)
+        self.assertTrue(running.done())
+        self.assertTrue(all(future.cancelled() for future in queued))
+        self.assertEqual(scheduler.stats().queued, 0)
+        self.assertEqual(self.runner.calls, [])
+
+
+class CleanupQueueUnitTests(FakeSandboxieTestCase):
+    sandboxie_options = {'cleanup_workers': 1}
+
+    def _block_cleanup_of(self, blocked_box):
+        """Queues the cleanup of *blocked_box*, and makes it block until the
+        returned event is set. Returns the event, the future of the cleanup
+        and the list of sandboxes cleaned up so far."""
+        started = threading.Event()
+        release = threading.Event()
+        cleaned = []
+        delete_contents = self.sbie.delete_contents
+
+        def blocking_delete_contents(box, **kwargs):
+            if box == blocked_box and not started.is_set():
+                started.set()
+                self.assertTrue(release.wait(5))
+            cleaned.append(box)
+            delete_contents(box, **kwargs)
+
+        self.sbie.delete_contents = blocking_delete_contents
+        future = self.sbie.cleanup_async(blocked_box)
+        self.assertTrue(started.wait(5))
+        return release, future, cleaned
+
+    def test_cleanup_terminates_processes_and_deletes_contents(self):
+        self.sbie.start('test.exe', box='foo')
+        self.sbie.start('test.exe', box='bar')
+        self.assertEqual(self.sbie.cleanup_async('foo').result(5), None)
+        self.assertEqual(self.runner.deleted, ['foo'])
+        self.assertEqual(self.sbie.running_processes(box='foo'), frozenset())
+        self.assertEqual(len(self.sbie.running_processes(box='bar')), 1)
+        self.sbie.cleanup_async().result(5)
+        self.assertEqual(self.runner.deleted, ['foo', 'DefaultBox'])
+
+    def test_cleanups_are_deduplicated_and_prioritized(self):
+        release, _, cleaned = self._block_cleanup_of('busy')
+        a = self.sbie.cleanup_async('a')
+        self.sbie.cleanup_async('b')
+        self.sbie.cleanup_async('c', priority=5)
+        self.assertTrue(self.sbie.cleanup_async('a') is a)
+        self.assertTrue(self.sbie.cleanup_async('a', priority=10) is a)
+        self.assertFalse(self.sbie.drain(timeout=0.05))
+        release.set()
+        self.assertTrue(self.sbie.drain(timeout=5))
+        self.assertEqual(cleaned, ['busy', 'a', 'c', 'b'])
+        self.assertTrue(a.done())
+
+    def test_cleanups_of_a_sandbox_do_not_overlap(self):
+        self.sbie = Sandboxie(install_dir=self.config_dir, runner=self.runner,
+                              cleanup_workers=4)
+        release, first, cleaned = self._block_cleanup_of('busy')
+        second = self.sbie.cleanup_async('busy')
+        self.assertFalse(first is second)
+        self.sbie.cleanup_async('other').result(5)
+        self.assertEqual(cleaned, ['other'])
+        release.set()
+        self.assertTrue(self.sbie.drain(timeout=5))
+        self.assertEqual(cleaned, ['other', 'busy', 'busy'])
+
+    def test_cleanup_errors_are_set_on_the_future(self):
+        self.sbie.terminate_processes = mock.Mock(
+            side_effect=subprocess.CalledProcessError(1, 'Start.exe'))
+        future = self.sbie.cleanup_async('foo')
+        self.assertRaises(subprocess.CalledProcessError, future.result, 5)
+        self.assertTrue(self.sbie.drain(timeout=5))
+
+
+class BoxContentsUnitTests(FakeSandboxieTestCase):
+    def setUp(self):
+        FakeSandboxieTestCase.setUp(self)
+        self.sandbox_dir = os.path.join(self.config_dir, 'Sandbox')
+        self._write_ini(
+            '[GlobalSettings]\n'
+            'FileRootPath={0}/%USER%/%SANDBOX%\n'
+            '[foo]\n'
+            'Enabled=yes\n'
+            '[bar]\n'
+            'FileRootPath=\\??\\%ROOT%/custom/%SANDBOX%\n'.format(
+                self.sandbox_dir))
+        self.root = os.path.join(self.sandbox_dir, getpass.getuser(), 'foo')
+
+    def tearDown(self):
+        # Wait for tombstones still being deleted in the background.
+        for thread in threading.enumerate():
+            if thread.name == 'sandboxie-job-runner':
+                thread.join(5)
+
+    def _make_tree(self, root, dirs=3, files=3, depth=3):
+        os.makedirs(root)
+        for i in range(files):
+            with io.open(os.path.join(root, 'file{0}'.format(i)), 'wb') as f:
+                f.write(b'x' * i)
+        if depth:
+            for i in range(dirs):
+                self._make_tree(os.path.join(root, 'dir{0}'.format(i)), dirs,
+                                files, depth - 1)
+
+    def test_box_root(self):
+        self.assertEqual(self.sbie.box_root('foo'), self.root)
+        os.environ['ROOT'] = self.config_dir
+        self.assertEqual(self.sbie.box_root('bar'),
+                         self.config_dir + '/custom/bar')
+        self.assertRaises(configparser.NoSectionError, self.sbie.box_root,
+                          'missing')
+        self._write_ini('[foo]\nEnabled=yes\n')
+        self.assertEqual(self.sbie.box_root('foo'),
+                         'C:\\Sandbox\\{0}\\foo'.format(getpass.getuser()))
+
+    def test_reset_box_empties_sandbox(self):
+        self._make_tree(self.root)
+        os.chmod(os.path.join(self.root, 'file1'), stat.S_IREAD)
+        outside = os.path.join(self.config_dir, 'outside')
+        self._make_tree(outside, depth=0)
+        os.symlink(outside, os.path.join(self.root, 'dir0', 'link'))
+        leftover = self.root + '.sandboxie-deleted-leftover'
+        self._make_tree(leftover, depth=1)
+
+        deleted = self.sbie.reset_box('foo', max_workers=4)
+        self.assertFalse(os.path.exists(self.root))
+        self.assertEqual(deleted.result(5), None)
+        self.assertEqual(os.listdir(os.path.dirname(self.root)), [])
+        self.assertEqual(len(os.listdir(outside)), 3)
+        self.assertEqual(self.sbie.reset_box('foo').result(5), None)
+
+    def _read_tree(self, root):
+        tree = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                relpath = os.path.relpath(path, root)
+                if os.path.islink(path):
+                    tree[relpath] = 'link:' + os.readlink(path)
+                elif os.path.isdir(path):
+                    tree[relpath] = 'dir'
+                else:
+                    with io.open(path, 'rb') as f:
+                        tree[relpath] = f.read()
+        return tree
+
+    def test_snapshot_and_restore_box(self):
+        self._make_tree(self.root)
+        os.symlink('file0', os.path.join(self.root, 'dir1', 'link'))
+        tree = self._read_tree(self.root)
+        counts = self.sbie.snapshot_box('foo', 'golden')
+        self.assertEqual(sum(counts.values()), 120)
+        snapshot = os.path.join(os.path.dirname(self.root), '.snapshots',
+                                'golden')
+        self.assertEqual(self.sbie.snapshot_path('golden', 'foo'), snapshot)
+        self.assertEqual(self._read_tree(snapshot), tree)
+
+        os.unlink(os.path.join(self.root, 'file2'))
+        self._make_tree(os.path.join(self.root, 'new'), depth=0)
+        self.sbie.restore_box('foo', 'golden')
+        self.assertEqual(self._read_tree(self.root), tree)
+
+        self.sbie.snapshot_dir = os.path.join(self.config_dir, 'snapshots')
+        self.sbie.snapshot_box('foo')
+        os.environ['ROOT'] = self.config_dir
+        self.sbie.restore_box('bar', 'foo')
+        self.assertEqual(self._read_tree(self.sbie.box_root('bar')), tree)
+
+        self.assertRaises(SandboxieError, self.sbie.restore_box, 'foo',
+                          'missing')
+        for name in ('..', 'a/b', os.path.join('a', 'b')):
+            self.assertRaises(ValueError, self.sbie.snapshot_box, 'foo', name)
+
+    def test_snapshot_box_with_hardlinks(self):
+        self._make_tree(self.root, depth=1)
+        counts = self.sbie.snapshot_box('foo', 'golden', hardlink=True)
+        self.assertEqual(counts, {'hardlink': 12})
+        snapshot = self.sbie.snapshot_path('golden', 'foo')
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.root, 'dir2', 'file1'),
+            os.path.join(snapshot, 'dir2', 'file1')))
+
+    def test_tree_cloner_falls_back_to_plain_copies(self):
+        src = os.path.join(self.config_dir, 'src')
+        self._make_tree(src, depth=1)
+        cloner = sandboxie._TreeCloner(max_workers=2)
+        cloner._reflink = False
+        with mock.patch('os.copy_file_range', create=True,
+                        side_effect=OSError(18, 'EXDEV')):
+            counts = cloner.clone_tree(src, src + '-copy')
+        self.assertEqual(counts, {'copy': 12})
+        self.assertFalse(cloner._copy_file_range)
+        self.assertEqual(self._read_tree(src + '-copy'),
+                         self._read_tree(src))
+
+    def _age_tree(self, root, seconds=3600):
+        """Sets the modification times of the directory tree *root* to
+        *seconds* ago, so that they are not considered racy."""
+        past = time.time() - seconds
+        for dirpath, _, _ in os.walk(root):
+            os.utime(dirpath, (past, past))
+
+    def test_box_usage_and_changed_files(self):
+        self._make_tree(self.root, depth=1)
+        self.assertEqual(self.sbie.box_usage('foo'), (12, 12))
+        changes = self.sbie.changed_files('foo')
+        self.assertEqual(len(changes.added), 12)
+        self.assertEqual((changes.modified, changes.deleted), ([], []))
+        self.assertTrue(os.path.exists(os.path.join(
+            os.path.dirname(self.root), '.index', 'foo.json.gz')))
+
+        checkpoint = changes.checkpoint
+        with io.open(os.path.join(self.root, 'dir0', 'new'), 'wb') as f:
+            f.write(b'12345')
+        with io.open(os.path.join(self.root, 'temp'), 'wb') as f:
+            f.write(b'1234')
+        os.replace(os.path.join(self.root, 'temp'),
+                   os.path.join(self.root, 'file1'))
+        os.unlink(os.path.join(self.root, 'dir1', 'file2'))
+        shutil.rmtree(os.path.join(self.root, 'dir2'))
+        with io.open(os.path.join(self.root, 'dir1', 'gone'), 'wb') as f:
+            f.write(b'1')
+
+        self.assertEqual(self.sbie.content_checkpoint('foo'),
+                         checkpoint + 1)
+        os.unlink(os.path.join(self.root, 'dir1', 'gone'))
+        changes = self.sbie.changed_files('foo', since=checkpoint)
+        self.assertEqual(changes, (
+            checkpoint + 2,
+            [os.path.join('dir0', 'new')],
+            ['file1'],
+            [os.path.join('dir1', 'file2'), os.path.join('dir2', 'file0'),
+             os.path.join('dir2', 'file1'), os.path.join('dir2', 'file2')]))
+        self.assertEqual(self.sbie.box_usage('foo'), (9, 12 + 5 + 3 - 2 - 3))
+        self.assertEqual(self.sbie.changed_files(
+            'foo', since=changes.checkpoint)[1:], ([], [], []))
+
+    def test_changed_files_of_deleted_and_recreated_file(self):
+        self._make_tree(self.root, depth=1)
+        path = os.path.join(self.root, 'file0')
+        checkpoint = self.sbie.content_checkpoint('foo')
+        os.unlink(path)
+        gap = self.sbie.content_checkpoint('foo')
+        with io.open(path, 'wb') as f:
+            f.write(b'recreated')
+        recreated = self.sbie.content_checkpoint('foo')
+        self.assertEqual(self.sbie.changed_files('foo', since=checkpoint)[1:],
+                         ([], ['file0'], []))
+        self.assertEqual(self.sbie.changed_files('foo', since=gap)[1:],
+                         (['file0'], [], []))
+
+        os.unlink(path)
+        self.sbie.content_checkpoint('foo')
+        sbie = Sandboxie(install_dir=self.config_dir, runner=self.runner)
+        for instance in (self.sbie, sbie):
+            self.assertEqual(
+                instance.changed_files('foo', since=checkpoint)[1:],
+                ([], [], ['file0']))
+            self.assertEqual(instance.changed_files('foo', since=gap)[1:],
+                             ([], [], []))
+            self.assertEqual(
+                instance.changed_files('foo', since=recreated)[1:],
+                ([], [], ['file0']))
+
+    def test_content_index_forgets_old_changes(self):
+        self._make_tree(self.root, depth=1)
+        first = self.sbie.content_checkpoint('foo')
+        shutil.rmtree(self.root)
+        with mock.patch.object(sandboxie._ContentIndex,
+                               'retained_generations', 5):
+            for i in range(10):
+                self._make_tree(self.root, depth=1)
+                self.sbie.content_checkpoint('foo')
+                shutil.rmtree(self.root)
+                checkpoint = self.sbie.content_checkpoint('foo')
+            index = self.sbie._content_indexes['foo']
+            self.assertEqual(index.oldest, index.generation - 5)
+            self.assertTrue(sum(len(lifetimes) for lifetimes
+                                in index.deleted.values()) <= 3 * 12)
+            self.assertTrue(len(index._log) <= 5 * 12)
+
+            self.assertRaises(sandboxie.CheckpointExpired,
+                              self.sbie.changed_files, 'foo', since=first)
+            changes = self.sbie.changed_files('foo', since=checkpoint - 1)
+            self.assertEqual((changes.added, changes.modified),
+                             ([], []))
+            self.assertEqual(len(changes.deleted), 12)
+
+            # The history limit survives reloading the index.
+            sbie = Sandboxie(install_dir=self.config_dir, runner=self.runner)
+            self.assertEqual(sbie.changed_files('foo', since=checkpoint - 1),
+                             changes)
+            self.assertRaises(sandboxie.CheckpointExpired,
+                              sbie.changed_files, 'foo', since=first)
+            self.assertEqual(sbie.changed_files('foo')[1:], ([], [], []))
+
+    def test_content_index_only_rescans_changed_directories(self):
+        self._make_tree(self.root)
+        self._age_tree(self.root)
+        checkpoint = self.sbie.content_checkpoint('foo')
+        with io.open(os.path.join(self.root, 'dir2', 'dir0', 'new'),
+                     'wb') as f:
+            f.write(b'12345')
+
+        scanned = []
+        scan_dir = sandboxie._ContentIndex._scan_dir
+
+        def tracking_scan_dir(index, rel, signature):
+            scanned.append(rel)
+            return scan_dir(index, rel, signature)
+
+        with mock.patch.object(sandboxie._ContentIndex, '_scan_dir',
+                               tracking_scan_dir):
+            # A new instance loads the persisted index.
+            sbie = Sandboxie(install_dir=self.config_dir, runner=self.runner)
+            changes = sbie.changed_files('foo', since=checkpoint)
+            self.assertEqual(scanned, [os.path.join('dir2', 'dir0')])
+            self.assertEqual(changes.added,
+                             [os.path.join('dir2', 'dir0', 'new')])
+            self.assertEqual(sbie.box_usage('foo'), (121, 125))
+
+            # Files modified in place are only seen by a full refresh.
+            path = os.path.join(self.root, 'dir1', 'file1')
+            with io.open(path, 'ab') as f:
+                f.write(b'1')
+            self.assertEqual(sbie.box_usage('foo'), (121, 125))
+            self.assertEqual(sbie.box_usage('foo', full=True), (121, 126))
+            changes = sbie.changed_files('foo', since=changes.checkpoint)
+            self.assertEqual(changes.modified,
+                             [os.path.join('dir1', 'file1')])
+
+    def test_delete_contents_uses_reset_box_if_fast_reset(self):
+        self._make_tree(self.root, depth=1)
+        self.sbie.delete_contents('foo', wait=True)
+        self.assertTrue(os.path.exists(self.root))
+        self.assertEqual(self.runner.deleted, ['foo'])
+
+        self.sbie.fast_reset = True
+        self.sbie.delete_contents('foo', wait=True)
+        self.assertFalse(os.path.exists(self.root))
+        self.assertEqual(os.listdir(os.path.dirname(self.root)), [])
+        self.assertEqual(self.runner.deleted, ['foo'])
+
+    def test_content_operations_are_instrumented(self):
+        self.sbie.content_checkpoint('foo')
+        self.sbie.start_many([('a.exe', 'foo')])[0].result()
+        operations = self.sbie.metrics.snapshot()['operations']
+        for operation in ('content_checkpoint', 'box_root', 'start_many',
+                          'start'):
+            self.assertEqual(operations[operation]['count'], 1, operation)
+
+    def test_async_delete_contents_uses_reset_box_if_fast_reset(self):
+        self._make_tree(self.root, depth=1)
+        self.sbie.fast_reset = True
+        asbie = sandboxie.AsyncSandboxie(sandboxie=self.sbie)
+        run_coroutine(asbie.delete_contents('foo', wait=True))
+        self.assertFalse(os.path.exists(self.root))
+        self.assertEqual(os.listdir(os.path.dirname(self.root)), [])
+        self.assertEqual(self.runner.deleted, [])
+
+    def _wait_for_log(self, logs, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not logs.records and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_background_deletion_errors_are_logged(self):
+        self._make_tree(self.root, depth=1)
+        self.sbie.fast_reset = True
+        with mock.patch('sandboxie._remove_tree',
+                        side_effect=OSError(13, 'Permission denied')):
+            with self.assertLogs('sandboxie', 'ERROR') as logs:
+                self.sbie.delete_contents('foo')
+                self._wait_for_log(logs)
+        self.assertIn("sandbox 'foo'", logs.output[0])
+        self.assertFalse(os.path.exists(self.root))
+
+    def test_snapshot_deletion_errors_are_logged(self):
+        self._make_tree(self.root, depth=1)
+        self.sbie.snapshot_box('foo', 'golden')
+        with mock.patch('sandboxie._remove_tree',
+                        side_effect=OSError(13, 'Permission denied')):
+            with self.assertLogs('sandboxie', 'ERROR') as logs:
+                self.sbie.snapshot_box('foo', 'golden')
+                self._wait_for_log(logs)
+            self.assertIn("snapshot 'golden'", logs.output[0])
+            with self.assertLogs('sandboxie', 'ERROR') as logs:
+                self.sbie.restore_box('foo', 'golden')
+                self._wait_for_log(logs)
+            self.assertIn("sandbox 'foo'", logs.output[0])
+        self.assertEqual(sorted(os.listdir(self.root)),
+                         ['dir0', 'dir1', 'dir2', 'file0', 'file1', 'file2'])
+
+
 class SandboxieStartCommandMatcher(object):
     def __init__(self, start_exe, command, options):
         self.start_exe = start_exe